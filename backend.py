@@ -3,18 +3,28 @@ import os
 import tempfile
 import json
 import re
+import math
 import time
 import threading
+import asyncio
 import uuid
 import base64
+import random
+import copy
+import difflib
 from io import BytesIO
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from types import MappingProxyType
 from PyPDF2 import PdfReader
-from flask import Flask, request, jsonify # Removed send_file as we're not sending local files anymore
+from flask import Flask, Response, request, jsonify # Removed send_file as we're not sending local files anymore
 from flask_cors import CORS
 import requests
 from werkzeug.utils import secure_filename
 import shutil
+import subprocess
+import struct
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
 from dotenv import load_dotenv
 import anthropic
 import traceback
@@ -51,6 +61,9 @@ AWS_DEFAULT_REGION = os.environ.get("AWS_DEFAULT_REGION")
 RAZORPAY_KEY_ID = os.environ.get("RAZORPAY_KEY_ID")
 RAZORPAY_KEY_SECRET = os.environ.get("RAZORPAY_KEY_SECRET")
 RAZORPAY_WEBHOOK_SECRET = os.environ.get("RAZORPAY_WEBHOOK_SECRET")
+# Follow-up requests allowed when an LLM reply stops on its token limit (0 disables continuation)
+LLM_CONTINUATION_MAX_ROUNDS = int(os.environ.get('LLM_CONTINUATION_MAX_ROUNDS', 2))
+OPENAI_CONTINUATION_PROMPT = "Continue exactly where your previous message stopped. Do not repeat anything already written and do not add any commentary."
 # AWS Keys might be needed if IAM role on Render doesn't work for Polly
 # AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
 # AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
@@ -228,6 +241,564 @@ def add_conversation_message(interview_id, role, content):
         if isinstance(e, TypeError) and 'Cannot convert to a Firestore Value' in str(e):
              print(f"[{interview_id}] Likely caused by nested timestamp issue during ArrayUnion.")
         return False
+
+
+# === Token Estimation ===
+# Offline prompt-size estimates so prompt builders can fit content to a token budget before sending.
+# The base estimate is UTF-8 bytes / 4 (one pass in C, ~tens of microseconds for 30k chars); a per-model
+# correction factor is learned as an EMA of API-reported input tokens / estimated tokens on single-request calls.
+
+TOKEN_ESTIMATE_BYTES_PER_TOKEN = 4.0
+TOKEN_CALIBRATION_ALPHA = 0.1
+TOKEN_CALIBRATION_BOUNDS = (0.5, 2.5) # ignore samples whose ratio falls outside this (e.g. cached prompts)
+_token_calibration = {} # model -> {'factor', 'samples'}; None key holds the all-model factor
+_token_calibration_lock = threading.Lock()
+
+
+def estimate_tokens(text, model=None, calibrated=True):
+    """Estimates the token count of `text` for `model`, using its calibration factor when one has been learned."""
+    if not text:
+        return 0
+    raw = len(text.encode('utf-8', 'replace')) / TOKEN_ESTIMATE_BYTES_PER_TOKEN
+    calibration = (_token_calibration.get(model) or _token_calibration.get(None)) if calibrated else None
+    return int(raw * calibration['factor'] + 0.5) if calibration else int(raw + 0.5)
+
+
+def estimate_payload_tokens(payload, model=None, calibrated=True):
+    """Estimates input tokens for a Claude or OpenAI request payload (system, messages, tools, response schema)."""
+    parts = [payload.get("system") or ""]
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        parts.append(content if isinstance(content, str) else json.dumps(content))
+    for key in ("tools", "response_format"):
+        if payload.get(key):
+            parts.append(json.dumps(payload[key]))
+    return estimate_tokens("\n".join(parts), model, calibrated)
+
+
+def observe_token_usage(model, raw_estimated_tokens, actual_tokens):
+    """Updates the model's (and the all-model) calibration factor from an uncalibrated estimate and the reported usage."""
+    if not raw_estimated_tokens or not actual_tokens:
+        return
+    ratio = actual_tokens / raw_estimated_tokens
+    if not TOKEN_CALIBRATION_BOUNDS[0] <= ratio <= TOKEN_CALIBRATION_BOUNDS[1]:
+        return
+    with _token_calibration_lock:
+        for key in (model, None):
+            calibration = _token_calibration.get(key)
+            if calibration is None:
+                _token_calibration[key] = {'factor': ratio, 'samples': 1}
+            else:
+                calibration['factor'] += TOKEN_CALIBRATION_ALPHA * (ratio - calibration['factor'])
+                calibration['samples'] += 1
+
+
+def truncate_to_token_budget(text, token_budget, model=None, marker="\n[... truncated to fit token budget]"):
+    """Returns `text` cut (at a whitespace boundary where possible) so its estimate fits `token_budget`."""
+    if not text:
+        return text or ""
+    estimate = estimate_tokens(text, model)
+    if estimate <= token_budget:
+        return text
+    text_budget = token_budget - estimate_tokens(marker, model)
+    cut = int(len(text) * text_budget / estimate)
+    while cut > 0:
+        boundary = max(text.rfind(' ', max(0, cut - 200), cut), text.rfind('\n', max(0, cut - 200), cut))
+        truncated = text[:boundary if boundary > 0 else cut].rstrip()
+        if estimate_tokens(truncated, model) <= text_budget:
+            print(f"Truncated prompt text from ~{estimate} to ~{token_budget} tokens ({len(text)} -> {len(truncated)} chars).")
+            return truncated + marker
+        cut = int(cut * 0.95) # multi-byte text estimates higher per char; shrink and retry
+    return marker.lstrip()
+
+
+def get_token_estimator_stats():
+    """Returns learned calibration factors per model."""
+    with _token_calibration_lock:
+        calibration = {(model or 'all'): {'factor': round(c['factor'], 4), 'samples': c['samples']}
+                       for model, c in _token_calibration.items()}
+    return {'calibration': calibration}
+
+
+# === LLM Telemetry ===
+# Every call_claude_api/call_openai_api call produces one telemetry record (provider, model, feature tag,
+# input/output/cached tokens from the API usage field, latency, gateway retries, continuations, truncation).
+# Records are aggregated per feature+model for /metrics and per session (resume session or interview id)
+# for the summaries stored on those documents.
+
+LLM_PRICING_PER_MILLION_TOKENS = MappingProxyType({ # (input, output) USD list prices, used for estimates only
+    CLAUDE_MODEL: (3.0, 15.0),
+    CLAUDE_HAIKU_MODEL: (0.25, 1.25),
+    OPENAI_MODEL: (2.5, 10.0)
+})
+LLM_TELEMETRY_MAX_SESSIONS = int(os.environ.get('LLM_TELEMETRY_MAX_SESSIONS', 500))
+_llm_usage_totals = {} # (feature, model) -> counters
+_llm_session_usage = OrderedDict() # session key -> {feature -> counters}, LRU order
+_llm_telemetry_lock = threading.Lock()
+_llm_telemetry_context = threading.local() # .session: usage session key for calls made on this thread
+
+
+def set_llm_usage_session(session_key):
+    """Attributes LLM calls made on the current thread to `session_key` (None to stop)."""
+    _llm_telemetry_context.session = session_key
+
+
+def new_llm_call_telemetry(provider, model, feature):
+    """Starts a telemetry record for one logical LLM call (including its retries and continuations)."""
+    return {
+        'provider': provider, 'model': model, 'feature': feature or 'other',
+        'session': getattr(_llm_telemetry_context, 'session', None),
+        'startedAt': time.monotonic(), 'requests': 0, 'retries': 0, 'continuations': 0, 'truncated': False,
+        'inputTokens': 0, 'outputTokens': 0, 'cachedTokens': 0, 'estimatedInputTokens': 0 # uncalibrated, set by the caller
+    }
+
+
+def add_llm_usage(telemetry, usage):
+    """Adds one response's `usage` block (Claude or OpenAI shape) to a telemetry record."""
+    if telemetry is None or not usage:
+        return
+    telemetry['requests'] += 1
+    if 'prompt_tokens' in usage: # OpenAI
+        telemetry['inputTokens'] += usage.get('prompt_tokens') or 0
+        telemetry['outputTokens'] += usage.get('completion_tokens') or 0
+        telemetry['cachedTokens'] += (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    else: # Anthropic reports cache reads/writes separately from input_tokens
+        cached = (usage.get('cache_read_input_tokens') or 0) + (usage.get('cache_creation_input_tokens') or 0)
+        telemetry['inputTokens'] += (usage.get('input_tokens') or 0) + cached
+        telemetry['outputTokens'] += usage.get('output_tokens') or 0
+        telemetry['cachedTokens'] += cached
+
+
+def _empty_llm_counters():
+    return {'calls': 0, 'errors': 0, 'inputTokens': 0, 'outputTokens': 0, 'cachedTokens': 0, 'retries': 0,
+            'continuations': 0, 'truncated': 0, 'latencySeconds': 0.0, 'maxLatencySeconds': 0.0, 'estimatedCostUsd': 0.0}
+
+
+def _add_to_llm_counters(counters, telemetry, success, latency, cost):
+    counters['calls'] += 1
+    counters['errors'] += 0 if success else 1
+    for key in ('inputTokens', 'outputTokens', 'cachedTokens', 'retries', 'continuations'):
+        counters[key] += telemetry[key]
+    counters['truncated'] += 1 if telemetry['truncated'] else 0
+    counters['latencySeconds'] += latency
+    counters['maxLatencySeconds'] = max(counters['maxLatencySeconds'], latency)
+    counters['estimatedCostUsd'] += cost
+
+
+def record_llm_call(telemetry, success):
+    """Finishes a telemetry record: logs it and adds it to the feature/model totals and its session summary."""
+    latency = time.monotonic() - telemetry['startedAt']
+    if success and telemetry['requests'] == 1 and not telemetry['cachedTokens']: # continuations resend the prompt
+        observe_token_usage(telemetry['model'], telemetry['estimatedInputTokens'], telemetry['inputTokens'])
+    input_price, output_price = LLM_PRICING_PER_MILLION_TOKENS.get(telemetry['model'], (0.0, 0.0))
+    cost = (telemetry['inputTokens'] * input_price + telemetry['outputTokens'] * output_price) / 1_000_000
+    print(f"LLM call [{telemetry['feature']}] {telemetry['model']}: {'ok' if success else 'FAILED'}, "
+          f"in={telemetry['inputTokens']} out={telemetry['outputTokens']} cached={telemetry['cachedTokens']}, "
+          f"{latency:.2f}s, retries={telemetry['retries']}, continuations={telemetry['continuations']}"
+          f"{', TRUNCATED' if telemetry['truncated'] else ''}")
+    with _llm_telemetry_lock:
+        counters = _llm_usage_totals.setdefault((telemetry['feature'], telemetry['model']), _empty_llm_counters())
+        _add_to_llm_counters(counters, telemetry, success, latency, cost)
+        session_key = telemetry['session']
+        if session_key:
+            session = _llm_session_usage.setdefault(session_key, {})
+            _llm_session_usage.move_to_end(session_key)
+            _add_to_llm_counters(session.setdefault(telemetry['feature'], _empty_llm_counters()), telemetry, success, latency, cost)
+            while len(_llm_session_usage) > LLM_TELEMETRY_MAX_SESSIONS:
+                _llm_session_usage.popitem(last=False)
+
+
+def _finish_llm_counters(counters):
+    """Rounds floats and adds the average latency for reporting."""
+    finished = dict(counters)
+    finished['avgLatencySeconds'] = round(counters['latencySeconds'] / counters['calls'], 3) if counters['calls'] else 0.0
+    finished['latencySeconds'] = round(counters['latencySeconds'], 3)
+    finished['maxLatencySeconds'] = round(counters['maxLatencySeconds'], 3)
+    finished['estimatedCostUsd'] = round(counters['estimatedCostUsd'], 6)
+    return finished
+
+
+def get_llm_usage_stats():
+    """Returns LLM usage totals grouped by feature, then model."""
+    with _llm_telemetry_lock:
+        by_feature = {}
+        for (feature, model), counters in _llm_usage_totals.items():
+            by_feature.setdefault(feature, {})[model] = _finish_llm_counters(counters)
+        return by_feature
+
+
+def get_llm_session_usage(session_key):
+    """Returns the per-feature usage summary plus a 'total' entry for a session, or None if nothing was recorded."""
+    with _llm_telemetry_lock:
+        session = _llm_session_usage.get(session_key)
+        if not session:
+            return None
+        total = _empty_llm_counters()
+        for counters in session.values():
+            for key, value in counters.items():
+                total[key] = max(total[key], value) if key == 'maxLatencySeconds' else total[key] + value
+        summary = {feature: _finish_llm_counters(counters) for feature, counters in session.items()}
+        summary['total'] = _finish_llm_counters(total)
+        return summary
+
+
+# === Circuit Breakers ===
+# Registry of breakers for external dependencies (LLM providers, Polly, Whisper, TTS, Razorpay). Each breaker
+# keeps a rolling window of call outcomes and latencies; it opens when the window's error rate crosses
+# CIRCUIT_ERROR_RATE_THRESHOLD, fails fast while open, and lets a single probe through once half-open.
+
+CIRCUIT_WINDOW_SECONDS = float(os.environ.get('CIRCUIT_WINDOW_SECONDS', 60))
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', 5)) # Calls in the window before the error rate counts
+CIRCUIT_ERROR_RATE_THRESHOLD = float(os.environ.get('CIRCUIT_ERROR_RATE_THRESHOLD', 0.5))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 30)) # Time before a half-open probe
+CIRCUIT_PROBE_TIMEOUT_SECONDS = 150 # A probe that never reports back stops blocking the next one after this
+CIRCUIT_SLOW_CALL_SECONDS = MappingProxyType({
+    'anthropic': 45, 'openai': 45, 'openai_tts': 15, 'whisper': 30, 'polly': 10, 'razorpay': 10
+})
+CIRCUIT_DEFAULT_SLOW_CALL_SECONDS = 30
+_circuit_breakers = {} # name -> {'state': closed/open/half_open, 'calls': deque of (at, ok, latency), ...}
+_circuit_lock = threading.Lock()
+
+
+def _get_circuit(name):
+    """Returns the breaker for `name`, creating it closed. Caller holds _circuit_lock."""
+    breaker = _circuit_breakers.get(name)
+    if breaker is None:
+        breaker = {'state': 'closed', 'calls': deque(), 'openedAt': None, 'probeStartedAt': None, 'opens': 0, 'rejected': 0}
+        _circuit_breakers[name] = breaker
+    return breaker
+
+
+def _open_circuit(name, breaker, reason):
+    """Moves a breaker to open. Caller holds _circuit_lock."""
+    if breaker['state'] != 'open':
+        breaker['opens'] += 1
+        print(f"Circuit '{name}' opened: {reason}")
+    breaker.update(state='open', openedAt=time.monotonic(), probeStartedAt=None)
+
+
+def circuit_is_open(name):
+    """True while `name` is open and not yet due for a half-open probe. Does not change breaker state."""
+    with _circuit_lock:
+        breaker = _circuit_breakers.get(name)
+        return bool(breaker and breaker['state'] == 'open' and time.monotonic() - breaker['openedAt'] < CIRCUIT_OPEN_SECONDS)
+
+
+def circuit_allows(name):
+    """
+    True if a call to `name` may proceed. An open breaker turns half-open after CIRCUIT_OPEN_SECONDS and then
+    admits one probe at a time; every other call is rejected (and counted) until the probe reports back.
+    """
+    with _circuit_lock:
+        breaker = _get_circuit(name)
+        now = time.monotonic()
+        if breaker['state'] == 'open' and now - breaker['openedAt'] >= CIRCUIT_OPEN_SECONDS:
+            breaker['state'] = 'half_open'
+        if breaker['state'] == 'closed':
+            return True
+        if breaker['state'] == 'half_open' and (breaker['probeStartedAt'] is None or now - breaker['probeStartedAt'] > CIRCUIT_PROBE_TIMEOUT_SECONDS):
+            breaker['probeStartedAt'] = now
+            return True
+        breaker['rejected'] += 1
+        return False
+
+
+def record_circuit_result(name, success, latency=None):
+    """
+    Records a call outcome. success=None marks a call that says nothing about dependency health
+    (e.g. a rejected request payload); it only frees a half-open probe slot. A breaker whose open period has
+    elapsed is treated as half-open, so breakers only checked with circuit_is_open (the per-model interviewer
+    routes) still close on success and re-open on failure.
+    """
+    with _circuit_lock:
+        breaker = _get_circuit(name)
+        now = time.monotonic()
+        if breaker['state'] == 'open' and now - breaker['openedAt'] >= CIRCUIT_OPEN_SECONDS:
+            breaker['state'] = 'half_open'
+        if success is None:
+            breaker['probeStartedAt'] = None
+            return
+        if breaker['state'] == 'half_open':
+            if success:
+                print(f"Circuit '{name}' closed after a successful probe.")
+                breaker.update(state='closed', openedAt=None, probeStartedAt=None)
+                breaker['calls'].clear()
+            else:
+                _open_circuit(name, breaker, "half-open probe failed")
+                return
+        calls = breaker['calls']
+        calls.append((now, bool(success), latency))
+        while calls and now - calls[0][0] > CIRCUIT_WINDOW_SECONDS:
+            calls.popleft()
+        if breaker['state'] == 'closed' and len(calls) >= CIRCUIT_MIN_CALLS:
+            failures = sum(1 for _, ok, _ in calls if not ok)
+            if failures / len(calls) >= CIRCUIT_ERROR_RATE_THRESHOLD:
+                _open_circuit(name, breaker, f"{failures}/{len(calls)} calls failed in the last {int(CIRCUIT_WINDOW_SECONDS)}s")
+
+
+def _is_neutral_circuit_error(error):
+    """Errors caused by the request itself (bad input/config, 4xx other than 429) rather than the dependency."""
+    if isinstance(error, (ValueError, razorpay.errors.BadRequestError)):
+        return True
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return isinstance(error, requests.exceptions.HTTPError) and status is not None and 400 <= status < 500 and status != 429
+
+
+def call_with_circuit(name, func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) behind the `name` breaker. Raises ConnectionError immediately while the
+    breaker is open; otherwise records the outcome and latency and returns func's result.
+    """
+    if not circuit_allows(name):
+        raise ConnectionError(f"{name} is unavailable (circuit open); failing fast")
+    started = time.monotonic()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        record_circuit_result(name, None if _is_neutral_circuit_error(e) else False, time.monotonic() - started)
+        raise
+    record_circuit_result(name, True, time.monotonic() - started)
+    return result
+
+
+def get_circuit_states():
+    """Returns state, rolling error rate, p95 latency and a 0-100 health score for every breaker."""
+    with _circuit_lock:
+        now = time.monotonic()
+        states = {}
+        for name, breaker in _circuit_breakers.items():
+            calls = [call for call in breaker['calls'] if now - call[0] <= CIRCUIT_WINDOW_SECONDS]
+            successes = [latency for _, ok, latency in calls if ok]
+            latencies = sorted(latency for _, _, latency in calls if latency is not None)
+            slow_limit = CIRCUIT_SLOW_CALL_SECONDS.get(name.split(':')[0], CIRCUIT_DEFAULT_SLOW_CALL_SECONDS)
+            slow_successes = sum(1 for latency in successes if latency is not None and latency > slow_limit)
+            state = breaker['state']
+            if state == 'open' and now - breaker['openedAt'] >= CIRCUIT_OPEN_SECONDS:
+                state = 'half_open' # due for a probe; the next recorded result decides
+            if state == 'open':
+                health = 0
+            elif calls: # Slow successes count half
+                health = round(100 * (len(successes) - 0.5 * slow_successes) / len(calls))
+            else:
+                health = 100
+            states[name] = {
+                'state': state,
+                'callsInWindow': len(calls),
+                'errorRate': round(1 - len(successes) / len(calls), 3) if calls else 0.0,
+                'p95LatencySeconds': round(latencies[max(0, int(len(latencies) * 0.95) - 1)], 3) if latencies else None,
+                'slowCalls': slow_successes,
+                'healthScore': health,
+                'opens': breaker['opens'],
+                'rejected': breaker['rejected']
+            }
+        return states
+
+
+# === LLM Gateway ===
+# All Claude/OpenAI text requests go through llm_gateway_post(), which limits concurrent requests and
+# tokens-per-minute per model, queues callers up to a deadline, and retries throttled/overloaded
+# responses honouring Retry-After. call_claude_api_async/call_openai_api_async are the asyncio entry points.
+
+LLM_GATEWAY_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('LLM_GATEWAY_QUEUE_TIMEOUT_SECONDS', 60))
+LLM_GATEWAY_MAX_RETRIES = int(os.environ.get('LLM_GATEWAY_MAX_RETRIES', 3))
+LLM_GATEWAY_RETRY_STATUSES = frozenset({429, 500, 502, 503, 529})
+LLM_MODEL_LIMITS = MappingProxyType({
+    CLAUDE_MODEL: {'maxConcurrent': int(os.environ.get('CLAUDE_MODEL_MAX_CONCURRENT', 4)),
+                   'tokensPerMinute': int(os.environ.get('CLAUDE_MODEL_TOKENS_PER_MINUTE', 80000))},
+    CLAUDE_HAIKU_MODEL: {'maxConcurrent': int(os.environ.get('CLAUDE_HAIKU_MAX_CONCURRENT', 8)),
+                         'tokensPerMinute': int(os.environ.get('CLAUDE_HAIKU_TOKENS_PER_MINUTE', 200000))},
+    OPENAI_MODEL: {'maxConcurrent': int(os.environ.get('OPENAI_MODEL_MAX_CONCURRENT', 6)),
+                   'tokensPerMinute': int(os.environ.get('OPENAI_MODEL_TOKENS_PER_MINUTE', 150000))}
+})
+LLM_DEFAULT_MODEL_LIMITS = {'maxConcurrent': 4, 'tokensPerMinute': 60000} # Models not listed above
+_llm_gateway_states = {} # model -> limiter state, created on first use
+_llm_gateway_states_lock = threading.Lock()
+
+
+def _get_llm_gateway_state(model):
+    """Returns the limiter state for a model, creating it on first use."""
+    with _llm_gateway_states_lock:
+        state = _llm_gateway_states.get(model)
+        if state is None:
+            limits = LLM_MODEL_LIMITS.get(model, LLM_DEFAULT_MODEL_LIMITS)
+            state = {
+                'limits': limits,
+                'slots': threading.BoundedSemaphore(limits['maxConcurrent']),
+                'condition': threading.Condition(),
+                'tokens': float(limits['tokensPerMinute']), # Token bucket, refilled continuously
+                'refilledAt': time.monotonic(),
+                'stats': {'requests': 0, 'inFlight': 0, 'queued': 0, 'retries': 0, 'throttled': 0,
+                          'queueTimeouts': 0, 'queueWaitSeconds': 0.0, 'tokensUsed': 0}
+            }
+            _llm_gateway_states[model] = state
+        return state
+
+
+def _refill_llm_tokens(state):
+    """Adds the tokens earned since the last refill. Caller holds state['condition']."""
+    now = time.monotonic()
+    capacity = state['limits']['tokensPerMinute']
+    state['tokens'] = min(capacity, state['tokens'] + (now - state['refilledAt']) * capacity / 60.0)
+    state['refilledAt'] = now
+
+
+def estimate_request_tokens(payload):
+    """Rough token reservation for a request: prompt characters / 4 plus the full output allowance."""
+    prompt_chars = len(json.dumps(payload.get("messages", []))) + len(str(payload.get("system", "")))
+    return prompt_chars // 4 + int(payload.get("max_tokens") or 1000)
+
+
+def acquire_llm_capacity(model, tokens, deadline):
+    """
+    Blocks until a concurrency slot and `tokens` of the model's per-minute budget are available.
+    Raises TimeoutError if that cannot happen before `deadline` (time.monotonic() based).
+    Returns the number of tokens reserved (capped at the bucket size).
+    """
+    state = _get_llm_gateway_state(model)
+    stats = state['stats']
+    queued_at = time.monotonic()
+    with state['condition']:
+        stats['queued'] += 1
+    try:
+        if not state['slots'].acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise TimeoutError(f"LLM gateway: no free slot for {model} before the deadline")
+        reserved = min(tokens, state['limits']['tokensPerMinute'])
+        with state['condition']:
+            _refill_llm_tokens(state)
+            while state['tokens'] < reserved:
+                wait_seconds = (reserved - state['tokens']) * 60.0 / state['limits']['tokensPerMinute']
+                if time.monotonic() + wait_seconds > deadline:
+                    state['slots'].release()
+                    raise TimeoutError(f"LLM gateway: token budget for {model} exhausted until after the deadline")
+                state['condition'].wait(timeout=wait_seconds)
+                _refill_llm_tokens(state)
+            state['tokens'] -= reserved
+            stats['inFlight'] += 1
+            stats['requests'] += 1
+            stats['queueWaitSeconds'] += time.monotonic() - queued_at
+        return reserved
+    except TimeoutError:
+        with state['condition']:
+            stats['queueTimeouts'] += 1
+        raise
+    finally:
+        with state['condition']:
+            stats['queued'] -= 1
+
+
+def release_llm_capacity(model, reserved_tokens, used_tokens=None):
+    """Frees the concurrency slot and settles the token reservation against actual usage (if known)."""
+    state = _get_llm_gateway_state(model)
+    with state['condition']:
+        if used_tokens is not None:
+            capacity = state['limits']['tokensPerMinute']
+            state['tokens'] = min(capacity, state['tokens'] + reserved_tokens - used_tokens)
+            state['stats']['tokensUsed'] += used_tokens
+        state['stats']['inFlight'] -= 1
+        state['condition'].notify_all()
+    state['slots'].release()
+
+
+def _retry_after_seconds(response, attempt):
+    """Delay before retrying: Retry-After / retry-after-ms headers if present, else exponential backoff with jitter."""
+    headers = response.headers if response is not None else {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass # HTTP-date form or garbage; fall back to backoff
+    return min(30.0, 2 ** attempt) + random.uniform(0, 0.5)
+
+
+def _usage_tokens(response):
+    """Total tokens reported by a Claude (input/output) or OpenAI (total) response body, or None."""
+    try:
+        usage = response.json().get("usage") or {}
+    except ValueError:
+        return None
+    if "total_tokens" in usage:
+        return usage["total_tokens"]
+    if "input_tokens" in usage or "output_tokens" in usage:
+        return usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+    return None
+
+
+def llm_gateway_post(model, url, headers, payload, timeout, deadline=None, circuit=None, telemetry=None):
+    """
+    Thread-safe entry point for LLM HTTP requests. Waits for capacity on `model`, posts, and retries
+    throttled (429) / overloaded (5xx, 529) responses and connection errors, honouring Retry-After.
+    `deadline` (time.monotonic() based, default now + LLM_GATEWAY_QUEUE_TIMEOUT_SECONDS) bounds queueing
+    and backoff. If `circuit` names a breaker, requests fail fast with ConnectionError while it is open
+    and the final outcome is recorded on it. Retries are counted on `telemetry` if given.
+    Returns the final requests.Response; the caller checks its status.
+    """
+    if circuit and not circuit_allows(circuit):
+        raise ConnectionError(f"{circuit} is unavailable (circuit open); failing fast")
+    if deadline is None:
+        deadline = time.monotonic() + LLM_GATEWAY_QUEUE_TIMEOUT_SECONDS
+    state = _get_llm_gateway_state(model)
+    try:
+        reserved = acquire_llm_capacity(model, estimate_request_tokens(payload), deadline)
+    except TimeoutError:
+        if circuit: record_circuit_result(circuit, None) # Local queueing, not a provider failure
+        raise
+    response = None
+    started = time.monotonic()
+    outcome = False
+    try:
+        for attempt in range(LLM_GATEWAY_MAX_RETRIES + 1):
+            try:
+                response = requests.post(url, headers=headers, json=payload, timeout=timeout)
+                if response.status_code not in LLM_GATEWAY_RETRY_STATUSES:
+                    outcome = True if response.ok else None # Other 4xx reflect the request, not provider health
+                    return response
+                if response.status_code == 429:
+                    with state['condition']:
+                        state['stats']['throttled'] += 1
+                error = None
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            delay = _retry_after_seconds(response if error is None else None, attempt)
+            if attempt == LLM_GATEWAY_MAX_RETRIES or time.monotonic() + delay > deadline:
+                if error is not None: raise error
+                return response
+            print(f"LLM gateway: {model} {'error ' + str(error) if error else 'status ' + str(response.status_code)}; retrying in {delay:.1f}s (attempt {attempt + 1}/{LLM_GATEWAY_MAX_RETRIES})")
+            with state['condition']:
+                state['stats']['retries'] += 1
+            if telemetry is not None: telemetry['retries'] += 1
+            time.sleep(delay)
+    finally:
+        if circuit: record_circuit_result(circuit, outcome, time.monotonic() - started)
+        release_llm_capacity(model, reserved, _usage_tokens(response) if response is not None and response.ok else None)
+
+
+def get_llm_gateway_stats():
+    """Returns per-model limiter configuration and counters."""
+    with _llm_gateway_states_lock:
+        states = dict(_llm_gateway_states)
+    snapshot = {}
+    for model, state in states.items():
+        with state['condition']:
+            _refill_llm_tokens(state)
+            stats = dict(state['stats'])
+            stats['avgQueueWaitMs'] = round(stats.pop('queueWaitSeconds') * 1000 / stats['requests'], 1) if stats['requests'] else 0.0
+            snapshot[model] = dict(stats, limits=dict(state['limits']), tokensAvailable=int(state['tokens']))
+    return snapshot
+
+
+async def call_claude_api_async(*args, **kwargs):
+    """asyncio entry point for call_claude_api; runs it in a worker thread so the gateway limits still apply."""
+    return await asyncio.to_thread(call_claude_api, *args, **kwargs)
+
+
+async def call_openai_api_async(*args, **kwargs):
+    """asyncio entry point for call_openai_api; runs it in a worker thread so the gateway limits still apply."""
+    return await asyncio.to_thread(call_openai_api, *args, **kwargs)
+
+
 # === Existing Helper Functions (Keep implementations as they were) ===
 
 def extract_text_from_pdf(file_path):
@@ -255,8 +826,51 @@ def extract_text_from_pdf(file_path):
         traceback.print_exc()
         raise Exception(f"Failed to extract text from PDF source: {e}") from e
 
-def call_claude_api(messages, system_prompt, model=CLAUDE_MODEL, temperature=0.7, max_tokens=4096, current_time_str=None):
-    """Calls the Claude API with specified parameters, optionally injecting current time."""
+def post_claude_messages(payload, headers, deadline=None, telemetry=None):
+    """
+    Posts a Messages API request through the LLM gateway. While the reply stops on max_tokens (and no tools are in use), it is
+    continued by sending the partial text back as an assistant prefill, up to LLM_CONTINUATION_MAX_ROUNDS.
+    Usage, continuations and truncation are added to `telemetry` if given.
+    Returns (response_data of the last request, stitched text of all text blocks).
+    """
+    messages = payload["messages"]
+    # A trailing assistant message is a caller prefill; the API does not echo it back
+    prefill = messages[-1]["content"] if messages[-1].get("role") == "assistant" and isinstance(messages[-1].get("content"), str) else ""
+    base_messages = messages[:-1] if prefill else messages
+    request_payload = payload
+    text = ""
+    for round_num in range(LLM_CONTINUATION_MAX_ROUNDS + 1):
+        response = llm_gateway_post(payload["model"], "https://api.anthropic.com/v1/messages", headers, request_payload,
+                                    timeout=90, deadline=deadline, circuit='anthropic', telemetry=telemetry)
+        print(f"Claude API response status: {response.status_code}{f' (continuation {round_num})' if round_num else ''}")
+        response.raise_for_status()
+        response_data = response.json()
+        add_llm_usage(telemetry, response_data.get("usage"))
+        text += "".join([block.get("text", "") for block in response_data.get("content", []) if block.get("type") == "text"])
+
+        if response_data.get("stop_reason") != "max_tokens" or payload.get("tools") or round_num == LLM_CONTINUATION_MAX_ROUNDS:
+            if response_data.get("stop_reason") == "max_tokens" and not payload.get("tools"):
+                print(f"Warning: Claude reply still truncated after {round_num} continuation(s) ({len(text)} chars).")
+                if telemetry is not None: telemetry['truncated'] = True
+            return response_data, text
+        # The API rejects a final assistant turn ending in whitespace
+        partial = (prefill + text).rstrip()
+        if not partial:
+            return response_data, text
+        text = partial[len(prefill):]
+        print(f"Claude reply hit max_tokens at {len(text)} chars; requesting continuation {round_num + 1}/{LLM_CONTINUATION_MAX_ROUNDS}.")
+        request_payload = dict(payload, messages=base_messages + [{"role": "assistant", "content": partial}])
+        if telemetry is not None: telemetry['continuations'] += 1
+
+
+def call_claude_api(messages, system_prompt, model=CLAUDE_MODEL, temperature=0.7, max_tokens=4096, current_time_str=None, response_schema=None, deadline=None, feature=None):
+    """
+    Calls the Claude API with specified parameters, optionally injecting current time.
+    `feature` tags the call's token/latency telemetry (see LLM Telemetry).
+    Requests go through the LLM gateway; `deadline` (time.monotonic() based) bounds queueing and retries.
+    If response_schema names an entry in RESPONSE_SCHEMAS, Claude is forced to answer through a tool
+    with that input schema and the parsed tool input (a dict) is returned instead of text.
+    """
     if not CLAUDE_API_KEY: raise ValueError("Claude API Key is not configured.")
     
     # Filter out system messages if they exist in the messages list
@@ -284,26 +898,51 @@ def call_claude_api(messages, system_prompt, model=CLAUDE_MODEL, temperature=0.7
         "system": final_system_prompt, # Use the potentially modified prompt
         "temperature": temperature
     }
+    if response_schema:
+        tool_name = f"record_{response_schema}"
+        payload["tools"] = [{
+            "name": tool_name,
+            "description": f"Record the {response_schema.replace('_', ' ')} as structured data.",
+            "input_schema": _RESPONSE_JSON_SCHEMAS[response_schema]
+        }]
+        payload["tool_choice"] = {"type": "tool", "name": tool_name}
     headers = {
         "Content-Type": "application/json",
         "anthropic-version": "2023-06-01",
         "x-api-key": CLAUDE_API_KEY
     }
+    telemetry = new_llm_call_telemetry('anthropic', model, feature)
+    telemetry['estimatedInputTokens'] = estimate_payload_tokens(payload, model, calibrated=False)
+    succeeded = False
     try:
-        response = requests.post("https://api.anthropic.com/v1/messages", headers=headers, json=payload, timeout=90)
-        print(f"Claude API response status: {response.status_code}")
-        response.raise_for_status()
-        response_data = response.json()
+        response_data, claude_response_text = post_claude_messages(payload, headers, deadline, telemetry)
         content_blocks = response_data.get("content", [])
         if not content_blocks: raise Exception(f"Claude API response missing 'content'. Data: {response_data}")
 
-        claude_response_text = "".join([block.get("text", "") for block in content_blocks if block.get("type") == "text"])
+        if response_schema:
+            tool_input = next((block.get("input") for block in content_blocks if block.get("type") == "tool_use"), None)
+            if response_data.get("stop_reason") == "max_tokens":
+                # A cut-off tool call cannot be resumed, so continue as prefilled JSON text instead
+                print(f"Claude structured output for '{response_schema}' hit max_tokens ({max_tokens}); continuing as JSON text.")
+                text_payload = {key: value for key, value in payload.items() if key not in ("tools", "tool_choice")}
+                text_payload["messages"] = user_assistant_messages + [{"role": "assistant", "content": "{"}]
+                _, claude_response_text = post_claude_messages(text_payload, headers, deadline, telemetry)
+                claude_response_text = "{" + claude_response_text
+            elif isinstance(tool_input, dict) and tool_input:
+                succeeded = True
+                return tool_input
+            # No usable tool call; extract JSON from the text the model wrote
+            parsed, repairs = extract_json_from_llm_response(claude_response_text)
+            print(f"Parsed text JSON for '{response_schema}' (repairs: {repairs or 'none'}).")
+            succeeded = True
+            return parsed
 
         # Check if the response text is empty or only whitespace
         if not claude_response_text.strip():
             print(f"Warning: Claude API returned empty text content. Blocks: {content_blocks}")
             return "[IRIS encountered an issue generating a response. Please try again.]"
 
+        succeeded = True
         return claude_response_text
     except requests.exceptions.RequestException as e:
         error_msg = f"Claude API request error ({model}): {e}"
@@ -314,30 +953,89 @@ def call_claude_api(messages, system_prompt, model=CLAUDE_MODEL, temperature=0.7
         error_msg = f"Claude API error ({model}): {e}"
         print(error_msg)
         raise Exception(error_msg) from e
+    finally:
+        record_llm_call(telemetry, succeeded)
+
+def strip_repeated_overlap(previous_text, continuation, min_overlap=20, max_overlap=300):
+    """Drops a re-opened code fence and any prefix of the continuation that repeats the tail of the previous text."""
+    if continuation.startswith("```"):
+        continuation = continuation.split("\n", 1)[-1]
+    for size in range(min(max_overlap, len(previous_text), len(continuation)), min_overlap - 1, -1):
+        if previous_text.endswith(continuation[:size]):
+            return continuation[size:]
+    return continuation
+
 
-def call_openai_api(prompt, model=OPENAI_MODEL, temperature=0.4):
+def call_openai_api(prompt, model=OPENAI_MODEL, temperature=0.4, response_schema=None, deadline=None, messages=None, max_tokens=5000, feature=None):
+    """
+    Calls the OpenAI chat completions API through the LLM gateway and returns the message text.
+    `feature` tags the call's token/latency telemetry (see LLM Telemetry).
+    `prompt` is sent as the system message ahead of `messages` when a conversation is given, else as the user message.
+    If response_schema names an entry in RESPONSE_SCHEMAS, a JSON schema response_format is requested
+    and the parsed object (a dict) is returned instead; ValueError is raised if it cannot be parsed.
+    """
     if not OPENAI_API_KEY: raise ValueError("OpenAI API Key not configured.")
     
     payload = {
         "model": model,
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": [{"role": "system", "content": prompt}] + list(messages) if messages else [{"role": "user", "content": prompt}],
         "temperature": temperature,
-        "max_tokens": 5000
+        "max_tokens": max_tokens
     }
+    if response_schema:
+        # Non-strict: strict mode would reject the optional fields and pass-through keys the schemas allow
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": response_schema, "schema": _RESPONSE_JSON_SCHEMAS[response_schema], "strict": False}
+        }
     
-    try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
+    def post_completion(body):
+        response = llm_gateway_post(
+            model, OPENAI_COMPLETIONS_URL,
+            {
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {OPENAI_API_KEY}"
             },
-            json=payload,
-            timeout=120  # Increased timeout
+            body,
+            timeout=120,  # Increased timeout
+            deadline=deadline,
+            circuit='openai',
+            telemetry=telemetry
         )
         response.raise_for_status()
         data = response.json()
-        return data["choices"][0]["message"]["content"]
+        add_llm_usage(telemetry, data.get("usage"))
+        return data["choices"][0]
+
+    telemetry = new_llm_call_telemetry('openai', model, feature)
+    telemetry['estimatedInputTokens'] = estimate_payload_tokens(payload, model, calibrated=False)
+    succeeded = False
+    try:
+        choice = post_completion(payload)
+        content = choice["message"]["content"] or ""
+        # Continue replies cut off by max_tokens; continuations drop response_format so the model
+        # resumes the partial text instead of starting a new JSON object
+        for round_num in range(1, LLM_CONTINUATION_MAX_ROUNDS + 1):
+            if choice.get("finish_reason") != "length": break
+            print(f"OpenAI reply hit max_tokens at {len(content)} chars; requesting continuation {round_num}/{LLM_CONTINUATION_MAX_ROUNDS}.")
+            continuation_payload = {key: value for key, value in payload.items() if key != "response_format"}
+            continuation_payload["messages"] = payload["messages"] + [
+                {"role": "assistant", "content": content},
+                {"role": "user", "content": OPENAI_CONTINUATION_PROMPT}
+            ]
+            choice = post_completion(continuation_payload)
+            telemetry['continuations'] += 1
+            content += strip_repeated_overlap(content, choice["message"]["content"] or "")
+        if choice.get("finish_reason") == "length":
+            print(f"Warning: OpenAI reply still truncated after continuations ({len(content)} chars).")
+            telemetry['truncated'] = True
+        if not response_schema:
+            succeeded = True
+            return content
+        parsed, repairs = extract_json_from_llm_response(content or "")
+        if repairs: print(f"Repaired OpenAI structured output for '{response_schema}': {'; '.join(repairs)}")
+        succeeded = True # only once the structured output parsed, as in call_claude_api
+        return parsed
     except requests.exceptions.RequestException as e:
         print(f"OpenAI API request error: {e}")
         if hasattr(e, 'response') and e.response is not None: 
@@ -346,6 +1044,8 @@ def call_openai_api(prompt, model=OPENAI_MODEL, temperature=0.4):
     except Exception as e:
         print(f"OpenAI API Error: {e}")
         raise
+    finally:
+        record_llm_call(telemetry, succeeded)
 
 def generate_speech_polly(text, voice_id="Kajal", region_name=None):
     """Generates speech using AWS Polly."""
@@ -379,13 +1079,13 @@ def generate_speech_polly(text, voice_id="Kajal", region_name=None):
         traceback.print_exc()
         raise # Re-raise other exceptions
 
-def generate_speech(text):
-    """Generates speech from text, trying Polly then falling back to OpenAI."""
+def synthesize_speech_cloud(text):
+    """Generates MP3 speech from text, trying Polly then falling back to OpenAI."""
     # --- Attempt 1: AWS Polly (Kajal) ---
     if AWS_DEFAULT_REGION: # Only attempt if region is set
         try:
             print("Attempting AWS Polly TTS...")
-            return generate_speech_polly(text, voice_id="Kajal", region_name=AWS_DEFAULT_REGION)
+            return call_with_circuit('polly', generate_speech_polly, text, voice_id="Kajal", region_name=AWS_DEFAULT_REGION)
         except Exception as polly_e:
             print(f"AWS Polly TTS failed, falling back to OpenAI TTS. Error: {polly_e}")
     else:
@@ -395,13 +1095,17 @@ def generate_speech(text):
     if not OPENAI_API_KEY: raise ValueError("Neither AWS Polly nor OpenAI TTS is configured/working.")
     print("Using fallback OpenAI TTS with 'nova' voice.")
     payload = {"model": "tts-1", "voice": "nova", "input": text, "response_format": "mp3"}
-    try:
+    def post_tts():
         response = requests.post(
             OPENAI_TTS_URL,
             headers={"Content-Type": "application/json", "Authorization": f"Bearer {OPENAI_API_KEY}"},
             json=payload, timeout=30
         )
         response.raise_for_status()
+        return response
+
+    try:
+        response = call_with_circuit('openai_tts', post_tts)
         print(f"OpenAI TTS fallback successful, generated {len(response.content)} bytes.")
         return response.content
     except requests.exceptions.RequestException as e:
@@ -412,17 +1116,41 @@ def generate_speech(text):
         print(f"Unexpected OpenAI TTS API error (fallback): {e}")
         raise Exception(f"Unexpected OpenAI TTS fallback error: {e}") from e
 
-def transcribe_audio(audio_file_bytes, filename='audio.webm'):
-    """Transcribes audio using OpenAI Whisper."""
+def transcribe_audio_whisper(audio_file_bytes, filename='audio.webm', prompt=None):
+    """
+    Transcribes audio using OpenAI Whisper. `audio_file_bytes` may also be a readable file object (e.g. an upload
+    stream); the audio is compressed first where possible (see Audio Preprocessing).
+    `prompt` is preceding transcript text Whisper should continue from.
+    """
     if not OPENAI_API_KEY: raise ValueError("OpenAI API Key not configured.")
     try:
-        files = {"file": (filename, audio_file_bytes)}
+        processed, original = preprocess_audio_for_transcription(audio_file_bytes)
+        if processed is not None:
+            upload, upload_name = processed, os.path.splitext(filename or 'audio')[0] + '.ogg'
+        else:
+            upload, upload_name = original, filename
+        if isinstance(upload, (bytes, bytearray)):
+            upload_size = len(upload)
+        else:
+            upload.seek(0, os.SEEK_END)
+            upload_size = upload.tell()
+        files = {"file": (upload_name, upload)}
         data = {"model": "whisper-1"}
-        response = requests.post(
-            OPENAI_STT_URL, headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-            files=files, data=data, timeout=60
-        )
-        response.raise_for_status()
+        if prompt: data["prompt"] = prompt
+        def post_transcription():
+            if hasattr(upload, 'seek'): upload.seek(0)
+            response = requests.post(
+                OPENAI_STT_URL, headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                files=files, data=data, timeout=60
+            )
+            response.raise_for_status()
+            return response
+        started = time.monotonic()
+        try:
+            response = call_with_circuit('whisper', post_transcription)
+        finally:
+            if hasattr(original, 'close'): original.close()
+        record_whisper_latency(processed is not None, upload_size, time.monotonic() - started)
         data = response.json()
         return data.get("text", "")
     except requests.exceptions.RequestException as e:
@@ -433,13 +1161,1311 @@ def transcribe_audio(audio_file_bytes, filename='audio.webm'):
         raise Exception(f"OpenAI STT API error: {e}") from e
 
 
+# === Speech Backends ===
+# generate_speech() and transcribe_audio() dispatch to the backend named by SPEECH_BACKEND:
+#   'cloud' - Polly with OpenAI TTS fallback, and Whisper (the production path)
+#   'local' - no network: deterministic silent WAV of proportional length (the text is embedded in an INFO chunk),
+#             and echo transcription (local WAVs give back their text, UTF-8 uploads their content), each after
+#             SPEECH_LOCAL_LATENCY_SECONDS, so load tests can run the full voice loop offline.
+
+SPEECH_BACKEND = os.environ.get('SPEECH_BACKEND', 'cloud').lower()
+SPEECH_LOCAL_LATENCY_SECONDS = float(os.environ.get('SPEECH_LOCAL_LATENCY_SECONDS', 0))
+SPEECH_LOCAL_SECONDS_PER_CHAR = 0.06 # ~ natural speaking rate
+SPEECH_LOCAL_SAMPLE_RATE = 8000
+
+
+def _riff_chunk(chunk_id, payload):
+    return chunk_id + struct.pack('<I', len(payload)) + payload + (b'\0' if len(payload) % 2 else b'')
+
+
+def synthesize_speech_local(text):
+    """Returns a silent 8 kHz mono 16-bit WAV lasting ~SPEECH_LOCAL_SECONDS_PER_CHAR per character, with `text` embedded."""
+    if SPEECH_LOCAL_LATENCY_SECONDS: time.sleep(SPEECH_LOCAL_LATENCY_SECONDS)
+    samples = max(1, int(len(text) * SPEECH_LOCAL_SECONDS_PER_CHAR * SPEECH_LOCAL_SAMPLE_RATE))
+    fmt = struct.pack('<HHIIHH', 1, 1, SPEECH_LOCAL_SAMPLE_RATE, SPEECH_LOCAL_SAMPLE_RATE * 2, 2, 16)
+    info = b'INFO' + _riff_chunk(b'ICMT', text.encode('utf-8'))
+    body = b'WAVE' + _riff_chunk(b'fmt ', fmt) + _riff_chunk(b'LIST', info) + _riff_chunk(b'data', bytes(samples * 2))
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def transcribe_audio_local(audio_file_bytes, filename='audio.webm', prompt=None):
+    """Echo transcription: the text embedded by synthesize_speech_local, else the upload decoded as UTF-8 text."""
+    if SPEECH_LOCAL_LATENCY_SECONDS: time.sleep(SPEECH_LOCAL_LATENCY_SECONDS)
+    audio = audio_file_bytes if isinstance(audio_file_bytes, (bytes, bytearray)) else audio_file_bytes.read()
+    if audio[:4] == b'RIFF' and audio[8:12] == b'WAVE':
+        position = 12
+        while position + 8 <= len(audio):
+            chunk_id, size = audio[position:position + 4], struct.unpack('<I', audio[position + 4:position + 8])[0]
+            if chunk_id == b'LIST' and audio[position + 8:position + 12] == b'INFO' and audio[position + 12:position + 16] == b'ICMT':
+                comment_size = struct.unpack('<I', audio[position + 16:position + 20])[0]
+                return audio[position + 20:position + 20 + comment_size].decode('utf-8', 'replace')
+            position += 8 + size + (size % 2)
+        return ""
+    try:
+        return audio.decode('utf-8').strip()
+    except UnicodeDecodeError:
+        return f"[local transcription of {len(audio)} bytes]"
+
+
+SPEECH_BACKENDS = MappingProxyType({
+    'cloud': MappingProxyType({'synthesize': synthesize_speech_cloud, 'transcribe': transcribe_audio_whisper, 'audioFormat': 'mp3'}),
+    'local': MappingProxyType({'synthesize': synthesize_speech_local, 'transcribe': transcribe_audio_local, 'audioFormat': 'wav'})
+})
+if SPEECH_BACKEND not in SPEECH_BACKENDS:
+    print(f"WARNING: Unknown SPEECH_BACKEND '{SPEECH_BACKEND}', using 'cloud'.")
+    SPEECH_BACKEND = 'cloud'
+
+
+def generate_speech(text):
+    """Generates speech audio (see speech_audio_format()) for `text` with the configured speech backend."""
+    return SPEECH_BACKENDS[SPEECH_BACKEND]['synthesize'](text)
+
+
+def transcribe_audio(audio_file_bytes, filename='audio.webm', prompt=None):
+    """Transcribes audio bytes or a readable file object with the configured speech backend."""
+    return SPEECH_BACKENDS[SPEECH_BACKEND]['transcribe'](audio_file_bytes, filename, prompt=prompt)
+
+
+def speech_audio_format():
+    """Container format of generate_speech() output ('mp3' or 'wav')."""
+    return SPEECH_BACKENDS[SPEECH_BACKEND]['audioFormat']
+
+
+# === Audio Preprocessing ===
+# Uploads are piped through ffmpeg before Whisper: leading and trailing silence is trimmed (pauses inside the answer
+# are kept, since Whisper uses them for punctuation and sentence breaks), audio is downmixed to 16 kHz mono and
+# re-encoded as Opus/Ogg, and capped at AUDIO_MAX_DURATION_SECONDS.
+# The upload is streamed into ffmpeg in chunks, with a spooled copy kept so the original can still be sent
+# if ffmpeg is missing or rejects the input (e.g. an MP4 whose index is at the end of the file).
+
+AUDIO_PREPROCESSING_ENABLED = os.environ.get('AUDIO_PREPROCESSING_ENABLED', 'true').lower() == 'true'
+AUDIO_MAX_DURATION_SECONDS = int(os.environ.get('AUDIO_MAX_DURATION_SECONDS', 300))
+AUDIO_SILENCE_THRESHOLD = '-45dB'
+AUDIO_OPUS_BITRATE = '24k'
+AUDIO_PREPROCESS_TIMEOUT_SECONDS = 30
+AUDIO_STREAM_CHUNK_BYTES = 64 * 1024
+FFMPEG_PATH = shutil.which(os.environ.get('FFMPEG_BINARY', 'ffmpeg'))
+_audio_stats = {'uploads': 0, 'preprocessed': 0, 'fallbacks': 0, 'inputBytes': 0, 'uploadedBytes': 0,
+                'whisper': {'preprocessed': {'calls': 0, 'seconds': 0.0}, 'original': {'calls': 0, 'seconds': 0.0}}}
+_audio_stats_lock = threading.Lock()
+
+
+def _ffmpeg_transcription_args():
+    # Trailing silence is trimmed as leading silence of the reversed audio; atrim bounds what areverse buffers
+    silence_filter = (f"silenceremove=start_periods=1:start_threshold={AUDIO_SILENCE_THRESHOLD}:start_silence=0.2,"
+                      f"atrim=end={AUDIO_MAX_DURATION_SECONDS},areverse,"
+                      f"silenceremove=start_periods=1:start_threshold={AUDIO_SILENCE_THRESHOLD}:start_silence=0.5,areverse")
+    return [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', '-vn', '-af', silence_filter,
+            '-t', str(AUDIO_MAX_DURATION_SECONDS), '-ac', '1', '-ar', '16000',
+            '-c:a', 'libopus', '-b:a', AUDIO_OPUS_BITRATE, '-application', 'voip', '-f', 'ogg', 'pipe:1']
+
+
+def preprocess_audio_for_transcription(audio_source):
+    """
+    Streams `audio_source` (bytes or a readable file object) through ffmpeg.
+    Returns (processed_bytes or None, original) where `original` is bytes or a rewound spooled file holding the input,
+    for the caller to send instead when processing was skipped or failed.
+    """
+    if isinstance(audio_source, (bytes, bytearray)):
+        reader, original = BytesIO(audio_source), audio_source
+    else:
+        reader, original = audio_source, tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    try:
+        if not (AUDIO_PREPROCESSING_ENABLED and FFMPEG_PATH):
+            if original is not audio_source:
+                shutil.copyfileobj(reader, original, AUDIO_STREAM_CHUNK_BYTES)
+                original.seek(0)
+            return None, original
+
+        stderr_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(_ffmpeg_transcription_args(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file)
+
+        def feed_ffmpeg():
+            try:
+                while True:
+                    chunk = reader.read(AUDIO_STREAM_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    if original is not audio_source:
+                        original.write(chunk)
+                    process.stdin.write(chunk)
+            except (BrokenPipeError, ValueError): # ffmpeg exited early (bad input or duration cap reached)
+                if original is not audio_source: # keep the spooled copy complete for the fallback
+                    shutil.copyfileobj(reader, original, AUDIO_STREAM_CHUNK_BYTES)
+            finally:
+                try:
+                    process.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+
+        feeder = threading.Thread(target=feed_ffmpeg, daemon=True)
+        killer = threading.Timer(AUDIO_PREPROCESS_TIMEOUT_SECONDS, process.kill)
+        feeder.start()
+        killer.start()
+        try:
+            processed = process.stdout.read()
+            return_code = process.wait()
+        finally:
+            killer.cancel()
+            feeder.join()
+        input_bytes = len(original) if original is audio_source else original.tell()
+        if original is not audio_source:
+            original.seek(0)
+        with _audio_stats_lock:
+            _audio_stats['uploads'] += 1
+            _audio_stats['inputBytes'] += input_bytes
+        if return_code != 0 or not processed:
+            stderr_file.seek(0)
+            print(f"Audio preprocessing failed (exit {return_code}), sending original upload: {stderr_file.read()[-500:].decode('utf-8', 'replace')}")
+            stderr_file.close()
+            with _audio_stats_lock:
+                _audio_stats['fallbacks'] += 1
+            return None, original
+        stderr_file.close()
+        with _audio_stats_lock:
+            _audio_stats['preprocessed'] += 1
+        print(f"Audio preprocessed for transcription: {input_bytes} -> {len(processed)} bytes.")
+        return processed, original
+    except BaseException:
+        if original is not audio_source: # the caller never receives the spooled copy, so release it here
+            original.close()
+        raise
+
+
+def record_whisper_latency(preprocessed, uploaded_bytes, seconds):
+    with _audio_stats_lock:
+        bucket = _audio_stats['whisper']['preprocessed' if preprocessed else 'original']
+        bucket['calls'] += 1
+        bucket['seconds'] += seconds
+        _audio_stats['uploadedBytes'] += uploaded_bytes
+
+
+def get_audio_preprocessing_stats():
+    """Returns upload/compression byte totals and average Whisper latency with and without preprocessing."""
+    with _audio_stats_lock:
+        stats = copy.deepcopy(_audio_stats)
+    for bucket in stats['whisper'].values():
+        bucket['avgSeconds'] = round(bucket['seconds'] / bucket['calls'], 3) if bucket['calls'] else None
+        bucket['seconds'] = round(bucket['seconds'], 3)
+    stats['ffmpegAvailable'] = bool(FFMPEG_PATH)
+    stats['enabled'] = AUDIO_PREPROCESSING_ENABLED
+    return stats
+
+
+# === Streaming Transcription ===
+# While recording, the browser posts short self-contained audio chunks (each starting ~1s before the previous one
+# ended) to /transcribe-chunk. Chunks are transcribed as they arrive, in parallel, and merged into a running
+# transcript per interview in sequence order; the overlap is removed by matching the repeated words at the seam.
+# The tail of the transcript so far is passed to Whisper as the prompt to keep wording consistent across chunks.
+# With SPEECH_BACKEND=local the chunk flow runs offline (chunks are echo-transcribed).
+# Every chunk carries a client-generated answerId. Finished answers leave a tombstone so a late chunk of a previous
+# answer is dropped instead of starting (or polluting) a running transcript.
+# The web client finishes an answer with a final chunk and sends the merged transcript to /interview-turn; if the
+# chunk flow fails it sends the full recording there instead.
+# Running transcripts live in this process's memory: deployments with more than one worker must route
+# /transcribe-chunk requests for the same interviewId to the same worker (sticky routing), or run a single worker.
+
+TRANSCRIPT_OVERLAP_MAX_WORDS = 15
+TRANSCRIPT_PROMPT_CHARS = 200
+TRANSCRIPT_STATE_TTL_SECONDS = 600
+TRANSCRIPT_FINAL_WAIT_SECONDS = float(os.environ.get('TRANSCRIPT_FINAL_WAIT_SECONDS', 10))
+TRANSCRIPT_MISSING_CHUNK_GRACE_SECONDS = float(os.environ.get('TRANSCRIPT_MISSING_CHUNK_GRACE_SECONDS', 2))
+_running_transcripts = {} # interview id -> {'answerId', 'text', 'applied', 'pending', 'inFlight', 'updatedAt'}
+_finished_answers = {} # (interview id, answer id) -> time.monotonic() the answer finished or was superseded
+_transcript_condition = threading.Condition()
+_WORD_NORMALIZE = re.compile(r"[^\w']+")
+
+
+def merge_transcript_overlap(previous_text, chunk_text, max_overlap_words=TRANSCRIPT_OVERLAP_MAX_WORDS):
+    """Appends `chunk_text` to `previous_text`, dropping its leading words that repeat the end of `previous_text`."""
+    previous_words, chunk_words = previous_text.split(), chunk_text.split()
+    if not previous_words:
+        return chunk_text.strip()
+    normalize = lambda word: _WORD_NORMALIZE.sub('', word.lower())
+    tail = [normalize(word) for word in previous_words[-max_overlap_words:]]
+    head = [normalize(word) for word in chunk_words[:max_overlap_words]]
+    for size in range(min(len(tail), len(head)), 0, -1):
+        # A single matching word only counts if it is unlikely to repeat by chance
+        if tail[-size:] == head[:size] and (size > 1 or len(head[0]) >= 5):
+            chunk_words = chunk_words[size:]
+            break
+    return " ".join(previous_words + chunk_words)
+
+
+def add_transcript_chunk(interview_id, answer_id, sequence, audio_bytes, filename, final=False):
+    """
+    Transcribes chunk `sequence` of answer `answer_id` and merges every contiguous transcribed chunk into the running
+    transcript. A new answer id supersedes the running answer; chunks of finished or superseded answers are dropped.
+    For the final chunk, waits (at most TRANSCRIPT_FINAL_WAIT_SECONDS) while earlier chunks are still being transcribed,
+    and up to TRANSCRIPT_MISSING_CHUNK_GRACE_SECONDS for earlier chunks that have not arrived; then every transcribed
+    chunk is merged in sequence order, skipping gaps.
+    Returns {'transcript', 'appliedThrough', 'final', 'dropped'}.
+    """
+    now = time.monotonic()
+    with _transcript_condition:
+        for key in [key for key, s in _running_transcripts.items() if now - s['updatedAt'] > TRANSCRIPT_STATE_TTL_SECONDS]:
+            del _running_transcripts[key]
+        for key in [key for key, finished_at in _finished_answers.items() if now - finished_at > TRANSCRIPT_STATE_TTL_SECONDS]:
+            del _finished_answers[key]
+        if (interview_id, answer_id) in _finished_answers:
+            print(f"[{interview_id}] Dropped late chunk {sequence} of finished answer {answer_id}.")
+            return {'transcript': "", 'appliedThrough': -1, 'final': final, 'dropped': True}
+        state = _running_transcripts.get(interview_id)
+        if state is None or state['answerId'] != answer_id:
+            if state is not None:
+                _finished_answers[(interview_id, state['answerId'])] = now
+            state = {'answerId': answer_id, 'text': "", 'applied': -1, 'pending': {}, 'inFlight': set(), 'updatedAt': now}
+            _running_transcripts[interview_id] = state
+        state['inFlight'].add(sequence)
+        prompt = state['text'][-TRANSCRIPT_PROMPT_CHARS:] or None
+
+    try:
+        chunk_text = transcribe_audio(audio_bytes, filename, prompt=prompt)
+    except Exception as e:
+        print(f"[{interview_id}] Chunk {sequence} transcription failed, continuing without it: {e}")
+        chunk_text = ""
+
+    with _transcript_condition:
+        state['inFlight'].discard(sequence)
+        _transcript_condition.notify_all()
+        if _running_transcripts.get(interview_id) is not state: # superseded by a newer answer meanwhile
+            return {'transcript': "", 'appliedThrough': -1, 'final': final, 'dropped': True}
+        state['pending'][sequence] = chunk_text
+        while state['applied'] + 1 in state['pending']:
+            state['applied'] += 1
+            state['text'] = merge_transcript_overlap(state['text'], state['pending'].pop(state['applied']))
+        state['updatedAt'] = time.monotonic()
+        if final:
+            final_at = time.monotonic()
+            deadline = final_at + TRANSCRIPT_FINAL_WAIT_SECONDS
+            grace_end = min(deadline, final_at + TRANSCRIPT_MISSING_CHUNK_GRACE_SECONDS)
+            while state['applied'] < sequence:
+                now = time.monotonic()
+                wait_until = deadline if state['inFlight'] else grace_end
+                if now >= wait_until:
+                    break
+                _transcript_condition.wait(timeout=wait_until - now)
+            if state['applied'] < sequence:
+                missing = [seq for seq in range(state['applied'] + 1, sequence) if seq not in state['pending']]
+                print(f"[{interview_id}] Final transcript merged without chunks {missing}.")
+                for pending_sequence in sorted(state['pending']):
+                    state['text'] = merge_transcript_overlap(state['text'], state['pending'].pop(pending_sequence))
+                    state['applied'] = max(state['applied'], pending_sequence)
+            if _running_transcripts.get(interview_id) is state:
+                del _running_transcripts[interview_id]
+            _finished_answers[(interview_id, answer_id)] = time.monotonic()
+        return {'transcript': state['text'], 'appliedThrough': state['applied'], 'final': final, 'dropped': False}
+
+
+# === Interviewer Model Routing ===
+# Interviewer turns go to the first healthy route. If no good answer arrives within the primary model's
+# observed p95 latency, a hedged request is sent to the next route and the first good answer wins.
+# A circuit breaker per route ("provider:model") routes around a degraded model; the provider-level breakers
+# in the LLM gateway cover a provider that is down entirely.
+
+INTERVIEWER_MODEL_ROUTES = (('anthropic', CLAUDE_MODEL), ('anthropic', CLAUDE_HAIKU_MODEL), ('openai', OPENAI_MODEL))
+INTERVIEWER_TURN_TIMEOUT_SECONDS = float(os.environ.get('INTERVIEWER_TURN_TIMEOUT_SECONDS', 45))
+INTERVIEWER_HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get('INTERVIEWER_HEDGE_DEFAULT_DELAY_SECONDS', 8)) # Until enough samples
+INTERVIEWER_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('INTERVIEWER_HEDGE_MIN_DELAY_SECONDS', 1.5))
+INTERVIEWER_LATENCY_MIN_SAMPLES = 20
+INTERVIEWER_FALLBACK_RESPONSE = "[IRIS encountered an issue generating a response. Please try again.]"
+_interviewer_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('INTERVIEWER_HEDGE_MAX_WORKERS', 8)), thread_name_prefix="interviewer")
+_model_latency_samples = {} # model -> deque of recent successful call durations (seconds)
+_interviewer_routing_stats = {'turns': 0, 'hedgesSent': 0, 'failovers': 0, 'wins': {}, 'failures': 0}
+_routing_lock = threading.Lock()
+
+
+def model_latency_p95(model):
+    """p95 of recent successful call durations for a model, or None until enough samples exist."""
+    with _routing_lock:
+        samples = sorted(_model_latency_samples.get(model, ()))
+    if len(samples) < INTERVIEWER_LATENCY_MIN_SAMPLES:
+        return None
+    return samples[int(len(samples) * 0.95) - 1]
+
+
+def _call_interviewer_route(route, messages, system_prompt, temperature, current_time_str, deadline, usage_session=None, feature='interviewer_turn'):
+    """Runs one interviewer request on a route, recording latency and circuit outcome. Returns the reply text."""
+    provider, model = route
+    circuit_name = f"{provider}:{model}"
+    started = time.monotonic()
+    set_llm_usage_session(usage_session) # Executor thread: attribute token usage to the caller's session
+    try:
+        if provider == 'openai':
+            if current_time_str:
+                system_prompt = system_prompt.replace("[Current Time Context]", f"Current time is approximately {current_time_str}.")
+            reply = call_openai_api(system_prompt, model=model, temperature=temperature, deadline=deadline,
+                                    messages=[msg for msg in messages if msg.get("role") != "system"], max_tokens=1024,
+                                    feature=feature)
+        else:
+            reply = call_claude_api(messages=messages, system_prompt=system_prompt, model=model, temperature=temperature,
+                                    current_time_str=current_time_str, deadline=deadline, feature=feature)
+        if not reply or not reply.strip() or reply == INTERVIEWER_FALLBACK_RESPONSE:
+            raise ValueError(f"{model} returned an empty interviewer reply")
+    except Exception:
+        record_circuit_result(circuit_name, False, time.monotonic() - started)
+        raise
+    finally:
+        set_llm_usage_session(None)
+    record_circuit_result(circuit_name, True, time.monotonic() - started)
+    with _routing_lock:
+        _model_latency_samples.setdefault(model, deque(maxlen=200)).append(time.monotonic() - started)
+    return reply
+
+
+def healthy_interviewer_routes():
+    """INTERVIEWER_MODEL_ROUTES whose provider and model circuits are closed, falling back to the primary route."""
+    return [route for route in INTERVIEWER_MODEL_ROUTES
+            if not circuit_is_open(route[0]) and not circuit_is_open(f"{route[0]}:{route[1]}")] or [INTERVIEWER_MODEL_ROUTES[0]]
+
+
+def interviewer_hedge_delay(model):
+    """Seconds to wait on `model` before hedging: its observed p95 latency, bounded below by the minimum delay."""
+    return max(INTERVIEWER_HEDGE_MIN_DELAY_SECONDS, model_latency_p95(model) or INTERVIEWER_HEDGE_DEFAULT_DELAY_SECONDS)
+
+
+def generate_interviewer_reply(messages, system_prompt, temperature=0.3, current_time_str=None, usage_session=None, feature='interviewer_turn'):
+    """
+    Gets the interviewer's next reply with hedging and failover across INTERVIEWER_MODEL_ROUTES.
+    LLM usage is attributed to `usage_session` (e.g. the interview id) under the `feature` tag.
+    Raises Exception if no route produced a reply before INTERVIEWER_TURN_TIMEOUT_SECONDS.
+    """
+    routes = healthy_interviewer_routes()
+    started = time.monotonic()
+    deadline = started + INTERVIEWER_TURN_TIMEOUT_SECONDS
+    hedge_delay = interviewer_hedge_delay(routes[0][1])
+    with _routing_lock:
+        _interviewer_routing_stats['turns'] += 1
+
+    def submit(route):
+        return _interviewer_executor.submit(_call_interviewer_route, route, messages, system_prompt, temperature, current_time_str, deadline, usage_session, feature)
+
+    pending = {submit(routes[0]): routes[0]}
+    next_route = 1
+    last_error = None
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        wait_for = min(hedge_delay, remaining) if next_route < len(routes) else remaining
+        done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+        for future in done:
+            route = pending.pop(future)
+            try:
+                reply = future.result()
+            except Exception as e:
+                last_error = e
+                print(f"Interviewer route {route[1]} failed: {e}")
+                continue
+            for other in pending: other.cancel() # Queued requests are dropped; in-flight ones finish and are discarded
+            with _routing_lock:
+                _interviewer_routing_stats['wins'][route[1]] = _interviewer_routing_stats['wins'].get(route[1], 0) + 1
+            return reply
+        # No good answer yet: hedge after the delay, or fail over immediately if everything sent so far failed
+        if next_route < len(routes) and (not done or not pending):
+            with _routing_lock:
+                _interviewer_routing_stats['hedgesSent' if pending else 'failovers'] += 1
+            print(f"Interviewer {'hedging' if pending else 'failing over'} to {routes[next_route][1]} after {time.monotonic() - started:.1f}s")
+            pending[submit(routes[next_route])] = routes[next_route]
+            next_route += 1
+    for other in pending: other.cancel()
+    with _routing_lock:
+        _interviewer_routing_stats['failures'] += 1
+    raise Exception(f"No interviewer route produced a reply: {last_error or 'timed out'}")
+
+
+def get_interviewer_routing_stats():
+    """Returns hedging/failover counters and per-model p95 latency."""
+    with _routing_lock:
+        stats = copy.deepcopy(_interviewer_routing_stats)
+        models = list(_model_latency_samples)
+    p95 = {}
+    for model in models:
+        value = model_latency_p95(model)
+        p95[model] = round(value, 3) if value is not None else None
+    return dict(stats, p95LatencySeconds=p95)
+
+
+# === Interview Conversation Context ===
+# Long mock interviews send the interviewer only the last INTERVIEW_CONTEXT_RECENT_MESSAGES messages verbatim;
+# everything before them is folded into a rolling summary stored on the interview doc as `context_summary`
+# ({'text', 'coveredMessages', 'updatedAt'}). Summaries are produced on a background thread, so a turn never
+# waits on one: messages not yet covered by the cached summary are simply sent verbatim.
+# Question/turn counts are computed from the full conversation so the prompt's pacing rules still hold.
+
+INTERVIEW_CONTEXT_RECENT_MESSAGES = int(os.environ.get('INTERVIEW_CONTEXT_RECENT_MESSAGES', 12))
+INTERVIEW_CONTEXT_SUMMARY_BATCH = int(os.environ.get('INTERVIEW_CONTEXT_SUMMARY_BATCH', 6)) # min new messages per re-summary
+_context_summaries_in_flight = set()
+_context_summary_lock = threading.Lock()
+
+
+def count_interviewer_questions(conversation):
+    """Counts interviewer turns that ask a question (contain '?')."""
+    return sum(1 for msg in conversation if msg.get('role') == 'assistant' and '?' in (msg.get('content') or ''))
+
+
+def _summarize_interview_context(interview_id, previous_summary, messages, covered_messages):
+    """Background job: folds `messages` into `previous_summary` and caches the result on the interview."""
+    set_llm_usage_session(interview_id)
+    try:
+        transcript = "\n".join(f"{'Interviewer' if m['role'] == 'assistant' else 'Candidate'}: {m['content']}" for m in messages)
+        system_prompt = f"""
+You maintain running notes for an interviewer conducting a mock interview. Update the notes with the new exchanges.
+Keep, in under 250 words:
+- Every question the interviewer has asked, in order, grouped by phase (introduction, experience/projects, fundamentals, advanced/problem-solving, behavioral, closing), one short line each
+- Key facts and claims the candidate stated (projects, tools, numbers) and answers that were weak or skipped
+Do not add commentary or evaluate the candidate beyond that. Return only the updated notes.
+
+Current notes:
+{previous_summary or "(none yet)"}
+
+New exchanges:
+{truncate_to_token_budget(transcript, 6000, CLAUDE_HAIKU_MODEL)}
+"""
+        summary = call_claude_api(messages=[{"role": "user", "content": "Update the notes."}], system_prompt=system_prompt,
+                                  model=CLAUDE_HAIKU_MODEL, temperature=0.0, max_tokens=600, feature='interview_context_summary')
+        if summary.startswith("[IRIS encountered"):
+            return
+        update_interview_data(interview_id, {'context_summary': {
+            'text': summary.strip(), 'coveredMessages': covered_messages, 'updatedAt': datetime.now().isoformat()
+        }})
+        print(f"[{interview_id}] Interview context summary now covers {covered_messages} messages.")
+    except Exception as e:
+        print(f"[{interview_id}] Context summary failed (turns keep sending the uncovered messages verbatim): {e}")
+    finally:
+        set_llm_usage_session(None)
+        with _context_summary_lock:
+            _context_summaries_in_flight.discard(interview_id)
+
+
+def build_interview_context(interview_id, interview_data, conversation, system_prompt):
+    """
+    Returns (messages, system_prompt) for the next interviewer turn: the cached summary plus question/turn counts are
+    appended to the system prompt and only messages after the summary are sent. Schedules a summary refresh when
+    enough messages have fallen out of the recent window.
+    """
+    summary = interview_data.get('context_summary') or {}
+    covered = summary.get('coveredMessages', 0) if summary.get('text') else 0
+    if covered > len(conversation): # conversation was reset/replaced under the summary
+        covered = 0
+    window_start = max(0, len(conversation) - INTERVIEW_CONTEXT_RECENT_MESSAGES)
+
+    if window_start - covered >= INTERVIEW_CONTEXT_SUMMARY_BATCH:
+        with _context_summary_lock:
+            start_job = interview_id not in _context_summaries_in_flight
+            if start_job:
+                _context_summaries_in_flight.add(interview_id)
+        if start_job:
+            threading.Thread(target=_summarize_interview_context, daemon=True,
+                             args=(interview_id, summary.get('text') if covered else None,
+                                   conversation[covered:window_start], window_start)).start()
+
+    if not covered:
+        return conversation, system_prompt
+    start = min(covered, len(conversation) - 1) # the summary can cover every message (e.g. no recent window)
+    while start > 0 and conversation[start].get('role') != 'user': # the API expects the first message from the user
+        start -= 1
+    context_note = f"""
+
+[Interview So Far]
+Earlier turns are summarized below; the most recent turns follow as messages.
+{summary['text']}
+Questions you have asked so far: {count_interviewer_questions(conversation)}. Conversation turns so far: {len(conversation)}.
+Apply the question counts, mandatory flow and pacing rules above to the WHOLE interview, including the summarized part; do not repeat a question already asked."""
+    print(f"[{interview_id}] Interviewer context: summary of {covered} messages + {len(conversation) - start} verbatim.")
+    return conversation[start:], system_prompt + context_note
+
+
+def prepare_interviewer_turn(interview_id, interview_data, conversation):
+    """Returns (api_messages, system_prompt) for the next interviewer reply from the stored interview snapshots."""
+    system_prompt = create_mock_interviewer_prompt(interview_data.get('resume_data_snapshot', {}),
+                                                   interview_data.get('job_data_snapshot', {}),
+                                                   interview_data.get('interviewType', 'general'))
+    # Firestore history may hold other roles; the APIs only take user/assistant turns
+    api_conversation = [{'role': msg.get('role'), 'content': msg.get('content', '')}
+                        for msg in conversation if msg.get('role') in ('user', 'assistant')]
+    return build_interview_context(interview_id, interview_data, api_conversation, system_prompt)
+
+
+# === Speculative Interviewer Drafts ===
+# Optional (INTERVIEWER_SPECULATIVE_DRAFTS=true). While the candidate is still answering, the client posts partial
+# transcripts to /interview-partial-transcript and a draft interviewer reply is generated in the background against
+# the conversation plus the partial answer. /interview-response reuses the draft when the final answer is at least
+# SPECULATIVE_SIMILARITY_THRESHOLD similar to the partial it was drafted from, and generates normally otherwise.
+# Drafts run unhedged on the first healthy route in their own pool, so they never occupy _interviewer_executor
+# workers needed by real turns, and a turn waits for an unfinished draft no longer than the route's hedge delay.
+
+INTERVIEWER_SPECULATIVE_DRAFTS = os.environ.get('INTERVIEWER_SPECULATIVE_DRAFTS', 'false').lower() == 'true'
+SPECULATIVE_SIMILARITY_THRESHOLD = float(os.environ.get('SPECULATIVE_SIMILARITY_THRESHOLD', 0.85))
+SPECULATIVE_MIN_PARTIAL_CHARS = 40
+SPECULATIVE_DRAFT_TTL_SECONDS = 300
+_speculative_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('SPECULATIVE_MAX_WORKERS', 4)), thread_name_prefix="speculative")
+_speculative_drafts = {} # interview id -> {'partial', 'startedAt', 'finishedAt', 'baseLength', 'future'}
+_speculative_stats = {'draftsStarted': 0, 'draftsSkipped': 0, 'draftsSuperseded': 0, 'draftsFailed': 0, 'turns': 0,
+                      'turnsWithDraft': 0, 'accepted': 0, 'rejectedSimilarity': 0, 'rejectedStale': 0, 'rejectedSlow': 0,
+                      'similaritySum': 0.0, 'secondsSaved': 0.0}
+_speculative_lock = threading.Lock()
+
+
+def transcript_similarity(first, second):
+    """Word-level similarity ratio (0-1) between two transcripts, ignoring case and punctuation."""
+    first_words = re.findall(r"\w+", (first or "").lower())
+    second_words = re.findall(r"\w+", (second or "").lower())
+    if not first_words or not second_words:
+        return 0.0
+    return difflib.SequenceMatcher(None, first_words, second_words, autojunk=False).ratio()
+
+
+def _generate_speculative_draft(interview_id, partial_transcript, draft):
+    """Background job: drafts the interviewer's reply as if `partial_transcript` were the final answer."""
+    try:
+        interview_data = get_interview_data(interview_id)
+        if not interview_data or interview_data.get('status') != 'active':
+            raise ValueError("interview is not active")
+        conversation = interview_data.get('conversation', []) + [{'role': 'user', 'content': partial_transcript}]
+        messages, system_prompt = prepare_interviewer_turn(interview_id, interview_data, conversation)
+        draft['baseLength'] = len(conversation) - 1
+        return _call_interviewer_route(draft['route'], messages, system_prompt, 0.3, datetime.now().strftime("%I:%M %p"),
+                                       time.monotonic() + INTERVIEWER_TURN_TIMEOUT_SECONDS, interview_id, 'interviewer_draft')
+    except Exception as e:
+        with _speculative_lock:
+            _speculative_stats['draftsFailed'] += 1
+        print(f"[{interview_id}] Speculative draft failed: {e}")
+        raise
+    finally:
+        draft['finishedAt'] = time.monotonic()
+
+
+def start_speculative_draft(interview_id, partial_transcript):
+    """Starts a background draft for a partial answer unless the current draft already matches it. Returns (started, reason)."""
+    if not INTERVIEWER_SPECULATIVE_DRAFTS:
+        return False, 'speculative drafts are disabled'
+    partial_transcript = (partial_transcript or "").strip()
+    if len(partial_transcript) < SPECULATIVE_MIN_PARTIAL_CHARS:
+        return False, 'partial transcript too short'
+    now = time.monotonic()
+    with _speculative_lock:
+        for key in [key for key, d in _speculative_drafts.items() if now - d['startedAt'] > SPECULATIVE_DRAFT_TTL_SECONDS]:
+            del _speculative_drafts[key]
+        current = _speculative_drafts.get(interview_id)
+        if current and transcript_similarity(current['partial'], partial_transcript) >= SPECULATIVE_SIMILARITY_THRESHOLD:
+            _speculative_stats['draftsSkipped'] += 1
+            return False, 'current draft still matches'
+        draft = {'partial': partial_transcript, 'startedAt': now, 'finishedAt': None, 'baseLength': None,
+                 'route': healthy_interviewer_routes()[0]}
+        # Submitted before publishing so a concurrent take_speculative_draft never sees a draft without its future
+        draft['future'] = _speculative_executor.submit(_generate_speculative_draft, interview_id, partial_transcript, draft)
+        _speculative_drafts[interview_id] = draft # A superseded draft keeps running; its result is discarded
+        _speculative_stats['draftsStarted'] += 1
+        _speculative_stats['draftsSuperseded'] += 1 if current else 0
+    return True, 'draft started'
+
+
+def take_speculative_draft(interview_id, base_length, final_transcript):
+    """
+    Returns the drafted reply for the turn that follows `base_length` conversation messages if the final answer matches
+    the drafted partial closely enough, else None. An unfinished draft is waited on only while it is still within its
+    route's hedge delay of starting (at least INTERVIEWER_HEDGE_MIN_DELAY_SECONDS); the draft is consumed either way.
+    """
+    if not INTERVIEWER_SPECULATIVE_DRAFTS:
+        return None
+    arrived = time.monotonic()
+    with _speculative_lock:
+        draft = _speculative_drafts.pop(interview_id, None)
+        _speculative_stats['turns'] += 1
+        if draft is None:
+            return None
+        _speculative_stats['turnsWithDraft'] += 1
+    similarity = transcript_similarity(draft['partial'], final_transcript)
+    with _speculative_lock:
+        _speculative_stats['similaritySum'] += similarity
+    if similarity < SPECULATIVE_SIMILARITY_THRESHOLD:
+        outcome = 'rejectedSimilarity'
+    elif draft['baseLength'] is not None and draft['baseLength'] != base_length:
+        outcome = 'rejectedStale'
+    else:
+        wait_seconds = max(INTERVIEWER_HEDGE_MIN_DELAY_SECONDS,
+                           interviewer_hedge_delay(draft['route'][1]) - (arrived - draft['startedAt']))
+        try:
+            reply = draft['future'].result(timeout=wait_seconds)
+        except FuturesTimeoutError:
+            reply = False # still running; the caller generates normally and the draft's result is discarded
+        except Exception:
+            reply = None # already counted in draftsFailed
+        if reply is False:
+            outcome = 'rejectedSlow'
+        else:
+            outcome = 'accepted' if reply and draft['baseLength'] == base_length else 'rejectedStale' if reply else None
+    if outcome:
+        with _speculative_lock:
+            _speculative_stats[outcome] += 1
+            if outcome == 'accepted':
+                _speculative_stats['secondsSaved'] += min(arrived, draft['finishedAt'] or arrived) - draft['startedAt']
+    print(f"[{interview_id}] Speculative draft {outcome or 'failed'} (similarity {similarity:.2f}).")
+    return reply if outcome == 'accepted' else None
+
+
+def get_speculative_draft_stats():
+    """Returns draft counters plus acceptance rate, mean similarity and generation time saved by accepted drafts."""
+    with _speculative_lock:
+        stats = dict(_speculative_stats)
+    with_draft = stats['turnsWithDraft']
+    stats['enabled'] = INTERVIEWER_SPECULATIVE_DRAFTS
+    stats['acceptanceRate'] = round(stats['accepted'] / with_draft, 3) if with_draft else None
+    stats['avgSimilarity'] = round(stats.pop('similaritySum') / with_draft, 3) if with_draft else None
+    stats['secondsSaved'] = round(stats['secondsSaved'], 2)
+    return stats
+
+
+# === Interviewer Turns ===
+# A turn saves the candidate's answer, produces the interviewer's reply and saves it. /interview-response takes text;
+# /interview-turn takes audio and streams transcript, reply and speech back as newline-delimited JSON events.
+
+SPEECH_CHUNK_MAX_CHARS = 300 # reply text is synthesized in sentence-aligned chunks up to this size
+_tts_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('TTS_MAX_WORKERS', 6)), thread_name_prefix="tts")
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def run_interviewer_turn(interview_id, user_response):
+    """
+    Saves the candidate's answer, gets the interviewer's reply and saves it.
+    Returns {'interviewerResponse': ...}, or {'error': ..., 'status': http_status} if the turn cannot be taken.
+    """
+    interview_data = get_interview_data(interview_id)
+    if interview_data is None: return {'error': 'Interview session not found', 'status': 404}
+    if interview_data.get('status') != 'active': return {'error': 'Interview is not active', 'status': 400}
+
+    # Add user response to conversation in Firestore
+    if not add_conversation_message(interview_id, 'user', user_response):
+         return {'error': 'Failed to save user response', 'status': 500}
+
+    # Refresh interview_data to get latest conversation for Claude context
+    updated_interview_data = get_interview_data(interview_id)
+    if not updated_interview_data: # Check if fetch failed
+         return {'error': 'Failed to retrieve updated interview data', 'status': 500}
+
+    current_conversation = updated_interview_data.get('conversation', [])
+
+    # Get current time for context
+    current_time_str = datetime.now().strftime("%I:%M %p")
+
+    # Generate interviewer's next response with LOWER temperature and time context
+    interviewer_response = INTERVIEWER_FALLBACK_RESPONSE # Default fallback
+    try:
+        # Reuse a reply drafted from the candidate's partial answer if it still matches (speculative mode only)
+        draft = take_speculative_draft(interview_id, len(current_conversation) - 1, user_response)
+        if draft is not None:
+            interviewer_response = draft
+        else:
+            # Prompt is regenerated from the stored snapshots; older turns are folded into a rolling summary
+            api_conversation, system_prompt = prepare_interviewer_turn(interview_id, updated_interview_data, current_conversation)
+            # Hedged across models with failover; see generate_interviewer_reply
+            interviewer_response = generate_interviewer_reply(
+                messages=api_conversation,
+                system_prompt=system_prompt,
+                temperature=0.3, # <-- SET TEMPERATURE
+                current_time_str=current_time_str, # <-- PASS CURRENT TIME
+                usage_session=interview_id
+            )
+        # Add AI response to conversation in Firestore
+        if not add_conversation_message(interview_id, 'assistant', interviewer_response):
+             # Log error but maybe still return response to user?
+             print(f"[{interview_id}] Failed to save assistant response to Firestore, but proceeding.")
+
+    except Exception as e:
+        print(f"[{interview_id}] Error generating interviewer response: {e}")
+        # Fallback response is already set above
+        # Attempt to save error message as assistant response
+        add_conversation_message(interview_id, 'assistant', interviewer_response) # Save the fallback message
+
+    return {'interviewerResponse': interviewer_response}
+
+
+# --- Interview Greeting Cache ---
+# The greeting (and its speech) is prepared on a worker while /start-mock-interview consumes quota and writes the
+# interview document. Greetings are cached per (interviewer system prompt, interview type, part of day), audio included.
+# The system prompt embeds the candidate's resume and job analysis, and the greeting's first question can draw on
+# them, so a cached greeting is only reused for the same resume/job pair (e.g. a restarted interview).
+GREETING_CACHE_MAX_ENTRIES = int(os.environ.get('GREETING_CACHE_MAX_ENTRIES', 200))
+GREETING_CACHE_TTL_SECONDS = int(os.environ.get('GREETING_CACHE_TTL_SECONDS', 86400))
+_greeting_cache = OrderedDict() # key -> (expires_at, greeting, audio bytes or None, audio format), LRU order
+_greeting_cache_stats = {'hits': 0, 'misses': 0}
+_greeting_cache_lock = threading.Lock()
+_greeting_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('GREETING_MAX_WORKERS', 4)), thread_name_prefix="greeting")
+
+
+def greeting_cache_key(system_prompt, interview_type, now=None):
+    """Cache key for a greeting; the part of day is included because the greeting is time-aware."""
+    hour = (now or datetime.now()).hour
+    part_of_day = 'morning' if hour < 12 else 'afternoon' if hour < 17 else 'evening'
+    key_material = json.dumps([system_prompt, interview_type, part_of_day, CLAUDE_MODEL, SPEECH_BACKEND])
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+
+def prepare_interview_greeting(interview_id, resume_data, job_data, interview_type, system_prompt):
+    """
+    Returns {'greeting', 'audio', 'audioFormat', 'cached'} for a new interview. Audio is None if speech failed
+    (the client can still call /generate-tts). A fallback greeting is used, and not cached, if generation fails.
+    """
+    candidate_name = resume_data.get('name', 'the candidate')
+    key = greeting_cache_key(system_prompt, interview_type)
+    with _greeting_cache_lock:
+        entry = _greeting_cache.get(key)
+        if entry and entry[0] > time.time():
+            _greeting_cache.move_to_end(key)
+            _greeting_cache_stats['hits'] += 1
+            return {'greeting': entry[1], 'audio': entry[2], 'audioFormat': entry[3], 'cached': True}
+        if entry: # Expired
+            del _greeting_cache[key]
+        _greeting_cache_stats['misses'] += 1
+
+    initial_prompt = f"Start the '{interview_type}' interview with {candidate_name}. Give a brief professional greeting and ask your first question."
+    set_llm_usage_session(interview_id)
+    try:
+        greeting = call_claude_api(
+            messages=[{"role": "user", "content": initial_prompt}],
+            system_prompt=system_prompt,
+            model=CLAUDE_MODEL,
+            temperature=0.3,  # Lower temperature for more consistency
+            current_time_str=datetime.now().strftime("%I:%M %p"),  # e.g., "01:15 PM"
+            feature='interview_greeting'
+        )
+        generated = greeting != INTERVIEWER_FALLBACK_RESPONSE
+    except Exception as e:
+        print(f"Error generating greeting for interview {interview_id}: {e}")
+        generated = False
+    finally:
+        set_llm_usage_session(None)
+    if not generated:
+        greeting = f"Hello {resume_data.get('name', 'there')}. Welcome to your {interview_type} mock interview. Let's begin. Can you start by telling me a bit about yourself and your background?"
+
+    try:
+        audio = generate_speech(greeting)
+    except Exception as e:
+        print(f"Greeting TTS failed for interview {interview_id}, client will request it: {e}")
+        audio = None
+    if generated:
+        with _greeting_cache_lock:
+            _greeting_cache[key] = (time.time() + GREETING_CACHE_TTL_SECONDS, greeting, audio, speech_audio_format())
+            _greeting_cache.move_to_end(key)
+            while len(_greeting_cache) > GREETING_CACHE_MAX_ENTRIES:
+                _greeting_cache.popitem(last=False)
+    return {'greeting': greeting, 'audio': audio, 'audioFormat': speech_audio_format(), 'cached': False}
+
+
+def get_greeting_cache_stats():
+    """Returns greeting cache size and hit/miss counts."""
+    with _greeting_cache_lock:
+        lookups = _greeting_cache_stats['hits'] + _greeting_cache_stats['misses']
+        return dict(_greeting_cache_stats, entries=len(_greeting_cache),
+                    hitRatio=round(_greeting_cache_stats['hits'] / lookups, 4) if lookups else 0.0)
+
+
+def split_reply_for_speech(text, max_chars=SPEECH_CHUNK_MAX_CHARS):
+    """Splits reply text into sentence-aligned chunks of at most `max_chars` (a longer sentence is its own chunk)."""
+    chunks, current = [], ""
+    for sentence in _SENTENCE_END.split(text.strip()):
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def ndjson_event(event_type, **fields):
+    """One line of an /interview-turn stream."""
+    return json.dumps(dict(fields, type=event_type)) + "\n"
+
+
+# === Prompt Context Serialization ===
+# Structured context (resumes, job requirements, gaps, questions) goes into prompts as indented YAML-like text
+# instead of json.dumps(indent=2): no quotes/braces, null and empty fields dropped, short scalar lists inline.
+# Output is cut to a token budget at line (field/item) boundaries rather than mid-value by a character slice.
+
+PROMPT_INLINE_LIST_MAX_CHARS = 120
+_prompt_compaction_stats = {} # call site -> {'calls', 'baselineTokens', 'compactTokens', 'truncated'}
+_prompt_compaction_lock = threading.Lock()
+
+
+def _is_empty_prompt_value(value):
+    return value is None or (isinstance(value, (str, list, tuple, dict)) and not (value.strip() if isinstance(value, str) else value))
+
+
+def _prompt_scalar(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return ' '.join(str(value).split()) # collapse newlines/runs of whitespace so every line is one field
+
+
+def _prompt_context_lines(value, indent, lines):
+    """Appends the YAML-like rendering of a dict/list to `lines` as (text, is_header) pairs."""
+    pad = '  ' * indent
+    if isinstance(value, dict):
+        items = [(f"{key}:", child) for key, child in value.items() if not _is_empty_prompt_value(child)]
+    else:
+        items = [('-', child) for child in value if not _is_empty_prompt_value(child)]
+    for label, child in items:
+        if isinstance(child, (list, tuple)) and not any(isinstance(c, (dict, list, tuple)) for c in child):
+            inline = ', '.join(_prompt_scalar(c) for c in child if not _is_empty_prompt_value(c))
+            if len(inline) <= PROMPT_INLINE_LIST_MAX_CHARS:
+                lines.append((f"{pad}{label} [{inline}]", False))
+                continue
+        if isinstance(child, dict) and label == '-': # "- first: field" with the rest aligned under it
+            start = len(lines)
+            _prompt_context_lines(child, indent + 1, lines)
+            if len(lines) > start:
+                text, is_header = lines[start]
+                lines[start] = (f"{pad}- {text.lstrip()}", is_header)
+            continue
+        if isinstance(child, (dict, list, tuple)):
+            lines.append((f"{pad}{label}", True))
+            _prompt_context_lines(child, indent + 1, lines)
+        else:
+            lines.append((f"{pad}{label} {_prompt_scalar(child)}", False))
+
+
+def serialize_prompt_context(value, token_budget, call_site, legacy_char_limit=None):
+    """
+    Renders `value` as compact YAML-like prompt text within `token_budget` tokens, cutting at field boundaries.
+    Savings are recorded per call site against the json.dumps(indent=2) text the prompt used before
+    (capped at `legacy_char_limit` where the old prompt sliced it).
+    """
+    if isinstance(value, (dict, list, tuple)):
+        lines = []
+        _prompt_context_lines(value, 0, lines)
+    else:
+        lines = [(_prompt_scalar(value), False)] if not _is_empty_prompt_value(value) else []
+
+    kept, used = [], 0
+    for text, is_header in lines:
+        cost = estimate_tokens(text) + 1 # +1 for the newline
+        if used + cost > token_budget:
+            break
+        kept.append((text, is_header))
+        used += cost
+    omitted = len(lines) - len(kept)
+    if omitted:
+        while kept and kept[-1][1]: # don't end on a header whose children were all cut
+            kept.pop()
+            omitted += 1
+    result = '\n'.join(text for text, _ in kept) or 'N/A'
+    if omitted:
+        result += f"\n... ({omitted} more lines omitted)"
+
+    baseline = json.dumps(value, indent=2, default=str)
+    if legacy_char_limit:
+        baseline = baseline[:legacy_char_limit]
+    baseline_tokens, compact_tokens = estimate_tokens(baseline), estimate_tokens(result)
+    with _prompt_compaction_lock:
+        stats = _prompt_compaction_stats.setdefault(call_site, {'calls': 0, 'baselineTokens': 0, 'compactTokens': 0, 'truncated': 0})
+        stats['calls'] += 1
+        stats['baselineTokens'] += baseline_tokens
+        stats['compactTokens'] += compact_tokens
+        stats['truncated'] += 1 if omitted else 0
+    print(f"Prompt context [{call_site}]: ~{compact_tokens} tokens (was ~{baseline_tokens}, saved ~{baseline_tokens - compact_tokens})"
+          f"{f', {omitted} lines over budget' if omitted else ''}")
+    return result
+
+
+def get_prompt_compaction_stats():
+    """Returns per-call-site token totals before/after compact serialization."""
+    with _prompt_compaction_lock:
+        return {site: dict(stats, tokensSaved=stats['baselineTokens'] - stats['compactTokens'])
+                for site, stats in _prompt_compaction_stats.items()}
+
+
+# === LLM JSON Extraction ===
+
+_JSON_CLOSERS = {'{': '}', '[': ']'}
+_JSON_STRING_SPECIAL = re.compile(r'["\\]')
+_JSON_TRAILING_UNICODE_ESCAPE = re.compile(r'(\\+)u[0-9a-fA-F]{0,3}$')
+
+def extract_json_from_llm_response(response_text, root='{'):
+    """
+    Extracts the outermost JSON value (starting at the first `root` character) from LLM output
+    in a single bracket- and string-aware scan, ignoring surrounding prose and markdown fences.
+    Truncated output is repaired by closing an open value string, dropping an incomplete trailing
+    key/number/comma or a nested member that has no complete value yet, and closing open arrays/objects
+    in nesting order.
+    Returns (parsed_value, repairs) where repairs lists what was fixed (empty if nothing).
+    Raises ValueError (json.JSONDecodeError for parse failures) if no JSON value can be parsed.
+    """
+    if not isinstance(response_text, str):
+        raise ValueError(f"Expected LLM response text, got {type(response_text).__name__}")
+    start = response_text.find(root)
+    if start == -1:
+        raise ValueError(f"No JSON {'object' if root == '{' else 'array'} found in response: {response_text[:200]}")
+
+    text = response_text
+    length = len(text)
+    # Stack entries: [opening char, state]; object states: key/colon/value/comma, array states: value/comma
+    stack = []
+    in_string = False
+    string_is_key = False
+    escaped = False # Truncated right after a backslash inside a string
+    scalar_start = -1 # Start of an unquoted literal/number in progress
+    safe_end, safe_closers = -1, '' # Last cut point where closing the stack yields valid JSON
+
+    def closers_for_stack():
+        return ''.join(_JSON_CLOSERS[entry[0]] for entry in reversed(stack))
+
+    def value_completed(end_index):
+        nonlocal safe_end, safe_closers
+        stack[-1][1] = 'comma'
+        safe_end, safe_closers = end_index, closers_for_stack()
+
+    i = start
+    while i < length:
+        if in_string:
+            # Jump straight to the next quote or backslash
+            match = _JSON_STRING_SPECIAL.search(text, i)
+            if not match:
+                i = length
+                break
+            i = match.start()
+            if text[i] == '\\':
+                if i + 1 >= length:
+                    escaped = True
+                i += 2
+                continue
+            in_string = False
+            if string_is_key:
+                stack[-1][1] = 'colon'
+            else:
+                value_completed(i + 1)
+            i += 1
+            continue
+
+        char = text[i]
+        if scalar_start != -1 and (char in ',}]' or char.isspace()):
+            scalar_start = -1
+            value_completed(i)
+
+        if char == '"':
+            in_string = True
+            string_is_key = stack[-1][0] == '{' and stack[-1][1] == 'key' if stack else False
+        elif char in '{[':
+            if stack: stack[-1][1] = 'comma' # The nested container is this slot's value
+            stack.append([char, 'key' if char == '{' else 'value'])
+            if len(stack) == 1: # Only the root may be closed empty; an unfinished nested member is dropped instead
+                safe_end, safe_closers = i + 1, closers_for_stack()
+        elif char in '}]':
+            stack.pop()
+            if not stack:
+                return json.loads(text[start:i + 1], strict=False), []
+            value_completed(i + 1)
+        elif char == ':':
+            stack[-1][1] = 'value'
+        elif char == ',':
+            stack[-1][1] = 'key' if stack[-1][0] == '{' else 'value'
+        elif scalar_start == -1 and not char.isspace():
+            scalar_start = i
+        i += 1
+
+    # --- Truncated: repair the tail ---
+    repairs = []
+    if in_string and not string_is_key:
+        fragment = text[start:]
+        if escaped:
+            fragment = fragment[:-1] # Drop a dangling backslash
+        else:
+            unicode_escape = _JSON_TRAILING_UNICODE_ESCAPE.search(fragment)
+            if unicode_escape and len(unicode_escape.group(1)) % 2 == 1:
+                fragment = fragment[:unicode_escape.end(1) - 1] # Drop an incomplete \uXXXX escape
+        fragment += '"'
+        repairs.append("closed unterminated string")
+        closers = closers_for_stack()
+    elif not in_string and scalar_start == -1 and stack[-1][1] == 'comma':
+        fragment = text[start:].rstrip()
+        closers = closers_for_stack()
+    elif not in_string and scalar_start != -1 and stack[-1][1] != 'colon' and \
+            text[scalar_start:].rstrip() in ('true', 'false', 'null'):
+        # Numbers are dropped below instead, since a trailing number may itself be cut short
+        fragment = text[start:].rstrip()
+        closers = closers_for_stack()
+    else:
+        if safe_end == -1:
+            raise ValueError(f"Truncated JSON could not be repaired: {text[start:start + 200]}")
+        fragment = text[start:safe_end]
+        closers = safe_closers
+        if text[safe_end:].strip():
+            repairs.append(f"dropped incomplete trailing content {text[safe_end:].strip()[:80]!r}")
+
+    repairs.append(f"closed {len(closers)} open container(s) with '{closers}'")
+    return json.loads(fragment + closers, strict=False), repairs
+
+
+# === LLM Response Schemas ===
+# Declarative shapes for the structured LLM responses. Each schema is compiled once at import into a
+# validator that coerces the parsed JSON in a single pass: wrong-typed values are converted where it is
+# safe (e.g. "85" -> 85, 85.4 -> 85), missing fields get their defaults, invalid array items are dropped,
+# and every field-level problem is recorded as a violation. Keys not in a schema are passed through.
+#
+# Node keys: 'type' ('string' | 'integer' | 'number' | 'boolean' | 'array' | 'object' | tuple of scalar types),
+# 'default', 'min'/'max' (numbers, clamped), 'items' (array), 'fields' (object), 'optional' (field is left
+# out instead of defaulted), 'drop' (object keys that are removed), 'wrapString' (object field a bare string
+# item is wrapped into).
+
+def _missing_marker_fields(*keys):
+    """String fields that default to a visible '[Missing: key]' marker."""
+    return {key: {'type': 'string', 'default': f"[Missing: {key}]"} for key in keys}
+
+_STRING_LIST = {'type': 'array', 'items': {'type': 'string'}}
+_SCORE = {'type': 'integer', 'min': 0, 'max': 100, 'default': 0}
+_ASSESSMENT = {'type': 'object', 'fields': {
+    'score': _SCORE,
+    'strengths': _STRING_LIST,
+    'weaknesses': _STRING_LIST,
+    'feedback': {'type': 'string', 'default': ""}
+}}
+
+RESPONSE_SCHEMAS = MappingProxyType({
+    'match_result': {'type': 'object', 'fields': {
+        'matchScore': _SCORE,
+        'matchAnalysis': {'type': 'string', 'default': "[Analysis not provided or failed validation]"},
+        'keyStrengths': {'type': 'array', 'items': {'type': 'object', 'fields': _missing_marker_fields(
+            "strength", "relevance", "howToEmphasize")}},
+        'skillGaps': {'type': 'array', 'items': {'type': 'object', 'fields': _missing_marker_fields(
+            "missingSkill", "importance", "suggestion", "alternateSkillToHighlight")}},
+        # Sub-fields stay optional: consumers fall back with .get('jobTitle', 'the position') etc.
+        'jobRequirements': {'type': 'object', 'fields': {
+            'jobTitle': {'type': 'string', 'optional': True},
+            'requiredSkills': dict(_STRING_LIST, optional=True),
+            'experienceLevel': {'type': 'string', 'optional': True},
+            'educationNeeded': {'type': 'string', 'optional': True}
+        }},
+        'resumeImprovements': {'type': 'array', 'items': {'type': 'object', 'fields': _missing_marker_fields(
+            "section", "issue", "recommendation", "currentContent", "improvedVersion", "explanation")}}
+    }},
+    'prep_plan': {'type': 'object', 'drop': ('preparationTimeline',), 'fields': {
+        'focusAreas': _STRING_LIST,
+        'likelyQuestions': {'type': 'array', 'items': {'type': 'object', 'wrapString': 'question', 'fields': {
+            'category': {'type': 'string', 'default': ""},
+            'question': {'type': 'string', 'default': ""},
+            'guidance': {'type': 'string', 'default': ""}
+        }}},
+        'conceptsToStudy': {'type': 'object', 'fields': {
+            'fundamentals': _STRING_LIST,
+            'advanced': _STRING_LIST,
+            'technologies': _STRING_LIST,
+            'methodologies': _STRING_LIST
+        }},
+        'gapStrategies': {'type': 'array', 'items': {'type': 'object', 'fields': {
+            'gap': {'type': 'string', 'default': ""},
+            'strategy': {'type': 'string', 'default': ""},
+            'focus_during_prep': {'type': 'string', 'default': ""}
+        }}}
+    }},
+    'timeline': {'type': 'object', 'fields': {
+        'timeline': {'type': 'array', 'items': {'type': 'object', 'fields': {
+            'day': {'type': ('integer', 'string'), 'default': None},
+            'focus': {'type': 'string', 'default': ""},
+            'schedule': {'type': 'array', 'items': {'type': 'object', 'wrapString': 'task', 'fields': {
+                'time_slot': {'type': 'string', 'optional': True},
+                'task': {'type': 'string', 'default': ""}
+            }}},
+            'notes': {'type': 'string', 'default': ""}
+        }}},
+        'estimated_total_hours': {'type': 'integer', 'min': 0, 'optional': True}
+    }},
+    'interview_analysis': {'type': 'object', 'fields': {
+        'overallScore': _SCORE,
+        'overallAssessment': {'type': 'string', 'default': "[Analysis Error]"},
+        'technicalAssessment': _ASSESSMENT,
+        'communicationAssessment': _ASSESSMENT,
+        'behavioralAssessment': _ASSESSMENT,
+        'specificFeedback': {'type': 'array', 'items': {'type': 'object', 'fields': {
+            'question': {'type': 'string', 'default': ""},
+            'response': {'type': 'string', 'default': ""},
+            'assessment': {'type': 'string', 'default': ""},
+            'improvement': {'type': 'string', 'default': ""}
+        }}},
+        'keyImprovementAreas': {'type': 'array', 'items': {'type': 'object', 'fields': {
+            'area': {'type': 'string', 'default': ""},
+            'recommendation': {'type': 'string', 'default': ""},
+            'practiceExercise': {'type': 'string', 'default': ""}
+        }}}
+    }},
+    'suggested_answers': {'type': 'object', 'fields': {
+        'suggestedAnswers': {'type': 'array', 'items': {'type': 'object', 'fields': {
+            'question': {'type': 'string', 'default': ""},
+            'suggestions': {'type': 'array', 'items': {'type': 'object', 'wrapString': 'answer', 'fields': {
+                'answer': {'type': 'string', 'default': ""},
+                'rationale': {'type': 'string', 'default': ""}
+            }}}
+        }}}
+    }}
+})
+
+_INVALID = object() # Returned by compiled validators when a value cannot be coerced
+_SCALAR_TYPES = {'string': str, 'integer': int, 'number': (int, float), 'boolean': bool}
+
+
+def _compile_schema_node(node, path):
+    """Compiles a schema node into validate(value, violations) -> coerced value or _INVALID."""
+    kind = node['type']
+
+    if isinstance(kind, tuple): # Union of scalar types: accept as-is, no coercion
+        accepted = tuple(_SCALAR_TYPES[k] for k in kind)
+        allow_bool = 'boolean' in kind
+        def validate(value, violations):
+            if isinstance(value, bool) and not allow_bool: return _INVALID
+            return value if isinstance(value, accepted) else _INVALID
+        return validate
+
+    if kind == 'string':
+        def validate(value, violations):
+            if isinstance(value, str): return value
+            if isinstance(value, (int, float)) and not isinstance(value, bool): return str(value)
+            if isinstance(value, list) and all(isinstance(part, str) for part in value): return "\n".join(value)
+            return _INVALID
+        return validate
+
+    if kind in ('integer', 'number'):
+        low, high = node.get('min'), node.get('max')
+        def validate(value, violations):
+            if isinstance(value, bool): return _INVALID
+            if isinstance(value, str):
+                try: value = float(value.strip().rstrip('%'))
+                except ValueError: return _INVALID
+            if not isinstance(value, (int, float)): return _INVALID
+            if isinstance(value, float) and not math.isfinite(value): return _INVALID # NaN/Infinity parse as JSON and from strings
+            if kind == 'integer' and not isinstance(value, int): value = int(round(value))
+            if low is not None and value < low or high is not None and value > high:
+                if violations is not None: violations.append((path, 'out_of_range'))
+                value = max(low, value) if low is not None else value
+                value = min(high, value) if high is not None else value
+            return value
+        return validate
+
+    if kind == 'boolean':
+        def validate(value, violations):
+            if isinstance(value, bool): return value
+            if isinstance(value, str) and value.strip().lower() in ('true', 'false'): return value.strip().lower() == 'true'
+            return _INVALID
+        return validate
+
+    if kind == 'array':
+        item_path = f"{path}[]"
+        validate_item = _compile_schema_node(node['items'], item_path)
+        def validate(value, violations):
+            if not isinstance(value, list): return _INVALID
+            coerced = []
+            for item in value:
+                item = validate_item(item, violations)
+                if item is _INVALID:
+                    if violations is not None: violations.append((item_path, 'invalid_item'))
+                    continue
+                coerced.append(item)
+            return coerced
+        return validate
+
+    if kind == 'object':
+        fields = []
+        for key, field_node in node['fields'].items():
+            field_path = f"{path}.{key}" if path else key
+            default = field_node.get('default', [] if field_node['type'] == 'array' else None)
+            fields.append((key, _compile_schema_node(field_node, field_path), field_path,
+                           field_node.get('optional', False), field_node['type'] == 'object', default))
+        drop_keys = node.get('drop', ())
+        wrap_key = node.get('wrapString')
+
+        def validate(value, violations):
+            if wrap_key and isinstance(value, str):
+                if violations is not None: violations.append((path, 'wrapped_string'))
+                value = {wrap_key: value}
+            if not isinstance(value, dict): return _INVALID
+            coerced = dict(value) # Unknown keys pass through
+            for key in drop_keys:
+                if coerced.pop(key, _INVALID) is not _INVALID and violations is not None:
+                    violations.append((f"{path}.{key}" if path else key, 'unexpected'))
+            for key, validate_field, field_path, optional, is_object, default in fields:
+                field_value = coerced.get(key)
+                if field_value is not None:
+                    field_value = validate_field(field_value, violations)
+                    if field_value is not _INVALID:
+                        coerced[key] = field_value
+                        continue
+                    if violations is not None: violations.append((field_path, 'wrong_type'))
+                elif violations is not None and not optional:
+                    violations.append((field_path, 'missing'))
+                if optional:
+                    coerced.pop(key, None)
+                else: # Nested objects default to their own fully-defaulted shape
+                    coerced[key] = validate_field({}, None) if is_object else copy.deepcopy(default)
+            return coerced
+        return validate
+
+    raise ValueError(f"Unknown schema type '{kind}' at '{path}'")
+
+
+def _schema_node_to_json_schema(node):
+    """Converts a schema node into the JSON Schema used for provider structured-output modes."""
+    kind = node['type']
+    if isinstance(kind, tuple):
+        return {'type': list(kind)}
+    if kind == 'array':
+        return {'type': 'array', 'items': _schema_node_to_json_schema(node['items'])}
+    if kind == 'object':
+        return {
+            'type': 'object',
+            'properties': {key: _schema_node_to_json_schema(field_node) for key, field_node in node['fields'].items()},
+            'required': [key for key, field_node in node['fields'].items() if not field_node.get('optional', False)]
+        }
+    json_schema = {'type': kind}
+    if 'min' in node: json_schema['minimum'] = node['min']
+    if 'max' in node: json_schema['maximum'] = node['max']
+    return json_schema
+
+
+_COMPILED_RESPONSE_SCHEMAS = {name: _compile_schema_node(schema, "") for name, schema in RESPONSE_SCHEMAS.items()}
+_RESPONSE_JSON_SCHEMAS = {name: _schema_node_to_json_schema(schema) for name, schema in RESPONSE_SCHEMAS.items()}
+_response_validation_stats = {} # schema name -> {'validated': N, 'withViolations': M, 'violations': {"path:kind": count}}
+_response_validation_lock = threading.Lock()
+
+
+def validate_llm_response(schema_name, data):
+    """
+    Validates and coerces a parsed LLM response against RESPONSE_SCHEMAS[schema_name] in one pass.
+    Returns (coerced_data, violations) where violations is a list of (field_path, kind) tuples.
+    Raises ValueError if the root value is not a JSON object. Violations are recorded for /metrics.
+    """
+    violations = []
+    coerced = _COMPILED_RESPONSE_SCHEMAS[schema_name](data, violations)
+    with _response_validation_lock:
+        stats = _response_validation_stats.setdefault(schema_name, {'validated': 0, 'withViolations': 0, 'violations': {}})
+        stats['validated'] += 1
+        if coerced is _INVALID:
+            violations.append(("", 'wrong_type'))
+        if violations:
+            stats['withViolations'] += 1
+            for field_path, violation in violations:
+                counter_key = f"{field_path or '<root>'}:{violation}"
+                stats['violations'][counter_key] = stats['violations'].get(counter_key, 0) + 1
+    if coerced is _INVALID:
+        raise ValueError(f"{schema_name} response is not a JSON object (got {type(data).__name__}).")
+    if violations:
+        summary = ", ".join(f"{field_path or '<root>'}:{violation}" for field_path, violation in violations[:10])
+        print(f"Schema '{schema_name}' coerced {len(violations)} violation(s): {summary}{' ...' if len(violations) > 10 else ''}")
+    return coerced, violations
+
+
+def get_response_validation_stats():
+    """Returns per-schema validation counts and field-level violation counts."""
+    with _response_validation_lock:
+        return copy.deepcopy(_response_validation_stats)
+
+
 def parse_resume_with_claude(resume_text):
     """Parses resume text using the Claude API."""
     if not CLAUDE_API_KEY: raise ValueError("Claude API Key not configured.")
     system_prompt = f"""
 You are an expert resume parser. Analyze this resume text:
 --- START ---
-{resume_text[:30000]}
+{truncate_to_token_budget(resume_text, 7500, CLAUDE_MODEL)}
 --- END ---
 Extract the following information and return it as a valid JSON object only (no explanations):
 {{
@@ -465,19 +2491,10 @@ Set "hasSummarySection" to true if there is a summary or professional profile pa
     try:
         response_content = call_claude_api(
             messages=messages, system_prompt=system_prompt,
-            model=CLAUDE_MODEL, temperature=0.2
+            model=CLAUDE_MODEL, temperature=0.2, feature='resume_parse'
         )
-        # Extract JSON part carefully
-        json_start = response_content.find('{')
-        json_end = response_content.rfind('}') + 1
-        if json_start >= 0 and json_end > json_start:
-            json_text = response_content[json_start:json_end]
-            parsed_json = json.loads(json_text)
-        else: # Fallback if no {} found, maybe Claude returned pure JSON?
-             try:
-                 parsed_json = json.loads(response_content)
-             except json.JSONDecodeError:
-                 raise ValueError(f"Could not find or parse JSON in Claude resume parsing response: {response_content[:500]}")
+        parsed_json, repairs = extract_json_from_llm_response(response_content)
+        if repairs: print(f"Repaired Claude resume parsing JSON: {'; '.join(repairs)}")
         # Defaulting key fields
         parsed_json.setdefault("name", None)
         parsed_json.setdefault("email", None)
@@ -498,7 +2515,7 @@ def match_resume_jd_with_openai(resume_data, job_description):
     # Ensure OPENAI_API_KEY is configured
     if not globals().get("OPENAI_API_KEY"): raise ValueError("OpenAI API Key is not configured.")
 
-    resume_data_str = json.dumps(resume_data, indent=2) if isinstance(resume_data, dict) else str(resume_data)
+    resume_data_str = serialize_prompt_context(resume_data, 2500, 'resume_match', legacy_char_limit=10000) if isinstance(resume_data, dict) else str(resume_data)[:10000]
 
     # Create sections overview for easier reference
     sections_overview = ""
@@ -522,13 +2539,13 @@ Your task is to perform a rigorous analysis of the provided resume against the j
 
 Job Description:
 --- START JD ---
-{job_description[:10000]}
+{truncate_to_token_budget(job_description, 2500, OPENAI_MODEL)}
 --- END JD ---
 
-Candidate Resume Data (JSON):
---- START JSON ---
-{resume_data_str[:10000]}
---- END JSON ---
+Candidate Resume Data:
+--- START RESUME ---
+{resume_data_str}
+--- END RESUME ---
 
 Resume Sections Overview:
 {sections_overview}
@@ -581,52 +2598,9 @@ MANDATORY INSTRUCTIONS:
 """
 
     try:
-        result_text = call_openai_api(prompt=prompt, model=OPENAI_MODEL, temperature=0.2)
-        # Clean potential markdown backticks
-        if result_text.strip().startswith("```json"): result_text = result_text.strip()[7:]
-        if result_text.strip().endswith("```"): result_text = result_text.strip()[:-3]
-
-        match_result_obj = json.loads(result_text.strip(), strict=False)
-
-        # Enhanced validation & defaulting
-        match_result_obj.setdefault("matchScore", 0)
-        match_result_obj.setdefault("matchAnalysis", "[Analysis not provided or failed validation]")
-        match_result_obj.setdefault("keyStrengths", [])
-        match_result_obj.setdefault("skillGaps", [])
-        match_result_obj.setdefault("jobRequirements", {})
-        match_result_obj.setdefault("resumeImprovements", [])
-
-        # Validate list items
-        def validate_list_items(items, required_keys, list_name):
-            validated_list = []
-            if not isinstance(items, list):
-                 print(f"Warning: '{list_name}' is not a list in the response. Defaulting to empty list.")
-                 return []
-            for i, item in enumerate(items):
-                if not isinstance(item, dict):
-                    print(f"Warning: Item {i} in '{list_name}' is not an object. Skipping.")
-                    continue
-                for key in required_keys:
-                    item.setdefault(key, f"[Missing: {key}]")
-                validated_list.append(item)
-            return validated_list
-
-        match_result_obj["keyStrengths"] = validate_list_items(
-            match_result_obj["keyStrengths"],
-            ["strength", "relevance", "howToEmphasize"],
-            "keyStrengths"
-        )
-        match_result_obj["skillGaps"] = validate_list_items(
-            match_result_obj["skillGaps"],
-            ["missingSkill", "importance", "suggestion", "alternateSkillToHighlight"],
-            "skillGaps"
-        )
-        match_result_obj["resumeImprovements"] = validate_list_items(
-            match_result_obj["resumeImprovements"],
-            ["section", "issue", "recommendation", "currentContent", "improvedVersion", "explanation"],
-            "resumeImprovements"
-        )
-        
+        match_result_obj = call_openai_api(prompt=prompt, model=OPENAI_MODEL, temperature=0.2, response_schema='match_result', feature='resume_match')
+        match_result_obj, _ = validate_llm_response('match_result', match_result_obj)
+
         # If resume already has a summary section, remove any suggestions to add one
         if resume_data.get("hasSummarySection") == True:
             match_result_obj["resumeImprovements"] = [
@@ -668,8 +2642,8 @@ def generate_interview_prep_plan(resume_match_data):
                     any(keyword.lower() in current_position.lower() for keyword in law_keywords)
 
     try:
-        gaps_str = json.dumps(skill_gaps, indent=2) if skill_gaps else "[]"
-        requirements_str = json.dumps(job_requirements, indent=2) if job_requirements else "{}"
+        gaps_str = serialize_prompt_context(skill_gaps, 375, 'prep_plan.gaps', legacy_char_limit=1500) if skill_gaps else "None"
+        requirements_str = serialize_prompt_context(job_requirements, 500, 'prep_plan.requirements', legacy_char_limit=2000) if job_requirements else "N/A"
         # Extract only basic info for summary to keep prompt concise
         resume_summary_dict = {
             "name": parsed_resume.get("name", parsed_resume.get("contactInfo", {}).get("name")),
@@ -677,11 +2651,11 @@ def generate_interview_prep_plan(resume_match_data):
             "yearsOfExperience": parsed_resume.get("yearsOfExperience", "[Not specified]"),
             "technicalSkillsSummary": [s.get("skill") for s in parsed_resume.get("skills", []) if s.get("type") == "TECHNICAL"][:10] # Sample of tech skills
         }
-        resume_summary_str = json.dumps(resume_summary_dict, indent=2)
+        resume_summary_str = serialize_prompt_context(resume_summary_dict, 250, 'prep_plan.resume', legacy_char_limit=1000)
 
     except Exception as json_err:
         print(f"Warning: Could not serialize data cleanly for prep plan prompt - {json_err}")
-        gaps_str, requirements_str, resume_summary_str = str(skill_gaps), str(job_requirements), str(parsed_resume) # Fallback to string
+        gaps_str, requirements_str, resume_summary_str = str(skill_gaps)[:1500], str(job_requirements)[:2000], str(parsed_resume)[:1000] # Fallback to string
 
     # NEW: Domain-specific question guidance and concepts structure
     if is_law_domain:
@@ -721,15 +2695,15 @@ def generate_interview_prep_plan(resume_match_data):
 You are an expert interview coach tasked with creating a highly targeted interview preparation plan. Base your plan *strictly* on the provided analysis data.
 
 Candidate Summary:
-{resume_summary_str[:1000]}
+{resume_summary_str}
 
 Job Requirements:
-{requirements_str[:2000]}
+{requirements_str}
 
 Identified Skill Gaps:
-{gaps_str[:1500]}
+{gaps_str}
 
-Analysis Summary: Match Score: {match_score}/100. {match_analysis[:1500]}
+Analysis Summary: Match Score: {match_score}/100. {truncate_to_token_budget(match_analysis, 375, CLAUDE_MODEL)}
 
 Your Task: Create a detailed preparation plan structured ONLY as a valid JSON object. Adhere precisely to the specified structure and content requirements below.
 
@@ -754,76 +2728,14 @@ MANDATORY INSTRUCTIONS:
     # --- End of Modified Prompt ---
 
     messages = [{"role": "user", "content": "Generate the detailed interview preparation plan (excluding timeline) strictly following the JSON structure and content rules provided in the system prompt."}]
-    response_content = ""
     try:
-        response_content = call_claude_api( # Assume call_claude_api exists
+        prep_plan = call_claude_api( # Structured output via tool use, returns a dict
             messages=messages, system_prompt=system_prompt, model=CLAUDE_HAIKU_MODEL,
-            max_tokens=4096, temperature=0.5
+            max_tokens=4096, temperature=0.5, response_schema='prep_plan', feature='prep_plan'
         )
 
-        # --- Robust JSON extraction ---
-        json_text = ""
-        try:
-            # Try parsing directly first
-            prep_plan = json.loads(response_content, strict=False)
-        except json.JSONDecodeError:
-            # If direct parsing fails, find JSON block
-            json_start = response_content.find('{')
-            json_end = response_content.rfind('}') + 1
-            if json_start != -1 and json_end != -1 and json_end > json_start:
-                json_text = response_content[json_start:json_end].strip()
-                try:
-                    # Try basic repair if needed
-                    opening_braces = json_text.count('{')
-                    closing_braces = json_text.count('}')
-                    opening_brackets = json_text.count('[')
-                    closing_brackets = json_text.count(']')
-                    
-                    # Add missing closing braces/brackets if needed
-                    if opening_braces > closing_braces:
-                        json_text += '}' * (opening_braces - closing_braces)
-                        print(f"Added {opening_braces - closing_braces} missing closing braces to JSON")
-                    
-                    if opening_brackets > closing_brackets:
-                        json_text += ']' * (opening_brackets - closing_brackets)
-                        print(f"Added {opening_brackets - closing_brackets} missing closing brackets to JSON")
-                    
-                    prep_plan = json.loads(json_text, strict=False)
-                    print("Successfully extracted and parsed JSON after repair.")
-                except json.JSONDecodeError as e_inner:
-                    print(f"Prep plan JSON decoding error after extraction and repair: {e_inner}. Response text slice: {json_text[:1000]}")
-                    raise ValueError(f"Valid JSON object not found or parsable in prep plan response: {response_content[:1000]}") from e_inner
-            else:
-                 raise ValueError(f"Valid JSON object markers not found in prep plan response: {response_content[:1000]}")
-
-        # --- Validation and Cleanup ---
-        if not isinstance(prep_plan, dict):
-             raise ValueError("Extracted content is not a JSON object.")
-
-        prep_plan.setdefault("focusAreas", [])
-        prep_plan.setdefault("likelyQuestions", [])
-        
-        # Update the conceptsToStudy initialization to match the new structure
-        if "conceptsToStudy" not in prep_plan or not isinstance(prep_plan["conceptsToStudy"], dict):
-            prep_plan["conceptsToStudy"] = {
-                "fundamentals": [],
-                "advanced": [],
-                "technologies": [],
-                "methodologies": []
-            }
-        else:
-            # Ensure all required fields exist
-            prep_plan["conceptsToStudy"].setdefault("fundamentals", [])
-            prep_plan["conceptsToStudy"].setdefault("advanced", [])
-            prep_plan["conceptsToStudy"].setdefault("technologies", [])
-            prep_plan["conceptsToStudy"].setdefault("methodologies", [])
-            
-        prep_plan.setdefault("gapStrategies", [])
-
-        # Ensure no timeline sneaked in
-        if "preparationTimeline" in prep_plan:
-            del prep_plan["preparationTimeline"]
-            print("Warning: Removed 'preparationTimeline' found in response.")
+        # --- Validation and Cleanup (also strips any 'preparationTimeline' the model added) ---
+        prep_plan, _ = validate_llm_response('prep_plan', prep_plan)
 
         # Validate question count and rough mix (optional but good)
         q_count = len(prep_plan.get("likelyQuestions", []))
@@ -834,10 +2746,7 @@ MANDATORY INSTRUCTIONS:
         print(f"Prep plan (no timeline) generated successfully. Questions: {q_count}")
         return prep_plan
 
-    except json.JSONDecodeError as e: # Catch errors from the primary attempt if extraction wasn't needed
-        print(f"Prep plan JSON decoding error: {e}. Full response: {response_content[:1000]}")
-        raise Exception("Claude API returned invalid JSON for prep plan.") from e
-    except ValueError as e: # Catch errors from extraction/validation logic
+    except ValueError as e: # Catch errors from validation logic
         print(f"Prep plan generation error: {e}")
         # Optionally re-raise or return error structure
         raise Exception(f"Failed to generate valid prep plan JSON: {str(e)}") from e
@@ -885,7 +2794,7 @@ def generate_dynamic_timeline_with_openai(session_data, days):
         if isinstance(concepts_to_study, list):
             concepts_str = "- " + "\n- ".join(concepts_to_study) if concepts_to_study else "N/A"
         elif isinstance(concepts_to_study, dict):
-             concepts_str = json.dumps(concepts_to_study, indent=2)
+             concepts_str = serialize_prompt_context(concepts_to_study, 750, 'timeline.concepts')
         else:
              concepts_str = str(concepts_to_study) if concepts_to_study else "N/A"
 
@@ -922,11 +2831,11 @@ The candidate, {candidate_name}, is interviewing for a {job_title} position and
 Key Context for Planning:
 * Preparation Duration: {days} days until the interview.
 * Priority Focus Areas:
-{focus_areas_str[:1000]}
+{truncate_to_token_budget(focus_areas_str, 250, OPENAI_MODEL)}
 * Specific {"Legal Concepts/Indian Statutes" if is_law_domain else "Concepts/Tools"} to Master:
-{concepts_str[:2000]}
+{truncate_to_token_budget(concepts_str, 500, OPENAI_MODEL)}
 * Identified {"Legal Knowledge" if is_law_domain else "Skill"} Gaps to Address:
-{gaps_str[:1000]}
+{truncate_to_token_budget(gaps_str, 250, OPENAI_MODEL)}
 
 Instructions: Create a detailed, day-by-day timeline from Day 1 to Day {days}, plus a final "Interview Day" plan.
 Output ONLY a valid JSON object with the following structure:
@@ -959,59 +2868,26 @@ CRITICAL REQUIREMENTS:
     # --- End of Modified Prompt ---
 
     try:
-        result_text = call_openai_api(prompt=prompt, model=OPENAI_MODEL, temperature=0.5) # Assume call_openai_api exists
-
-        # Clean potential markdown backticks
-        if result_text.strip().startswith("```json"): result_text = result_text.strip()[7:]
-        if result_text.strip().endswith("```"): result_text = result_text.strip()[:-3]
-
-        # --- Robust JSON Parsing ---
-        timeline_data = {}
+        # --- Structured output (JSON schema response_format) ---
         try:
-            timeline_data = json.loads(result_text.strip(), strict=False)
-        except json.JSONDecodeError as e_inner:
-             print(f"OpenAI timeline JSON decoding error: {e_inner}. Response text (partial): {result_text[:1000]}")
-             # Try to find JSON block if direct parse failed
-             json_start = result_text.find('{')
-             json_end = result_text.rfind('}') + 1
-             if json_start != -1 and json_end != -1 and json_end > json_start:
-                 json_text_extracted = result_text[json_start:json_end].strip()
-                 try:
-                     timeline_data = json.loads(json_text_extracted, strict=False)
-                     print("Successfully parsed JSON after finding block.")
-                 except json.JSONDecodeError as e_retry:
-                     print(f"JSON decoding failed even after extracting block: {e_retry}. Extracted text (partial): {json_text_extracted[:1000]}")
-                     # Set error state if retry fails
-                     timeline_data = {"timeline": [], "error": f"Failed to parse timeline JSON after extraction: {e_retry}"}
-             else:
-                # Set error state if no JSON block found
-                timeline_data = {"timeline": [], "error": f"Failed to parse timeline JSON, no valid block found: {e_inner}"}
+            timeline_data = call_openai_api(prompt=prompt, model=OPENAI_MODEL, temperature=0.5, response_schema='timeline', feature='timeline')
+        except ValueError as e_extract:
+            print(f"OpenAI timeline JSON decoding error: {e_extract}")
+            return {"timeline": [], "error": f"Failed to parse timeline JSON: {e_extract}"}
 
         # --- Validation ---
-        if not isinstance(timeline_data, dict) or "timeline" not in timeline_data:
-            print("Error: 'timeline' key missing or root is not an object in OpenAI response.")
-            # Ensure error key exists if structure is wrong
+        try:
+            timeline_data, violations = validate_llm_response('timeline', timeline_data)
+        except ValueError as e_schema:
+            print(f"Error: {e_schema}")
+            return {"timeline": [], "error": "Generated timeline structure was invalid."}
+
+        if any(field_path == 'timeline' for field_path, _ in violations):
+            print("Error: 'timeline' key missing or not a list in OpenAI response.")
             timeline_data.setdefault("error", "Generated timeline structure was invalid.")
-            timeline_data["timeline"] = [] # Ensure timeline key exists as list even on error
-        elif not isinstance(timeline_data.get("timeline"), list):
-             print("Warning: 'timeline' key exists but is not a list in OpenAI response.")
-             timeline_data["timeline"] = [] # Reset to list if type is wrong
-             timeline_data.setdefault("error", "'timeline' field was not a list.")
         else:
-             # Optional: Deeper validation of timeline items
-             for i, day_plan in enumerate(timeline_data["timeline"]):
-                 if not isinstance(day_plan, dict) or "day" not in day_plan or "schedule" not in day_plan or not isinstance(day_plan.get("schedule"), list):
-                     print(f"Warning: Invalid structure for timeline entry at index {i}. Day plan: {day_plan}")
-                     # Could potentially remove invalid entries or mark them
-
-             print(f"Dynamic timeline generated successfully ({len(timeline_data.get('timeline', []))} entries).")
-             # Clear error if validation passes
-             timeline_data.pop("error", None)
-
-        # Ensure estimated_total_hours is handled correctly
-        if "estimated_total_hours" in timeline_data and not isinstance(timeline_data["estimated_total_hours"], int):
-             print(f"Warning: 'estimated_total_hours' is not an integer. Removing.")
-             timeline_data.pop("estimated_total_hours", None)
+            print(f"Dynamic timeline generated successfully ({len(timeline_data['timeline'])} entries).")
+            timeline_data.pop("error", None)
 
         return timeline_data
 
@@ -1216,19 +3092,19 @@ You are IRIS, an AI Interviewer. Your ONLY role is to conduct a realistic, struc
 def analyze_interview_performance(interview_transcript, job_requirements, resume_data):
     """Analyzes the interview transcript using Claude."""
     print("--- Starting Interview Analysis (Stricter Prompt Version) ---")
-    response_content = ""
-    json_text_raw = ""
     try:
-        job_req_str = json.dumps(job_requirements, indent=2)
-        resume_str = json.dumps(resume_data, indent=2)
+        job_req_str = serialize_prompt_context(job_requirements, 500, 'interview_analysis.requirements', legacy_char_limit=2000)
+        resume_str = serialize_prompt_context(resume_data, 1250, 'interview_analysis.resume', legacy_char_limit=5000)
         transcript_length = len(interview_transcript)
         system_prompt = f"""
 You are an expert interview coach providing DETAILED and HONEST analysis of a mock interview transcript based PRIMARILY on the interaction recorded.
-Job Requirements: {job_req_str[:2000]}
-Candidate Resume (Context ONLY): {resume_str[:5000]}
+Job Requirements:
+{job_req_str}
+Candidate Resume (Context ONLY):
+{resume_str}
 Interview Transcript (Length: {transcript_length} chars):
 --- BEGIN TRANSCRIPT ---
-{interview_transcript[:20000]}
+{truncate_to_token_budget(interview_transcript, 5000, CLAUDE_MODEL)}
 --- END TRANSCRIPT ---
 
 **VERY IMPORTANT SCORING:** Base scores (`technicalAssessment`, `communicationAssessment`, `behavioralAssessment`) PRIMARILY on transcript evidence. Do NOT give high scores just based on the resume if the transcript lacks proof. If transcript interaction is minimal, scores MUST be low (0-30 range). State limitations in `overallAssessment` if transcript is short.
@@ -1249,34 +3125,13 @@ Create analysis as a JSON object ONLY with this exact structure (no extra text):
 }}
 """
         messages = [{"role": "user", "content": "Analyze my interview performance based *primarily* on the provided transcript interaction."}]
-        response_content = call_claude_api(
+        analysis = call_claude_api( # Structured output via tool use, returns a dict
             messages=messages, system_prompt=system_prompt, model=CLAUDE_MODEL,
-            max_tokens=4096, temperature=0.4
+            max_tokens=4096, temperature=0.4, response_schema='interview_analysis', feature='interview_analysis'
         )
-        json_start = response_content.find('{')
-        json_end = response_content.rfind('}') + 1
-        if json_start != -1 and json_end != -1 and json_end > json_start:
-            json_text_raw = response_content[json_start:json_end].strip()
-            analysis = json.loads(json_text_raw, strict=False)
-            print("Interview analysis generated successfully.")
-            # Basic validation can be added here if needed
-            analysis.setdefault("overallScore", 0)
-            analysis.setdefault("overallAssessment", "[Analysis Error]")
-            analysis.setdefault("technicalAssessment", {"score": 0, "strengths": [], "weaknesses": [], "feedback": ""})
-            analysis.setdefault("communicationAssessment", {"score": 0, "strengths": [], "weaknesses": [], "feedback": ""})
-            analysis.setdefault("behavioralAssessment", {"score": 0, "strengths": [], "weaknesses": [], "feedback": ""})
-            analysis.setdefault("specificFeedback", [])
-            analysis.setdefault("keyImprovementAreas", [])
-            return analysis
-        else:
-            raise ValueError(f"Valid JSON object not found in analysis response: {response_content[:1000]}")
-    except json.JSONDecodeError as e:
-        error_pos = getattr(e, 'pos', '?')
-        error_msg = getattr(e, 'msg', 'Unknown JSON error')
-        print(f"*** JSON Decode Error during analysis: {error_msg} at position {error_pos}")
-        log_text = json_text_raw if json_text_raw else response_content
-        print(f"--- Raw Text Failed Parsing (partial) ---\n{log_text[:2000]}\n------------------------------------")
-        raise Exception("Failed to parse valid interview analysis JSON.") from e
+        analysis, _ = validate_llm_response('interview_analysis', analysis)
+        print("Interview analysis generated successfully.")
+        return analysis
     except Exception as e:
         print(f"Error during interview analysis generation: {e}")
         traceback.print_exc()
@@ -1294,14 +3149,12 @@ def generate_suggested_answers(transcript, resume_data, job_data):
         "yearsOfExperience": resume_data.get("yearsOfExperience", ""),
         "technicalSkills": resume_data.get("technicalSkills", [])[:5]  # Limit skills
     }
-    resume_str = json.dumps(resume_summary, indent=2)
 
     # Extract only required job information
     job_req_summary = {
         "jobTitle": job_data.get("jobRequirements", {}).get("jobTitle", ""),
         "requiredSkills": job_data.get("jobRequirements", {}).get("requiredSkills", [])[:5]
     }
-    job_req_str = json.dumps(job_req_summary, indent=2)
 
     # Extract actual questions from the transcript by analyzing blocks of text
     interviewer_questions = []
@@ -1372,7 +3225,7 @@ Interview Context:
 - Skills Required: {", ".join(job_req_summary.get("requiredSkills", []))}
 
 Interview Questions:
-{json.dumps(batch_questions, indent=2)}
+{serialize_prompt_context(batch_questions, 2000, 'suggested_answers.questions')}
 
 For each question, provide ONLY ONE better sample answer. Format as valid JSON with NO control characters:
 {{
@@ -1398,65 +3251,46 @@ Return ONLY valid JSON with NO additional text before or after. IMPORTANT: Do NO
                 system_prompt=system_prompt,
                 model=CLAUDE_MODEL,
                 max_tokens=8000,  # Within Claude 3.5 Sonnet's limit (8192)
-                temperature=0.4    
+                temperature=0.4,
+                feature='suggested_answers'
             )
 
             print(f"Received response for batch {batch_num}, length: {len(response_content)} chars")
-            response_text = response_content.strip()
-
-            # Handle markdown code blocks
-            if response_text.startswith('```json'):
-                response_text = response_text[7:]
-            if response_text.endswith('```'):
-                response_text = response_text[:-3]
-            response_text = response_text.strip()
-
-            # Fallback find {} block if needed
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            if json_start >= 0 and json_end > json_start:
-                json_text = response_text[json_start:json_end].strip()
-                print(f"Extracted JSON from response, length: {len(json_text)} chars")
-            else:
-                print(f"Failed to extract JSON object for batch {batch_num}, response starts with: {response_text[:100]}...")
+            # Per-field sanitizing happens below; sanitizing the raw text would corrupt escaped quotes
+            try:
+                raw_parsed_data, repairs = extract_json_from_llm_response(response_content)
+                if repairs: print(f"Repaired JSON for batch {batch_num}: {'; '.join(repairs)}")
+                print(f"Successfully parsed JSON for batch {batch_num}")
+            except ValueError as e:
+                print(f"JSON extraction error for batch {batch_num}: {e}")
+                print(f"Problematic response (first 200 chars): {response_content[:200]}...")
                 continue
 
-            # Aggressive sanitization of the entire JSON string before parsing
-            sanitized_json_text = sanitize_string_for_json(json_text)
-            
             try:
-                # First try to parse the sanitized JSON
-                raw_parsed_data = json.loads(sanitized_json_text)
-                print(f"Successfully parsed JSON for batch {batch_num}")
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error for batch {batch_num}: {e}")
-                print(f"Problematic JSON (first 200 chars): {sanitized_json_text[:200]}...")
+                parsed_data, violations = validate_llm_response('suggested_answers', raw_parsed_data)
+            except ValueError as e:
+                print(f"Invalid suggested answers structure for batch {batch_num}: {e}")
+                continue
+            if any(field_path == 'suggestedAnswers' for field_path, _ in violations):
+                print(f"No 'suggestedAnswers' found in response for batch {batch_num}")
                 continue
 
-            # Add answers from this batch to the full list
+            # Add answers from this batch to the full list, keeping only the first suggestion per question
             answers_count = 0
-            if "suggestedAnswers" in raw_parsed_data and isinstance(raw_parsed_data.get("suggestedAnswers"), list):
-                for qa_item in raw_parsed_data["suggestedAnswers"]:
-                    sanitized_qa = {}
-                    sanitized_qa["question"] = sanitize_string_for_json(qa_item.get("question"))
-
-                    sanitized_suggestions = []
-                    # Ensure suggestions exist and keep only the first one
-                    suggestions = qa_item.get("suggestions", [])
-                    if suggestions and isinstance(suggestions, list):
-                        first_suggestion = suggestions[0]
-                        if isinstance(first_suggestion, dict):
-                            sanitized_suggestions.append({
-                                "answer": sanitize_string_for_json(first_suggestion.get("answer")),
-                                "rationale": sanitize_string_for_json(first_suggestion.get("rationale"))
-                            })
-                            answers_count += 1
-
-                    sanitized_qa["suggestions"] = sanitized_suggestions
-                    all_suggested_answers.append(sanitized_qa)
-                print(f"Added {answers_count} answers from batch {batch_num}")
-            else:
-                print(f"No 'suggestedAnswers' found in response for batch {batch_num}")
+            for qa_item in parsed_data["suggestedAnswers"]:
+                sanitized_suggestions = []
+                if qa_item["suggestions"]:
+                    first_suggestion = qa_item["suggestions"][0]
+                    sanitized_suggestions.append({
+                        "answer": sanitize_string_for_json(first_suggestion["answer"]),
+                        "rationale": sanitize_string_for_json(first_suggestion["rationale"])
+                    })
+                    answers_count += 1
+                all_suggested_answers.append({
+                    "question": sanitize_string_for_json(qa_item["question"]),
+                    "suggestions": sanitized_suggestions
+                })
+            print(f"Added {answers_count} answers from batch {batch_num}")
 
         except Exception as e:
             print(f"Error processing batch {batch_num}: {e}")
@@ -1481,11 +3315,12 @@ Return ONLY valid JSON with NO additional text before or after. IMPORTANT: Do NO
 def rewrite_resume_section(resume_data, job_description, section_to_improve):
     """Rewrites a specific section of the resume to better match the job description."""
     if not CLAUDE_API_KEY: raise ValueError("Claude API Key not configured.")
-    resume_str = json.dumps(resume_data, indent=2)
+    resume_str = serialize_prompt_context(resume_data, 2500, 'section_rewrite', legacy_char_limit=10000)
     system_prompt = f"""
 You are an expert resume writer improving the "{section_to_improve}" section of a resume for a specific job.
-Resume Data: {resume_str[:10000]}
-Job Description: {job_description[:10000]}
+Resume Data:
+{resume_str}
+Job Description: {truncate_to_token_budget(job_description, 2500, CLAUDE_MODEL)}
 Section to Improve: {section_to_improve}
 
 Rewrite the {section_to_improve} section to be aligned with job requirements, use action verbs, quantify achievements, and be ATS-friendly.
@@ -1500,14 +3335,9 @@ No additional explanation.
     messages = [{"role": "user", "content": f"Please rewrite the {section_to_improve} section."}]
     response_content = ""
     try:
-        response_content = call_claude_api(messages=messages, system_prompt=system_prompt, model=CLAUDE_MODEL)
-        json_start = response_content.find('{')
-        json_end = response_content.rfind('}') + 1
-        if json_start >= 0 and json_end > json_start:
-            json_text = response_content[json_start:json_end]
-            rewrite_result = json.loads(json_text)
-        else: # Fallback
-             rewrite_result = json.loads(response_content)
+        response_content = call_claude_api(messages=messages, system_prompt=system_prompt, model=CLAUDE_MODEL, feature='section_rewrite')
+        rewrite_result, repairs = extract_json_from_llm_response(response_content)
+        if repairs: print(f"Repaired resume rewrite JSON: {'; '.join(repairs)}")
         print(f"Resume section '{section_to_improve}' rewritten successfully.")
         return rewrite_result
     except json.JSONDecodeError as e:
@@ -1530,6 +3360,124 @@ def get_duration(start_time_str, end_time_str):
     except Exception: return "N/A"
 
 
+# --- Plan Limits (loaded once at startup, read-only) ---
+PACKAGE_LIMITS = MappingProxyType({
+    'free': MappingProxyType({
+        'resumeAnalyses': 1,
+        'mockInterviews': 0,
+        'pdfDownloads': 5,
+        'aiEnhance': 5
+    }),
+    'starter': MappingProxyType({
+        'resumeAnalyses': 5,
+        'mockInterviews': 1,
+        'pdfDownloads': 20,
+        'aiEnhance': 20
+    }),
+    'standard': MappingProxyType({
+        'resumeAnalyses': 10,
+        'mockInterviews': 3,
+        'pdfDownloads': 50,
+        'aiEnhance': 50
+    }),
+    'pro': MappingProxyType({
+        'resumeAnalyses': 20,
+        'mockInterviews': 5,
+        'pdfDownloads': 100,
+        'aiEnhance': 100
+    })
+})
+VALID_PLANS = tuple(PACKAGE_LIMITS.keys())
+USAGE_FEATURES = tuple(PACKAGE_LIMITS['free'].keys())
+
+# Short-lived per-user quota snapshots so read-only endpoints can skip Firestore
+QUOTA_CACHE_TTL_SECONDS = int(os.environ.get('QUOTA_CACHE_TTL_SECONDS', 30))
+_quota_snapshot_cache = {} # user_id -> (expires_at, snapshot)
+_quota_snapshot_lock = threading.Lock()
+
+
+def get_package_limit(package_name, feature_type):
+    """Returns the limit for a specific feature based on package type."""
+    # Default to free package if not found
+    if not package_name or package_name not in PACKAGE_LIMITS:
+        print(f"Warning: Unknown package '{package_name}', defaulting to free")
+        package_name = 'free'
+
+    # Return the limit for the feature, or 0 if feature not found
+    return PACKAGE_LIMITS[package_name].get(feature_type, 0)
+
+
+def build_quota_snapshot(user_data):
+    """Builds a quota snapshot (plan + usage with defaults filled in memory) from a user document."""
+    plan = user_data.get('plan', 'free')
+    stored_usage = user_data.get('usage') or {}
+    usage = {}
+    for feature_type in USAGE_FEATURES:
+        feature_usage = stored_usage.get(feature_type) or {}
+        usage[feature_type] = {
+            'used': feature_usage.get('used', 0),
+            'limit': feature_usage.get('limit', get_package_limit(plan, feature_type))
+        }
+    return {
+        'plan': plan,
+        'planPurchasedAt': user_data.get('planPurchasedAt'),
+        'planExpiresAt': user_data.get('planExpiresAt'),
+        'usage': usage
+    }
+
+
+def cache_quota_snapshot(user_id, snapshot):
+    """Stores a quota snapshot for user_id for QUOTA_CACHE_TTL_SECONDS."""
+    if not user_id or snapshot is None: return
+    with _quota_snapshot_lock:
+        _quota_snapshot_cache[user_id] = (time.time() + QUOTA_CACHE_TTL_SECONDS, snapshot)
+
+
+def update_cached_quota_usage(user_id, feature_type, used, limit):
+    """Applies a known post-write usage value to a cached snapshot (no-op if not cached)."""
+    with _quota_snapshot_lock:
+        entry = _quota_snapshot_cache.get(user_id)
+        if entry and entry[0] > time.time():
+            entry[1]['usage'][feature_type] = {'used': used, 'limit': limit}
+
+
+def invalidate_quota_snapshot(user_id):
+    """Drops the cached quota snapshot after writes that change plan or limits."""
+    with _quota_snapshot_lock:
+        _quota_snapshot_cache.pop(user_id, None)
+
+
+def get_quota_snapshot(user_id):
+    """
+    Returns the cached quota snapshot for a user, or reads the user document once
+    (without writing back default structures) and caches the result.
+    Returns None if the user is not found or the database is unavailable.
+    """
+    if not user_id: return None
+    with _quota_snapshot_lock:
+        entry = _quota_snapshot_cache.get(user_id)
+        if entry and entry[0] > time.time():
+            return copy.deepcopy(entry[1])
+    if not db: return None
+
+    try:
+        user_doc = db.collection('users').document(user_id).get()
+        if not user_doc.exists:
+            print(f"User {user_id} not found in Firestore")
+            return None
+        snapshot = build_quota_snapshot(user_doc.to_dict() or {})
+        snapshot['unshardedUsed'] = {} # user-doc part of each sharded total, for consume_sharded_quota's exact check
+        for feature_type in SHARDED_USAGE_FEATURES:
+            snapshot['unshardedUsed'][feature_type] = snapshot['usage'][feature_type]['used']
+            snapshot['usage'][feature_type]['used'] += get_sharded_usage_total(user_id, feature_type)
+        cache_quota_snapshot(user_id, snapshot)
+        return copy.deepcopy(snapshot)
+    except Exception as e:
+        print(f"Error retrieving quota snapshot for {user_id}: {e}")
+        traceback.print_exc()
+        return None
+
+
 def get_user_usage(user_id):
     """Retrieves user profile including usage data from Firestore. Ensures default structure exists."""
     if not db or not user_id:
@@ -1599,46 +3547,16 @@ def get_user_usage(user_id):
     except Exception as e:
         print(f"Error retrieving user usage for {user_id}: {e}")
         traceback.print_exc()
-        return None
-
-
-def get_package_limit(package_name, feature_type):
-    """Returns the limit for a specific feature based on package type."""
-    limits = {
-        'free': {
-            'resumeAnalyses': 1,
-            'mockInterviews': 0
-        },
-        'starter': {
-            'resumeAnalyses': 5,
-            'mockInterviews': 1
-        },
-        'standard': {
-            'resumeAnalyses': 10,
-            'mockInterviews': 3
-        },
-        'pro': {
-            'resumeAnalyses': 20,
-            'mockInterviews': 5
-        }
-    }
-    
-    # Default to free package if not found
-    if not package_name or package_name not in limits:
-        print(f"Warning: Unknown package '{package_name}', defaulting to free")
-        package_name = 'free'
-    
-    # Return the limit for the feature, or 0 if feature not found
-    return limits[package_name].get(feature_type, 0)
+        return None
 
 
 def check_feature_access(user_id, feature_type):
-    """Checks if a user has access to a specific feature based on their plan."""
+    """Checks if a user has access to a specific feature based on their plan (read-only, cached)."""
     if not db or not user_id:
         return {'allowed': False, 'error': 'Database or user ID not available'}
     
     try:
-        user_data = get_user_usage(user_id)
+        user_data = get_quota_snapshot(user_id)
         
         if not user_data:
             return {'allowed': False, 'error': 'User profile not found'}
@@ -1698,6 +3616,7 @@ def increment_usage_counter(user_id, feature_type):
         updated_user = user_ref.get().to_dict()
         current_usage = updated_user.get('usage', {}).get(feature_type, {}).get('used', 0)
         usage_limit = updated_user.get('usage', {}).get(feature_type, {}).get('limit', 0)
+        invalidate_quota_snapshot(user_id)
         
         return {
             'success': True,
@@ -1711,38 +3630,283 @@ def increment_usage_counter(user_id, feature_type):
         traceback.print_exc()
         return {'success': False, 'error': f'Server error: {str(e)}'}
 
+
+def consume_quota(user_id, feature_type, amount=1):
+    """
+    Checks and consumes usage quota for a feature in a single Firestore transaction.
+    Replaces the check_feature_access + increment_usage_counter pair (up to five round
+    trips, not atomic) so concurrent requests cannot over-consume a limit.
+    Returns {'allowed': True/False, 'used': N, 'limit': M, 'remaining': X, 'plan': P}
+    plus 'error' (and 'limitReached' when the limit is the reason) if not allowed.
+    """
+    if not db or not user_id:
+        return {'allowed': False, 'error': 'Database or user ID not available'}
+
+    try:
+        user_ref = db.collection('users').document(user_id)
+        transaction = db.transaction()
+
+        @firestore.transactional
+        def consume_in_transaction(transaction, user_ref):
+            snapshot = user_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return {'allowed': False, 'error': 'User profile not found'}
+
+            user_data = snapshot.to_dict() or {}
+            plan = user_data.get('plan', 'free')
+            usage = (user_data.get('usage') or {}).get(feature_type) or {}
+            currently_used = usage.get('used', 0)
+            # Same default get_user_usage would have written for a missing structure
+            limit = usage.get('limit', get_package_limit(plan, feature_type))
+
+            if currently_used + amount > limit:
+                return {
+                    'allowed': False,
+                    'limitReached': True,
+                    'error': f"Usage limit reached for {feature_type}",
+                    'used': currently_used,
+                    'limit': limit,
+                    'remaining': max(0, limit - currently_used),
+                    'plan': plan
+                }
+
+            new_used = currently_used + amount
+            if 'used' in usage and 'limit' in usage:
+                transaction.update(user_ref, {f'usage.{feature_type}.used': new_used})
+            else:
+                # Initialize/fix the structure in the same write
+                transaction.update(user_ref, {f'usage.{feature_type}': {'used': new_used, 'limit': limit}})
+
+            return {
+                'allowed': True,
+                'used': new_used,
+                'limit': limit,
+                'remaining': max(0, limit - new_used),
+                'plan': plan
+            }
+
+        result = consume_in_transaction(transaction, user_ref)
+        if result.get('allowed'):
+            update_cached_quota_usage(user_id, feature_type, result['used'], result['limit'])
+        return result
+
+    except Exception as e:
+        print(f"Error consuming quota for {user_id} ({feature_type}): {e}")
+        traceback.print_exc()
+        return {'allowed': False, 'error': f'Server error: {str(e)}'}
+
+
+# --- Sharded Usage Counters ---
+# High-frequency resume builder features are counted in N shard documents under
+# users/{userId}/usageCounters/{feature}/shards/{i} instead of one field on the user doc.
+# Total used = usage.{feature}.used on the user doc (legacy client increments) + sum of shards.
+# The web client no longer increments these features itself: /enhance-resume-content and /record-feature-usage charge them.
+# Only increase USAGE_COUNTER_SHARDS: plan resets zero shards 0..N-1 only.
+# Charges more than SHARDED_QUOTA_EXACT_MARGIN units below the limit are a single blind shard write; closer to the
+# limit, a transaction reads every shard before writing, so concurrent requests for the last units cannot overshoot.
+SHARDED_USAGE_FEATURES = ('aiEnhance', 'pdfDownloads')
+USAGE_COUNTER_SHARDS = max(1, int(os.environ.get('USAGE_COUNTER_SHARDS', 5)))
+SHARDED_QUOTA_EXACT_MARGIN = int(os.environ.get('SHARDED_QUOTA_EXACT_MARGIN', 10))
+
+
+def usage_shard_refs(user_ref, feature_type):
+    """Returns the document references of all configured shards for a feature."""
+    shards_collection = user_ref.collection('usageCounters').document(feature_type).collection('shards')
+    return [shards_collection.document(str(i)) for i in range(USAGE_COUNTER_SHARDS)]
+
+
+def get_sharded_usage_total(user_id, feature_type):
+    """Sums all shard counts for a feature (one collection read). Returns 0 on error."""
+    if not db or not user_id: return 0
+    try:
+        shards = (db.collection('users').document(user_id)
+                  .collection('usageCounters').document(feature_type).collection('shards').stream())
+        return sum((shard.to_dict() or {}).get('used', 0) for shard in shards)
+    except Exception as e:
+        print(f"Error aggregating usage shards for {user_id} ({feature_type}): {e}")
+        return 0
+
+
+def increment_sharded_usage(user_id, feature_type, amount=1):
+    """Increments a random shard of a feature's usage counter (single write, no reads). Returns the shard ref or None."""
+    if not db or not user_id: return None
+    try:
+        user_ref = db.collection('users').document(user_id)
+        shard_ref = random.choice(usage_shard_refs(user_ref, feature_type))
+        shard_ref.set({'used': firestore.Increment(amount)}, merge=True)
+        return shard_ref
+    except Exception as e:
+        print(f"Error incrementing usage shard for {user_id} ({feature_type}): {e}")
+        traceback.print_exc()
+        return None
+
+
+def consume_usage_shards_exactly(user_id, feature_type, amount, limit, unsharded_used):
+    """
+    Transactionally sums all shards and increments one if `unsharded_used` + shards + amount stays within `limit`.
+    Returns (allowed, used) where used is the total after the charge (or the current total when denied).
+    """
+    user_ref = db.collection('users').document(user_id)
+    shard_refs = usage_shard_refs(user_ref, feature_type)
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def charge_in_transaction(transaction):
+        used = unsharded_used + sum((shard_ref.get(transaction=transaction).to_dict() or {}).get('used', 0)
+                                    for shard_ref in shard_refs)
+        if used + amount > limit:
+            return False, used
+        transaction.set(random.choice(shard_refs), {'used': firestore.Increment(amount)}, merge=True)
+        return True, used + amount
+
+    return charge_in_transaction(transaction)
+
+
+def refund_sharded_quota(user_id, feature_type, amount=1):
+    """Gives back `amount` units charged by consume_sharded_quota for work that was not delivered."""
+    if amount <= 0 or not increment_sharded_usage(user_id, feature_type, -amount):
+        return False
+    invalidate_quota_snapshot(user_id)
+    print(f"Refunded {amount} {feature_type} unit(s) to {user_id}.")
+    return True
+
+
+def reset_usage_shards(writer, user_ref):
+    """Zeroes all sharded usage counters as part of a plan reset (writer: transaction or write batch)."""
+    for feature_type in SHARDED_USAGE_FEATURES:
+        for shard_ref in usage_shard_refs(user_ref, feature_type):
+            writer.set(shard_ref, {'used': 0})
+
+
+def consume_sharded_quota(user_id, feature_type, amount=1):
+    """
+    Checks a sharded feature against the cached quota snapshot and increments one shard. Within
+    SHARDED_QUOTA_EXACT_MARGIN units of the limit the check and increment run in one transaction over all shards.
+    Returns the same shape as consume_quota.
+    """
+    snapshot = get_quota_snapshot(user_id)
+    if not snapshot:
+        return {'allowed': False, 'error': 'User profile not found'}
+
+    plan = snapshot.get('plan', 'free')
+    usage = snapshot['usage'].get(feature_type, {'used': 0, 'limit': 0})
+    currently_used, limit = usage.get('used', 0), usage.get('limit', 0)
+    if currently_used + amount > limit:
+        return {
+            'allowed': False,
+            'limitReached': True,
+            'error': f"Usage limit reached for {feature_type}",
+            'used': currently_used,
+            'limit': limit,
+            'remaining': max(0, limit - currently_used),
+            'plan': plan
+        }
+
+    unsharded_used = (snapshot.get('unshardedUsed') or {}).get(feature_type)
+    if currently_used + amount > limit - SHARDED_QUOTA_EXACT_MARGIN and unsharded_used is not None:
+        try:
+            allowed, new_used = consume_usage_shards_exactly(user_id, feature_type, amount, limit, unsharded_used)
+        except Exception as e:
+            print(f"Error charging usage shards for {user_id} ({feature_type}): {e}")
+            traceback.print_exc()
+            return {'allowed': False, 'error': 'Failed to update usage counter'}
+        if not allowed:
+            update_cached_quota_usage(user_id, feature_type, new_used, limit)
+            return {
+                'allowed': False,
+                'limitReached': True,
+                'error': f"Usage limit reached for {feature_type}",
+                'used': new_used,
+                'limit': limit,
+                'remaining': max(0, limit - new_used),
+                'plan': plan
+            }
+    else:
+        if increment_sharded_usage(user_id, feature_type, amount) is None:
+            return {'allowed': False, 'error': 'Failed to update usage counter'}
+        new_used = currently_used + amount
+
+    update_cached_quota_usage(user_id, feature_type, new_used, limit)
+    return {
+        'allowed': True,
+        'used': new_used,
+        'limit': limit,
+        'remaining': max(0, limit - new_used),
+        'plan': plan
+    }
+
 # Helper function to sanitize strings for JSON embedding
+# Translate table precomputed once: control characters (0-31) and DEL (127) are removed,
+# except newline/tab/carriage return which become spaces; backslashes are doubled.
+_JSON_SANITIZE_TABLE = {code: None for code in range(32)}
+_JSON_SANITIZE_TABLE.update({ord('\n'): ' ', ord('\t'): ' ', ord('\r'): ' ', 127: None, ord('\\'): '\\\\'})
+
 def sanitize_string_for_json(text):
-    """Thoroughly removes or escapes control characters problematic for JSON."""
+    """Thoroughly removes or escapes control characters problematic for JSON (single linear pass)."""
     if not isinstance(text, str):
         return text  # Return non-strings as is
-    
-    # More aggressive control character handling - catches all JSON-breaking characters
-    # Remove all control characters (0-31) plus DEL (127)
-    cleaned_text = ''
-    for char in text:
-        # Skip all control characters completely
-        if ord(char) >= 32 and ord(char) != 127:
-            cleaned_text += char
-        elif char in ['\n', '\t', '\r']:
-            # Replace common whitespace with spaces instead of removing
-            cleaned_text += ' '
-    
-    # Additional safety for quote handling
-    cleaned_text = cleaned_text.replace('\\', '\\\\')  # Escape backslashes first
-    
-    # Double-check for any remaining invalid characters
-    checked_text = ''
-    for char in cleaned_text:
-        if 31 < ord(char) < 127 or ord(char) > 127:
-            checked_text += char
-        else:
-            checked_text += ' '  # Replace any remaining control chars with space
-    
-    return checked_text.strip()  # Remove leading/trailing whitespace
+
+    return text.translate(_JSON_SANITIZE_TABLE).strip()  # Remove leading/trailing whitespace
+
+# --- Enhancement Result Cache ---
+# Bump ENHANCEMENT_PROMPT_VERSION whenever the prompts below change so stale results are not served.
+ENHANCEMENT_PROMPT_VERSION = "v1"
+ENHANCEMENT_CACHE_MAX_ENTRIES = int(os.environ.get('ENHANCEMENT_CACHE_MAX_ENTRIES', 2000))
+ENHANCEMENT_CACHE_TTL_SECONDS = int(os.environ.get('ENHANCEMENT_CACHE_TTL_SECONDS', 86400))
+_enhancement_cache = OrderedDict() # key -> (expires_at, cleaned enhanced content), LRU order
+_enhancement_cache_stats = {} # section_type -> {'hits': N, 'misses': M}
+_enhancement_cache_lock = threading.Lock()
+
+
+def enhancement_cache_key(section_type, original_content):
+    """Builds the cache key from section type, normalized content, model and prompt version."""
+    normalized_content = " ".join(str(original_content).split())
+    key_material = json.dumps([section_type, normalized_content, CLAUDE_HAIKU_MODEL, ENHANCEMENT_PROMPT_VERSION])
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+
+def get_cached_enhancement(section_type, original_content):
+    """Returns the cached enhanced content (or None) and records a hit/miss for the section type."""
+    key = enhancement_cache_key(section_type, original_content)
+    with _enhancement_cache_lock:
+        stats = _enhancement_cache_stats.setdefault(section_type, {'hits': 0, 'misses': 0})
+        entry = _enhancement_cache.get(key)
+        if entry and entry[0] > time.time():
+            _enhancement_cache.move_to_end(key)
+            stats['hits'] += 1
+            return entry[1]
+        if entry: # Expired
+            del _enhancement_cache[key]
+        stats['misses'] += 1
+        return None
+
+
+def cache_enhancement(section_type, original_content, enhanced_content):
+    """Stores a cleaned enhancement result, evicting least recently used entries."""
+    key = enhancement_cache_key(section_type, original_content)
+    with _enhancement_cache_lock:
+        _enhancement_cache[key] = (time.time() + ENHANCEMENT_CACHE_TTL_SECONDS, enhanced_content)
+        _enhancement_cache.move_to_end(key)
+        while len(_enhancement_cache) > ENHANCEMENT_CACHE_MAX_ENTRIES:
+            _enhancement_cache.popitem(last=False)
+
+
+def get_enhancement_cache_stats():
+    """Returns per-section-type hit/miss counts and hit ratios for the enhancement cache."""
+    with _enhancement_cache_lock:
+        by_section = {}
+        for section_type, stats in _enhancement_cache_stats.items():
+            lookups = stats['hits'] + stats['misses']
+            by_section[section_type] = {
+                'hits': stats['hits'],
+                'misses': stats['misses'],
+                'hitRatio': round(stats['hits'] / lookups, 4) if lookups else 0.0
+            }
+        return {'entries': len(_enhancement_cache), 'promptVersion': ENHANCEMENT_PROMPT_VERSION, 'bySectionType': by_section}
+
 
 def call_haiku_for_enhancement(section_type, original_content):
-    """Calls Claude Haiku to enhance a specific resume section."""
+    """Calls Claude Haiku to enhance a specific resume section. Stores the cleaned result in the enhancement cache."""
     if not CLAUDE_API_KEY:
         raise ValueError("Claude API Key is not configured.")
 
@@ -1833,7 +3997,8 @@ Rules:
         system_prompt=system_prompt,
         model=CLAUDE_HAIKU_MODEL, # Specify Haiku model
         temperature=temperature,
-        max_tokens=max_tokens
+        max_tokens=max_tokens,
+        feature='resume_enhance'
     )
     
     # Clean up any potential unwanted prefixes that might slip through
@@ -1858,44 +4023,33 @@ Rules:
                 enhanced_content = enhanced_content[newline_pos + 1:].strip()
             break
     
+    cache_enhancement(section_type, original_content, enhanced_content)
     return enhanced_content
 
-def get_package_limit(package_name, feature_type):
-    """Returns the limit for a specific feature based on package type."""
-    limits = {
-        'free': {
-            'resumeAnalyses': 1,
-            'mockInterviews': 0,
-            'pdfDownloads': 5,
-            'aiEnhance': 5
-        },
-        'starter': {
-            'resumeAnalyses': 5,
-            'mockInterviews': 1,
-            'pdfDownloads': 20,
-            'aiEnhance': 20
-        },
-        'standard': {
-            'resumeAnalyses': 10,
-            'mockInterviews': 3,
-            'pdfDownloads': 50,
-            'aiEnhance': 50
-        },
-        'pro': {
-            'resumeAnalyses': 20,
-            'mockInterviews': 5,
-            'pdfDownloads': 100,
-            'aiEnhance': 100
-        }
-    }
-    
-    # Default to free package if not found
-    if not package_name or package_name not in limits:
-        print(f"Warning: Unknown package '{package_name}', defaulting to free")
-        package_name = 'free'
-    
-    # Return the limit for the feature, or 0 if feature not found
-    return limits[package_name].get(feature_type, 0)
+# --- Batch Enhancement (resume builder) ---
+ENHANCE_BATCH_MAX_ITEMS = int(os.environ.get('ENHANCE_BATCH_MAX_ITEMS', 20))
+ENHANCE_BATCH_MAX_WORKERS = int(os.environ.get('ENHANCE_BATCH_MAX_WORKERS', 4))
+# Shared pool so concurrent batch requests together never exceed the Haiku concurrency bound
+_enhancement_executor = ThreadPoolExecutor(max_workers=ENHANCE_BATCH_MAX_WORKERS, thread_name_prefix="enhance")
+
+
+def enhance_sections_batch(items):
+    """
+    Enhances many (sectionType, originalContent) items concurrently on the bounded pool.
+    Returns a list of per-item results in input order: {'index', 'sectionType',
+    'enhancedContent'} on success or {'index', 'sectionType', 'error'} on failure.
+    """
+    def enhance_one(index, item):
+        section_type = item.get('sectionType')
+        try:
+            enhanced_content = call_haiku_for_enhancement(section_type, item.get('originalContent'))
+            return {'index': index, 'sectionType': section_type, 'enhancedContent': enhanced_content, 'cached': False}
+        except Exception as e:
+            print(f"Batch enhancement failed for item {index} ({section_type}): {e}")
+            return {'index': index, 'sectionType': section_type, 'error': str(e)}
+
+    futures = [_enhancement_executor.submit(enhance_one, index, item) for index, item in items]
+    return [future.result() for future in futures]
 
 # Example if using Redis for caching
 def get_cached_suggested_answers(interview_id):
@@ -1976,6 +4130,7 @@ def process_captured_payment(order_data, payment_id):
             def update_in_transaction(transaction, user_ref, payment_data):
                 # Update user plan
                 transaction.update(user_ref, update_data)
+                reset_usage_shards(transaction, user_ref)
                 
                 # Add payment record
                 payment_ref = db.collection('payments').document()
@@ -1984,6 +4139,7 @@ def process_captured_payment(order_data, payment_id):
                 return payment_ref.id
                 
             payment_id = update_in_transaction(transaction, user_ref, payment_data)
+            invalidate_quota_snapshot(user_id)
             print(f"Plan upgrade completed via webhook for user {user_id}, payment record: {payment_id}")
             return True
             
@@ -2069,6 +4225,7 @@ def process_captured_payment(order_data, payment_id):
                 return purchase_ref.id
             
             purchase_id = update_addon_in_transaction(transaction, user_ref, addon_purchase)
+            invalidate_quota_snapshot(user_id)
             print(f"Addon purchase completed via webhook for user {user_id}, purchase record: {purchase_id}")
             return True
             
@@ -2082,6 +4239,189 @@ def process_captured_payment(order_data, payment_id):
         return False
 
 
+# === Progress Tracking ===
+# Each analyzed interview's scores go to sessions/{session_id}/progress_interviews/{interview_id}; running aggregates
+# (count, first/latest/best scores, per-dimension exponential moving averages) live in the small
+# sessions/{session_id}/progress/summary document. Both are written in one transaction that reads only the summary
+# and the interview's own metrics doc, so recording an interview costs O(1) regardless of history length.
+# Sessions tracked before this layout keep their `progress_history` map, which is folded in on the first update.
+# The same transaction maintains a per-user index, user_progress/{user_id}: the summary across all sessions, the
+# last USER_PROGRESS_SERIES_MAX data points as a time series, per-session counts and a digest of the latest analysis,
+# so /get-user-progress answers with one document read. Interviews recorded before the index existed are folded in
+# by backfill_user_progress on the first read of an index that is missing or not yet marked `backfilled`.
+
+PROGRESS_DIMENSIONS = ('overallScore', 'technicalScore', 'communicationScore', 'behavioralScore')
+PROGRESS_EMA_ALPHA = 0.3
+PROGRESS_PAGE_DEFAULT = 50
+PROGRESS_PAGE_MAX = 100
+USER_PROGRESS_SERIES_MAX = 100
+
+
+def _fold_progress_metrics(summary, metrics):
+    """Updates a progress summary in place with one interview's metrics."""
+    scores = {dimension: metrics.get(dimension) or 0 for dimension in PROGRESS_DIMENSIONS}
+    if not summary.get('count'):
+        summary.update({'count': 0, 'first': dict(scores, date=metrics['date']), 'latest': dict(scores, date=metrics['date']),
+                        'best': dict(scores), 'movingAverage': dict(scores)})
+    else:
+        if metrics['date'] < summary['first']['date']:
+            summary['first'] = dict(scores, date=metrics['date'])
+        if metrics['date'] >= summary['latest']['date']:
+            summary['latest'] = dict(scores, date=metrics['date'])
+        for dimension, score in scores.items():
+            summary['best'][dimension] = max(summary['best'].get(dimension, 0), score)
+            previous = summary['movingAverage'].get(dimension, score)
+            summary['movingAverage'][dimension] = round(previous + PROGRESS_EMA_ALPHA * (score - previous), 2)
+    summary['count'] += 1
+    return summary
+
+
+def progress_trends(summary):
+    """Trends in the shape progress_history used to store, derived from a summary."""
+    if not summary or summary.get('count', 0) < 2:
+        return {}
+    first, latest = summary['first'], summary['latest']
+    return {
+        "totalInterviews": summary['count'],
+        "overallImprovement": latest["overallScore"] - first["overallScore"],
+        "technicalImprovement": latest["technicalScore"] - first["technicalScore"],
+        "communicationImprovement": latest["communicationScore"] - first["communicationScore"],
+        "behavioralImprovement": latest["behavioralScore"] - first["behavioralScore"],
+        "timespan": f"{(datetime.fromisoformat(latest['date']) - datetime.fromisoformat(first['date'])).days} days"
+    }
+
+
+def summarize_analysis_for_progress(analysis_result):
+    """Small digest of an interview analysis for the user progress index."""
+    digest = {'overallScore': analysis_result.get('overallScore', 0),
+              'overallAssessment': (analysis_result.get('overallAssessment') or '')[:500],
+              'keyImprovementAreas': [item.get('area', '') for item in (analysis_result.get('keyImprovementAreas') or [])[:3]
+                                      if isinstance(item, dict)]}
+    for section in ('technicalAssessment', 'communicationAssessment', 'behavioralAssessment'):
+        assessment = analysis_result.get(section) or {}
+        digest[section] = {'score': assessment.get('score', 0), 'strengths': (assessment.get('strengths') or [])[:2],
+                           'weaknesses': (assessment.get('weaknesses') or [])[:2]}
+    return digest
+
+
+def _fold_user_progress(user_progress, session_id, metrics, analysis_digest):
+    """Updates a user progress index document in place with one interview."""
+    _fold_progress_metrics(user_progress.setdefault('summary', {}), metrics)
+    point = dict({dimension: metrics.get(dimension) or 0 for dimension in PROGRESS_DIMENSIONS},
+                 date=metrics['date'], interviewId=metrics['interviewId'], sessionId=session_id,
+                 interviewType=metrics.get('interviewType', 'general'))
+    series = user_progress.setdefault('series', [])
+    if not series or point['date'] >= series[-1]['date']:
+        series.append(point)
+    else: # Late arrival: keep the series in date order (bounded list, so this stays cheap)
+        series.insert(next(i for i, existing in enumerate(series) if existing['date'] > point['date']), point)
+    del series[:-USER_PROGRESS_SERIES_MAX]
+    sessions = user_progress.setdefault('sessions', {})
+    session_entry = sessions.setdefault(session_id, {'count': 0, 'latestDate': metrics['date']})
+    session_entry['count'] += 1
+    session_entry['latestDate'] = max(session_entry['latestDate'], metrics['date'])
+    latest = user_progress.get('latestAnalysis')
+    if analysis_digest and (not latest or metrics['date'] >= latest.get('date', '')):
+        user_progress['latestAnalysis'] = dict(analysis_digest, date=metrics['date'], interviewId=metrics['interviewId'], sessionId=session_id)
+    return user_progress
+
+
+def record_interview_progress(session_id, metrics, user_id=None, analysis_result=None):
+    """
+    Stores one interview's metrics and folds them into the session's progress summary and, when `user_id` is given,
+    the user's progress index, in one transaction. Recording the same interview twice is a no-op.
+    Returns the updated session summary, or None on failure.
+    """
+    if not db: return None
+    try:
+        session_ref = db.collection('sessions').document(session_id)
+        summary_ref = session_ref.collection('progress').document('summary')
+        metrics_ref = session_ref.collection('progress_interviews').document(metrics['interviewId'])
+        user_progress_ref = db.collection('user_progress').document(user_id) if user_id else None
+        analysis_digest = summarize_analysis_for_progress(analysis_result) if analysis_result else None
+        transaction = db.transaction()
+
+        @firestore.transactional
+        def record_in_transaction(transaction):
+            summary_snapshot = summary_ref.get(transaction=transaction)
+            user_progress_snapshot = user_progress_ref.get(transaction=transaction) if user_progress_ref else None
+            if metrics_ref.get(transaction=transaction).exists:
+                return summary_snapshot.to_dict() if summary_snapshot.exists else None
+            user_progress = None
+            if user_progress_ref:
+                user_progress = user_progress_snapshot.to_dict() if user_progress_snapshot.exists else {'userId': user_id}
+            if summary_snapshot.exists:
+                summary = summary_snapshot.to_dict()
+            else:
+                # One-time migration of the legacy list stored on the session document. A backfilled user index
+                # already counts these interviews (backfill_user_progress reads progress_history too).
+                summary = {}
+                fold_legacy_into_user = user_progress is not None and not user_progress.get('backfilled')
+                session_snapshot = session_ref.get(transaction=transaction)
+                legacy = ((session_snapshot.to_dict() or {}).get('progress_history') or {}).get('interviews', []) if session_snapshot.exists else []
+                for legacy_metrics in sorted(legacy, key=lambda m: m.get('date', '')):
+                    if legacy_metrics.get('interviewId') and legacy_metrics.get('date') and legacy_metrics['interviewId'] != metrics['interviewId']:
+                        _fold_progress_metrics(summary, legacy_metrics)
+                        if fold_legacy_into_user: _fold_user_progress(user_progress, session_id, legacy_metrics, None)
+                        transaction.set(session_ref.collection('progress_interviews').document(legacy_metrics['interviewId']), legacy_metrics)
+            _fold_progress_metrics(summary, metrics)
+            summary['updatedAt'] = datetime.now().isoformat()
+            transaction.set(metrics_ref, metrics)
+            transaction.set(summary_ref, summary)
+            if user_progress is not None:
+                _fold_user_progress(user_progress, session_id, metrics, analysis_digest)
+                user_progress['updatedAt'] = summary['updatedAt']
+                transaction.set(user_progress_ref, user_progress)
+            return summary
+
+        return record_in_transaction(transaction)
+    except Exception as e:
+        print(f"Error recording progress for session {session_id}: {e}")
+        traceback.print_exc()
+        return None
+
+
+def backfill_user_progress(user_id, existing=None):
+    """
+    Rebuilds a user's progress index from every session's progress_interviews (or legacy progress_history) and saves
+    it marked `backfilled`, keeping the stored latestAnalysis. The write is skipped if the index changed meanwhile.
+    `existing` is the current index document, if any. Returns the rebuilt index, or None on failure.
+    """
+    if not db: return None
+    try:
+        user_progress_ref = db.collection('user_progress').document(user_id)
+        entries = []
+        for session_snapshot in db.collection('sessions').where('userId', '==', user_id).stream():
+            recorded = [doc.to_dict() for doc in session_snapshot.reference.collection('progress_interviews').stream()]
+            if not recorded:
+                recorded = ((session_snapshot.to_dict() or {}).get('progress_history') or {}).get('interviews', [])
+            entries.extend((session_snapshot.id, metrics) for metrics in recorded
+                           if metrics and metrics.get('interviewId') and metrics.get('date'))
+        user_progress = {'userId': user_id}
+        for session_id, metrics in sorted(entries, key=lambda entry: entry[1]['date']):
+            _fold_user_progress(user_progress, session_id, metrics, None)
+        if existing and existing.get('latestAnalysis'):
+            user_progress['latestAnalysis'] = existing['latestAnalysis']
+        user_progress.update({'backfilled': True, 'updatedAt': datetime.now().isoformat()})
+        transaction = db.transaction()
+
+        @firestore.transactional
+        def save_in_transaction(transaction):
+            current = user_progress_ref.get(transaction=transaction)
+            if (current.to_dict() or {}).get('updatedAt') != (existing or {}).get('updatedAt'):
+                return False # an interview was recorded meanwhile; the next read backfills again
+            transaction.set(user_progress_ref, user_progress)
+            return True
+
+        if save_in_transaction(transaction):
+            print(f"Backfilled progress index for user {user_id} from {len(entries)} interviews.")
+        return user_progress
+    except Exception as e:
+        print(f"Error backfilling progress for user {user_id}: {e}")
+        traceback.print_exc()
+        return None
+
+
 # === Flask Routes ===
 
 @app.route('/test', methods=['GET'])
@@ -2106,9 +4446,40 @@ def test_route():
     return jsonify({
         'status': 'ok',
         'message': f'IRIS backend server running at {now}',
-        'config_status': config_status
+        'config_status': config_status,
+        'circuit_breakers': get_circuit_states()
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """Returns in-process performance metrics for this worker."""
+    try:
+        return jsonify({
+            'timestamp': datetime.now().isoformat(),
+            'enhancementCache': get_enhancement_cache_stats(),
+            'greetingCache': get_greeting_cache_stats(),
+            'responseValidation': get_response_validation_stats(),
+            'llmGateway': get_llm_gateway_stats(),
+            'interviewerRouting': get_interviewer_routing_stats(),
+            'speculativeDrafts': get_speculative_draft_stats(),
+            'audioPreprocessing': get_audio_preprocessing_stats(),
+            'llmUsage': get_llm_usage_stats(),
+            'promptCompaction': get_prompt_compaction_stats(),
+            'tokenEstimator': get_token_estimator_stats()
+        })
+    except Exception as e:
+        print(f"Error in /metrics: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/llm-usage/<session_key>', methods=['GET'])
+def llm_usage_route(session_key):
+    """Returns this worker's in-memory LLM usage summary for a resume session or interview id."""
+    usage = get_llm_session_usage(session_key)
+    if usage is None:
+        return jsonify({'error': 'No LLM usage recorded for this session on this worker'}), 404
+    return jsonify({'sessionKey': session_key, 'llmUsage': usage})
+
 # Replace this entire route function in backend.py
 @app.route('/analyze-resume', methods=['POST'])
 def analyze_resume():
@@ -2150,19 +4521,6 @@ def analyze_resume():
             return jsonify({'error': 'Database unavailable'}), 503
         # --- End Validation ---
 
-        # --- Check usage limits ---
-        access_check = check_feature_access(user_id, 'resumeAnalyses')
-        if not access_check.get('allowed', False):
-            # Return specific error indicating limit reached
-            return jsonify({
-                'error': access_check.get('error', 'Usage limit reached'),
-                'limitReached': True, # Flag for frontend
-                'used': access_check.get('used', 0),
-                'limit': access_check.get('limit', 0),
-                'plan': access_check.get('plan', 'free')
-            }), 403  # Forbidden due to limits
-        # --- End usage limit check ---
-
         session_id = str(uuid.uuid4())
         print(f"[{session_id}] Received /analyze-resume request for file: {resume_filename} from user: {user_id}")
 
@@ -2179,20 +4537,29 @@ def analyze_resume():
             return jsonify({'error': f'Server file system error: {str(file_err)}'}), 500
         # === End File Handling ===
 
-        # --- Increment Usage Counter (BEFORE creating session, in case of errors) ---
-        # This function now returns {'success': True/False, 'used': N, 'limit': M, 'remaining': X}
-        increment_result = increment_usage_counter(user_id, 'resumeAnalyses')
-        if not increment_result.get('success', False):
+        # --- Check & Consume Usage Quota (single transaction, BEFORE creating session) ---
+        # Returns {'allowed': True/False, 'used': N, 'limit': M, 'remaining': X, 'plan': P}
+        increment_result = consume_quota(user_id, 'resumeAnalyses')
+        if not increment_result.get('allowed', False):
             error_msg = increment_result.get('error', 'Failed to update usage counter')
-            print(f"[{session_id}] ERROR: {error_msg}")
-            # Clean up temp file if usage increment fails
+            print(f"[{session_id}] Quota not consumed: {error_msg}")
+            # Clean up temp file if quota could not be consumed
             if temp_session_dir and os.path.exists(temp_session_dir):
                 try:
                     shutil.rmtree(temp_session_dir)
                 except Exception as cleanup_err:
                     print(f"[{session_id}] Error during cleanup after usage error: {cleanup_err}")
+            if increment_result.get('limitReached'):
+                # Return specific error indicating limit reached
+                return jsonify({
+                    'error': error_msg,
+                    'limitReached': True, # Flag for frontend
+                    'used': increment_result.get('used', 0),
+                    'limit': increment_result.get('limit', 0),
+                    'plan': increment_result.get('plan', 'free')
+                }), 403  # Forbidden due to limits
             return jsonify({'error': error_msg}), 500
-        # --- End Usage Increment ---
+        # --- End Usage Quota ---
 
         # --- Initialize session doc in Firestore ---
         session_ref = db.collection('sessions').document(session_id)
@@ -2232,6 +4599,7 @@ def analyze_resume():
         # --- Define background task ---
         def process_resume_background(current_session_id, resume_local_path, jd, associated_user_id):
             session_status = 'failed'; error_list = []
+            set_llm_usage_session(current_session_id)
             try:
                 # (Existing background processing logic...)
                 print(f"[{current_session_id}] Background task started for local file: {resume_local_path}, User: {associated_user_id}")
@@ -2262,6 +4630,9 @@ def analyze_resume():
                 try:
                     if os.path.exists(dir_to_remove): print(f"[{current_session_id}] Cleaning up temp dir: {dir_to_remove}"); shutil.rmtree(dir_to_remove)
                 except Exception as cleanup_error: print(f"[{current_session_id}] WARNING: Failed to cleanup temp dir {dir_to_remove}: {cleanup_error}")
+                set_llm_usage_session(None)
+                llm_usage = get_llm_session_usage(current_session_id)
+                if llm_usage: update_session_data(current_session_id, {'llm_usage': llm_usage})
                 print(f"[{current_session_id}] Background processing finished with status: {session_status}")
         # --- End background task definition ---
 
@@ -2447,59 +4818,45 @@ def start_mock_interview():
         user_id = session_data.get('userId')
         if not user_id: return jsonify({'error': 'User ID not found in session'}), 400
 
-        # --- Check usage limits for mock interviews ---
-        access_check = check_feature_access(user_id, 'mockInterviews')
-        if not access_check.get('allowed', False):
-            # Return specific error indicating limit reached
-            return jsonify({
-                'error': access_check.get('error', 'Usage limit reached for mock interviews'),
-                'limitReached': True, # Flag for frontend
-                'used': access_check.get('used', 0),
-                'limit': access_check.get('limit', 0),
-                'plan': access_check.get('plan', 'free')
-            }), 403  # Forbidden due to limits
-
         # --- Fetch data required for the interview ---
         resume_data = session_data.get('results', {}).get('parsed_resume')
         job_data = session_data.get('results', {}).get('match_results')
         if not resume_data or not job_data: return jsonify({'error': 'Required analysis data missing'}), 500
 
-        # --- Increment Usage Counter BEFORE creating interview ---
-        increment_result = increment_usage_counter(user_id, 'mockInterviews')
-        if not increment_result.get('success', False):
+        # --- Cheap cached pre-check so denied starts never pay for a greeting or its TTS ---
+        access_result = check_feature_access(user_id, 'mockInterviews')
+        if not access_result.get('allowed', False):
+            increment_result = dict(access_result, limitReached='limit' in access_result)
+        else:
+            interview_id = str(uuid.uuid4())
+            system_prompt = create_mock_interviewer_prompt(resume_data, job_data, interview_type)
+            # Greeting text and audio are prepared while quota is consumed and the interview document is written
+            greeting_future = _greeting_executor.submit(prepare_interview_greeting, interview_id, resume_data, job_data, interview_type, system_prompt)
+
+            # --- Check & Consume Usage Quota (single transaction) BEFORE creating interview ---
+            increment_result = consume_quota(user_id, 'mockInterviews')
+        if not increment_result.get('allowed', False):
             error_msg = increment_result.get('error', 'Failed to update usage counter')
-            print(f"[{session_id}] ERROR: {error_msg}")
+            print(f"[{session_id}] Quota not consumed: {error_msg}")
+            if increment_result.get('limitReached'):
+                # Return specific error indicating limit reached
+                return jsonify({
+                    'error': error_msg or 'Usage limit reached for mock interviews',
+                    'limitReached': True, # Flag for frontend
+                    'used': increment_result.get('used', 0),
+                    'limit': increment_result.get('limit', 0),
+                    'plan': increment_result.get('plan', 'free')
+                }), 403  # Forbidden due to limits
             return jsonify({'error': error_msg}), 500
 
-        # --- Create interview ID and generate system prompt ---
-        interview_id = str(uuid.uuid4())
-        system_prompt = create_mock_interviewer_prompt(resume_data, job_data, interview_type)
-
-        # --- Generate initial greeting ---
-        initial_prompt = f"Start the '{interview_type}' interview with {resume_data.get('name', 'the candidate')}. Give a brief professional greeting and ask your first question."
-        try:
-            # Get current time for context
-            current_time_str = datetime.now().strftime("%I:%M %p")  # e.g., "01:15 PM"
-            
-            greeting = call_claude_api(
-                messages=[{"role": "user", "content": initial_prompt}],
-                system_prompt=system_prompt, 
-                model=CLAUDE_MODEL,
-                temperature=0.3,  # Lower temperature for more consistency
-                current_time_str=current_time_str  # Pass current time
-            )
-        except Exception as e:
-            print(f"[{session_id}] Error generating greeting for interview {interview_id}: {e}")
-            greeting = f"Hello {resume_data.get('name', 'there')}. Welcome to your {interview_type} mock interview. Let's begin. Can you start by telling me a bit about yourself and your background?"
-
-        # --- Create interview document in Firestore ---
+        # --- Create interview document in Firestore (greeting is appended once ready) ---
         interview_doc_ref = db.collection('interviews').document(interview_id)
         interview_data_to_save = {
             'sessionId': session_id,
             'userId': user_id,  # Store user ID directly in interview doc
             'interviewType': interview_type,
             'system_prompt_summary': system_prompt[:1000] + "...",
-            'conversation': [{'role': 'assistant', 'content': greeting, 'timestamp': datetime.now().isoformat()}],
+            'conversation': [],
             'status': 'active',
             'start_time': datetime.now().isoformat(),
             'last_updated': firestore.SERVER_TIMESTAMP,
@@ -2515,7 +4872,13 @@ def start_mock_interview():
             }
         }
         interview_doc_ref.set(interview_data_to_save)
-        print(f"[{session_id}] Started interview {interview_id} of type {interview_type} for user {user_id}.")
+
+        greeting_result = greeting_future.result() # Generation errors already fell back to a default greeting
+        greeting = greeting_result['greeting']
+        if not add_conversation_message(interview_id, 'assistant', greeting):
+            print(f"[{session_id}] Failed to save greeting for interview {interview_id}, but proceeding.")
+        print(f"[{session_id}] Started interview {interview_id} of type {interview_type} for user {user_id}"
+              f"{' (cached greeting)' if greeting_result['cached'] else ''}.")
 
         # Return the latest usage info obtained from increment_result
         return jsonify({
@@ -2523,6 +4886,9 @@ def start_mock_interview():
             'sessionId': session_id,
             'interviewType': interview_type,
             'greeting': greeting,
+            # Greeting speech, so the client can play it without a /generate-tts round trip (None if TTS failed)
+            'greetingAudioBase64': base64.b64encode(greeting_result['audio']).decode('utf-8') if greeting_result['audio'] else None,
+            'greetingAudioFormat': greeting_result['audioFormat'],
             'usageInfo': { # Include updated usage info
                 'feature': 'mockInterviews',
                 'used': increment_result.get('used', 0),
@@ -2549,67 +4915,91 @@ def interview_response():
         # Assuming `db` is the initialized Firestore client global variable
         if not db: return jsonify({'error': 'Database unavailable'}), 503
 
-        interview_data = get_interview_data(interview_id)
-        if interview_data is None: return jsonify({'error': 'Interview session not found'}), 404
-        if interview_data.get('status') != 'active': return jsonify({'error': 'Interview is not active'}), 400
-
-        # Add user response to conversation in Firestore
-        if not add_conversation_message(interview_id, 'user', user_response):
-             return jsonify({'error': 'Failed to save user response'}), 500
-
-        # Refresh interview_data to get latest conversation for Claude context
-        updated_interview_data = get_interview_data(interview_id)
-        if not updated_interview_data: # Check if fetch failed
-             return jsonify({'error': 'Failed to retrieve updated interview data'}), 500
+        result = run_interviewer_turn(interview_id, user_response)
+        if 'error' in result: return jsonify({'error': result['error']}), result['status']
+        return jsonify({'interviewerResponse': result['interviewerResponse']})
+    except Exception as e:
+        # Ensure interview_id has a value before using in the error message
+        id_for_log = interview_id if interview_id else "Unknown Interview"
+        print(f"Error in /interview-response route for {id_for_log}: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
 
-        current_conversation = updated_interview_data.get('conversation', [])
-        # Retrieve the original system prompt stored during interview start
-        # Regenerate the prompt using stored snapshot data
-        resume_data = updated_interview_data.get('resume_data_snapshot', {})
-        job_data = updated_interview_data.get('job_data_snapshot', {})
-        interview_type = updated_interview_data.get('interviewType', 'general') # Get the type used for this interview
-        system_prompt = create_mock_interviewer_prompt(resume_data, job_data, interview_type) # Regenerate prompt
 
-        # Get current time for context
-        current_time_str = datetime.now().strftime("%I:%M %p")
+@app.route('/interview-turn', methods=['POST'])
+def interview_turn():
+    """
+    Voice turn in one request: transcribes the answer audio, takes the interviewer turn and synthesizes the reply.
+    A client that streamed the answer through /transcribe-chunk sends the final `transcript` instead of the audio.
+    Streams newline-delimited JSON events: transcript, reply_chunk (the complete reply split into speech chunks),
+    audio (base64 in the speech backend's format per chunk, in order), then done; or error with an HTTP-style status.
+    The reply comes whole from hedged generation, so synthesis starts once it exists; chunks are then synthesized
+    in parallel and each chunk's audio is sent as soon as it and the chunks before it are ready.
+    """
+    try:
+        interview_id = request.form.get('interviewId')
+        if not interview_id: return jsonify({'error': 'Interview ID required'}), 400
+        streamed_transcript = request.form.get('transcript')
+        audio_bytes, filename = None, None
+        if streamed_transcript is None:
+            if 'audio' not in request.files: return jsonify({'error': 'No audio file'}), 400
+            audio_file = request.files['audio']
+            if not audio_file or not audio_file.filename: return jsonify({'error': 'Invalid audio file'}), 400
+            audio_bytes = audio_file.read()
+            filename = audio_file.filename
+        if not db: return jsonify({'error': 'Database unavailable'}), 503
+    except Exception as e:
+        print(f"Error in /interview-turn: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
 
-        # Generate interviewer's next response with LOWER temperature and time context
-        interviewer_response = "[IRIS encountered an issue generating a response. Please try again.]" # Default fallback
+    def generate_events():
+        started = time.monotonic()
         try:
-            # Reformat conversation for Claude API if needed (role 'user'/'assistant')
-            # Ensure roles are 'user' and 'assistant' as expected by Claude API
-            api_conversation = []
-            for msg in current_conversation:
-                role = msg.get('role')
-                # Map Firestore roles ('user', 'assistant') to Claude roles ('user', 'assistant')
-                # Assuming Firestore roles are already 'user' and 'assistant' based on add_conversation_message
-                if role in ['user', 'assistant']:
-                     api_conversation.append({'role': role, 'content': msg.get('content', '')})
-                # Skip system messages or other roles if they exist in Firestore history
-
-            interviewer_response = call_claude_api(
-                messages=api_conversation,
-                system_prompt=system_prompt,
-                model=CLAUDE_MODEL,
-                temperature=0.3, # <-- SET TEMPERATURE
-                current_time_str=current_time_str # <-- PASS CURRENT TIME
-            )
-            # Add AI response to conversation in Firestore
-            if not add_conversation_message(interview_id, 'assistant', interviewer_response):
-                 # Log error but maybe still return response to user?
-                 print(f"[{interview_id}] Failed to save assistant response to Firestore, but proceeding.")
-
+            transcript = streamed_transcript if streamed_transcript is not None else transcribe_audio(audio_bytes, filename)
+            yield ndjson_event('transcript', text=transcript)
+            if not transcript.strip():
+                yield ndjson_event('error', error='No speech detected in audio', status=400)
+                return
+            result = run_interviewer_turn(interview_id, transcript)
+            if 'error' in result:
+                yield ndjson_event('error', error=result['error'], status=result['status'])
+                return
+            reply = result['interviewerResponse']
+            chunks = split_reply_for_speech(reply)
+            speech_futures = [_tts_executor.submit(generate_speech, chunk) for chunk in chunks]
+            for index, chunk in enumerate(chunks):
+                yield ndjson_event('reply_chunk', index=index, text=chunk)
+            for index, future in enumerate(speech_futures):
+                try:
+                    audio_content = future.result()
+                    yield ndjson_event('audio', index=index, format=speech_audio_format(), audioBase64=base64.b64encode(audio_content).decode('utf-8'))
+                except Exception as tts_e:
+                    print(f"[{interview_id}] TTS failed for reply chunk {index}: {tts_e}")
+                    yield ndjson_event('audio_error', index=index, error=str(tts_e))
+            print(f"[{interview_id}] Voice turn completed in {time.monotonic() - started:.2f}s ({len(chunks)} speech chunks).")
+            yield ndjson_event('done', interviewerResponse=reply)
         except Exception as e:
-            print(f"[{interview_id}] Error generating interviewer response: {e}")
-            # Fallback response is already set above
-            # Attempt to save error message as assistant response
-            add_conversation_message(interview_id, 'assistant', interviewer_response) # Save the fallback message
+            print(f"Error in /interview-turn stream for {interview_id}: {e}")
+            traceback.print_exc()
+            yield ndjson_event('error', error=f'Server error: {str(e)}', status=500)
+
+    # X-Accel-Buffering stops nginx-style proxies from holding the stream until it completes
+    return Response(generate_events(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-        return jsonify({'interviewerResponse': interviewer_response})
+
+@app.route('/interview-partial-transcript', methods=['POST'])
+def interview_partial_transcript():
+    """Accepts a partial transcript of the answer in progress and drafts the interviewer's reply in the background."""
+    try:
+        data = request.get_json()
+        if not data: return jsonify({'error': 'Invalid JSON payload'}), 400
+        interview_id = data.get('interviewId')
+        if not interview_id: return jsonify({'error': 'Interview ID required'}), 400
+        started, reason = start_speculative_draft(interview_id, data.get('partialTranscript'))
+        return jsonify({'draftStarted': started, 'reason': reason})
     except Exception as e:
-        # Ensure interview_id has a value before using in the error message
-        id_for_log = interview_id if interview_id else "Unknown Interview"
-        print(f"Error in /interview-response route for {id_for_log}: {e}")
+        print(f"Error in /interview-partial-transcript: {e}")
         traceback.print_exc()
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
@@ -2625,8 +5015,8 @@ def process_audio():
         if not audio_file or not audio_file.filename: return jsonify({'error': 'Invalid audio file'}), 400
         # No check for interview_id needed if just transcribing, but good practice if context matters
 
-        audio_bytes = audio_file.read()
-        transcribed_text = transcribe_audio(audio_bytes, audio_file.filename)
+        # Passed as a stream so the upload is piped into preprocessing in chunks rather than read whole first
+        transcribed_text = transcribe_audio(audio_file.stream, audio_file.filename)
         print(f"Audio transcribed (interview: {interview_id if interview_id else 'N/A'}), length: {len(transcribed_text)}")
         return jsonify({'transcription': transcribed_text})
     except Exception as e:
@@ -2635,6 +5025,34 @@ def process_audio():
         return jsonify({'error': f'Server error transcribing audio: {str(e)}'}), 500
 
 
+@app.route('/transcribe-chunk', methods=['POST'])
+def transcribe_chunk():
+    """Transcribes one chunk of an answer being recorded and returns the running transcript (see Streaming Transcription)."""
+    try:
+        if 'audio' not in request.files: return jsonify({'error': 'No audio file'}), 400
+        audio_file = request.files['audio']
+        interview_id = request.form.get('interviewId')
+        if not interview_id: return jsonify({'error': 'Interview ID required'}), 400
+        answer_id = request.form.get('answerId')
+        if not answer_id: return jsonify({'error': 'Answer ID required'}), 400
+        try:
+            sequence = int(request.form.get('sequence', ''))
+        except ValueError:
+            return jsonify({'error': 'Integer chunk sequence required'}), 400
+        if sequence < 0: return jsonify({'error': 'Chunk sequence must be non-negative'}), 400
+        final = request.form.get('final', 'false').lower() == 'true'
+
+        result = add_transcript_chunk(interview_id, answer_id, sequence, audio_file.read(), audio_file.filename or 'chunk.webm', final=final)
+        if not final and result['transcript']:
+            start_speculative_draft(interview_id, result['transcript']) # no-op unless speculative drafts are enabled
+        return jsonify({'partialTranscript': result['transcript'], 'appliedThrough': result['appliedThrough'],
+                        'final': result['final'], 'dropped': result['dropped']})
+    except Exception as e:
+        print(f"Error in /transcribe-chunk: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'Server error transcribing chunk: {str(e)}'}), 500
+
+
 @app.route('/generate-tts', methods=['POST'])
 def generate_tts():
     """Generates speech from text."""
@@ -2646,7 +5064,7 @@ def generate_tts():
 
         audio_content = generate_speech(text)
         audio_base64 = base64.b64encode(audio_content).decode('utf-8')
-        return jsonify({'audioBase64': audio_base64})
+        return jsonify({'audioBase64': audio_base64, 'format': speech_audio_format()})
     except Exception as e:
         print(f"Error in /generate-tts: {e}")
         traceback.print_exc()
@@ -2687,6 +5105,8 @@ def end_interview():
         resume_data = updated_interview_data.get('resume_data_snapshot', {})
         job_data = updated_interview_data.get('job_data_snapshot', {}) # Pass full match results
         session_id = updated_interview_data.get('sessionId')
+        interview_type = updated_interview_data.get('interviewType', 'general')
+        interview_user_id = updated_interview_data.get('userId')
 
         # Format transcript
         transcript = "\n".join([
@@ -2699,6 +5119,7 @@ def end_interview():
             analysis_result = None
             analysis_status = 'failed'
             error_msg = None
+            set_llm_usage_session(current_interview_id)
             try:
                 print(f"[{current_interview_id}] Starting background analysis.")
                 analysis_result = analyze_interview_performance(transcript_text, job_reqs, resume_info)
@@ -2720,47 +5141,19 @@ def end_interview():
                 # --- Track Progress ---
                 if linked_session_id and analysis_result:
                     print(f"[{current_interview_id}] Attempting to track progress for session {linked_session_id}.")
-                    # We'll store progress directly in the 'sessions' document for simplicity
-                    session_data = get_session_data(linked_session_id)
-                    if session_data:
-                        past_interviews = session_data.get('progress_history', {}).get('interviews', [])
-                        metrics = {
-                            "date": datetime.now().isoformat(),
-                            "interviewId": current_interview_id,
-                            "interviewType": "general",  # You might want to get this from interview_data
-                            "overallScore": analysis_result.get("overallScore", 0),
-                            "technicalScore": analysis_result.get("technicalAssessment", {}).get("score", 0),
-                            "communicationScore": analysis_result.get("communicationAssessment", {}).get("score", 0),
-                            "behavioralScore": analysis_result.get("behavioralAssessment", {}).get("score", 0)
-                        }
-                        past_interviews.append(metrics)
-                        past_interviews.sort(key=lambda x: x["date"])  # Sort oldest first
-
-                        trends = {}
-                        if len(past_interviews) > 1:
-                            first = past_interviews[0]
-                            latest = past_interviews[-1]
-                            trends = {
-                                "totalInterviews": len(past_interviews),
-                                "overallImprovement": latest["overallScore"] - first["overallScore"],
-                                "technicalImprovement": latest["technicalScore"] - first["technicalScore"],
-                                "communicationImprovement": latest["communicationScore"] - first["communicationScore"],
-                                "behavioralImprovement": latest["behavioralScore"] - first["behavioralScore"],
-                                "timespan": f"{(datetime.fromisoformat(latest['date']) - datetime.fromisoformat(first['date'])).days} days"
-                            }
-
-                        progress_update = {
-                             'progress_history': {
-                                 'interviews': past_interviews,
-                                 'trends': trends
-                             }
-                        }
-                        if update_session_data(linked_session_id, progress_update):
-                            print(f"[{current_interview_id}] Progress tracked successfully for session {linked_session_id}.")
-                        else:
-                             print(f"[{current_interview_id}] WARNING: Failed to update progress tracking for session {linked_session_id}.")
+                    metrics = {
+                        "date": datetime.now().isoformat(),
+                        "interviewId": current_interview_id,
+                        "interviewType": interview_type,
+                        "overallScore": analysis_result.get("overallScore", 0),
+                        "technicalScore": analysis_result.get("technicalAssessment", {}).get("score", 0),
+                        "communicationScore": analysis_result.get("communicationAssessment", {}).get("score", 0),
+                        "behavioralScore": analysis_result.get("behavioralAssessment", {}).get("score", 0)
+                    }
+                    if record_interview_progress(linked_session_id, metrics, user_id=interview_user_id, analysis_result=analysis_result) is not None:
+                        print(f"[{current_interview_id}] Progress tracked successfully for session {linked_session_id}.")
                     else:
-                         print(f"[{current_interview_id}] WARNING: Could not find session {linked_session_id} to track progress.")
+                        print(f"[{current_interview_id}] WARNING: Failed to update progress tracking for session {linked_session_id}.")
                 # --- End Track Progress ---
                 
             except Exception as e:
@@ -2769,6 +5162,10 @@ def end_interview():
                 traceback.print_exc()
                 update_interview_data(current_interview_id, {'analysis_status': 'failed', 'analysis_error': str(e)})
             finally:
+                 set_llm_usage_session(None)
+                 # Covers the greeting, interviewer turns (if still in memory) and the analysis itself
+                 llm_usage = get_llm_session_usage(current_interview_id)
+                 if llm_usage: update_interview_data(current_interview_id, {'llm_usage': llm_usage})
                  print(f"[{current_interview_id}] Background analysis finished with status: {analysis_status}")
 
         # Start analysis thread
@@ -2901,24 +5298,67 @@ def get_suggested_answers_route(interview_id):
 
 @app.route('/get-progress-history/<session_id>', methods=['GET'])
 def get_progress_history(session_id):
-    """Returns the progress history stored within the session document."""
+    """
+    Returns the session's progress summary, trends and a page of per-interview metrics.
+    Pages run newest first (?limit=, ?before=<nextCursor>); interviews within a page are listed oldest first.
+    """
     try:
         if not db: return jsonify({'error': 'Database unavailable'}), 503
-        session_data = get_session_data(session_id)
-        if session_data is None: return jsonify({'error': 'Session not found or expired'}), 404
-
-        progress_data = session_data.get('progress_history', {'interviews': [], 'trends': {}}) # Default if not found
-
-        # Ensure interviews list exists
-        if 'interviews' not in progress_data: progress_data['interviews'] = []
-        if 'trends' not in progress_data: progress_data['trends'] = {}
+        try:
+            limit = min(max(int(request.args.get('limit', PROGRESS_PAGE_DEFAULT)), 1), PROGRESS_PAGE_MAX)
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        before = request.args.get('before')
 
-        return jsonify(progress_data)
+        session_ref = db.collection('sessions').document(session_id)
+        summary_snapshot = session_ref.collection('progress').document('summary').get()
+        if not summary_snapshot.exists:
+            # Nothing recorded in the new layout yet: serve the legacy map, if any, unpaginated
+            session_data = get_session_data(session_id)
+            if session_data is None: return jsonify({'error': 'Session not found or expired'}), 404
+            progress_data = session_data.get('progress_history') or {}
+            return jsonify({'interviews': progress_data.get('interviews', []), 'trends': progress_data.get('trends', {}),
+                            'summary': None, 'nextCursor': None})
+
+        summary = summary_snapshot.to_dict()
+        query = session_ref.collection('progress_interviews').order_by('date', direction=firestore.Query.DESCENDING)
+        if before:
+            query = query.start_after({'date': before})
+        interviews = [doc.to_dict() for doc in query.limit(limit).stream()]
+        next_cursor = interviews[-1]['date'] if len(interviews) == limit else None
+        interviews.reverse()
+
+        return jsonify({'interviews': interviews, 'trends': progress_trends(summary), 'summary': summary, 'nextCursor': next_cursor})
     except Exception as e:
         print(f"Error in /get-progress-history for {session_id}: {e}")
         traceback.print_exc()
         return jsonify({'error': f'Server error retrieving progress: {str(e)}'}), 500
 
+@app.route('/get-user-progress/<user_id>', methods=['GET'])
+def get_user_progress(user_id):
+    """Returns the user's progress across all sessions (summary, trends, time series, latest analysis), normally from one read."""
+    try:
+        if not db: return jsonify({'error': 'Database unavailable'}), 503
+        snapshot = db.collection('user_progress').document(user_id).get()
+        user_progress = snapshot.to_dict() if snapshot.exists else None
+        if not (user_progress or {}).get('backfilled'): # First read: fold in interviews recorded before the index
+            user_progress = backfill_user_progress(user_id, user_progress) or user_progress
+        if not user_progress:
+            return jsonify({'userId': user_id, 'summary': None, 'trends': {}, 'series': [], 'sessions': {}, 'latestAnalysis': None})
+        return jsonify({
+            'userId': user_id,
+            'summary': user_progress.get('summary'),
+            'trends': progress_trends(user_progress.get('summary')),
+            'series': user_progress.get('series', []),
+            'sessions': user_progress.get('sessions', {}),
+            'latestAnalysis': user_progress.get('latestAnalysis'),
+            'updatedAt': user_progress.get('updatedAt')
+        })
+    except Exception as e:
+        print(f"Error in /get-user-progress for {user_id}: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'Server error retrieving user progress: {str(e)}'}), 500
+
 @app.route('/check-feature-access', methods=['POST'])
 def check_feature_access_route():
     """API endpoint to check if user can access a specific feature based on plan."""
@@ -2933,7 +5373,7 @@ def check_feature_access_route():
         if not feature_type: return jsonify({'error': 'Feature type required'}), 400
         if not db: return jsonify({'error': 'Database unavailable'}), 503
         
-        if feature_type not in ['resumeAnalyses', 'mockInterviews']:
+        if feature_type not in USAGE_FEATURES:
             return jsonify({'error': f'Invalid feature type: {feature_type}'}), 400
             
         # Check access
@@ -2963,9 +5403,8 @@ def update_user_plan():
         if not db: return jsonify({'error': 'Database unavailable'}), 503
         
         # Validate plan name
-        valid_plans = ['free', 'starter', 'standard', 'pro']
-        if plan_name not in valid_plans:
-            return jsonify({'error': f'Invalid plan name: {plan_name}. Valid plans: {", ".join(valid_plans)}'}), 400
+        if plan_name not in VALID_PLANS:
+            return jsonify({'error': f'Invalid plan name: {plan_name}. Valid plans: {", ".join(VALID_PLANS)}'}), 400
             
         # Get user profile to verify existence
         user_data = get_user_usage(user_id)
@@ -2995,7 +5434,11 @@ def update_user_plan():
             'last_updated': firestore.SERVER_TIMESTAMP
         }
         
-        user_ref.update(update_data)
+        batch = db.batch()
+        batch.update(user_ref, update_data)
+        reset_usage_shards(batch, user_ref)
+        batch.commit()
+        invalidate_quota_snapshot(user_id)
         print(f"Updated user {user_id} to plan: {plan_name} with reset usage counters")
         
         return jsonify({
@@ -3024,7 +5467,8 @@ def get_user_usage_route(user_id):
         if not user_id: return jsonify({'error': 'User ID required'}), 400
         if not db: return jsonify({'error': 'Database unavailable'}), 503
         
-        user_data = get_user_usage(user_id)
+        # Read-only: served from the quota snapshot cache when fresh
+        user_data = get_quota_snapshot(user_id)
         if not user_data:
             return jsonify({'error': f'User {user_id} not found'}), 404
             
@@ -3035,7 +5479,10 @@ def get_user_usage_route(user_id):
             'planPurchasedAt': user_data.get('planPurchasedAt'),
             'planExpiresAt': user_data.get('planExpiresAt'),
             'resumeAnalyses': user_data.get('usage', {}).get('resumeAnalyses', {'used': 0, 'limit': 0}),
-            'mockInterviews': user_data.get('usage', {}).get('mockInterviews', {'used': 0, 'limit': 0})
+            'mockInterviews': user_data.get('usage', {}).get('mockInterviews', {'used': 0, 'limit': 0}),
+            # Includes sharded counts
+            'pdfDownloads': user_data.get('usage', {}).get('pdfDownloads', {'used': 0, 'limit': 0}),
+            'aiEnhance': user_data.get('usage', {}).get('aiEnhance', {'used': 0, 'limit': 0})
         }
         
         return jsonify(usage_data)
@@ -3055,15 +5502,50 @@ def enhance_resume_content_route():
 
         section_type = data.get('sectionType')
         original_content = data.get('originalContent')
+        user_id = data.get('userId') # Optional: charge aiEnhance server-side (sharded counter)
+        regenerate = str(data.get('regenerate', False)).lower() == 'true' # Skip the cache and produce a fresh rewrite
 
         if not section_type or not original_content:
             return jsonify({'error': 'sectionType and originalContent are required'}), 400
 
         print(f"Received enhancement request for section: {section_type}")
 
-        enhanced_content = call_haiku_for_enhancement(section_type, original_content)
+        # Cache hits are served without an API call or a quota charge
+        if not regenerate:
+            cached_content = get_cached_enhancement(section_type, original_content)
+            if cached_content is not None:
+                print(f"Serving cached enhancement for section: {section_type}")
+                return jsonify({'enhancedContent': cached_content, 'cached': True})
+
+        usage_result = None
+        if user_id:
+            usage_result = consume_sharded_quota(user_id, 'aiEnhance')
+            if not usage_result.get('allowed', False):
+                if usage_result.get('limitReached'):
+                    return jsonify({
+                        'error': usage_result.get('error'),
+                        'limitReached': True,
+                        'used': usage_result.get('used', 0),
+                        'limit': usage_result.get('limit', 0),
+                        'plan': usage_result.get('plan', 'free')
+                    }), 403
+                return jsonify({'error': usage_result.get('error', 'Failed to update usage counter')}), 500
 
-        return jsonify({'enhancedContent': enhanced_content})
+        try:
+            enhanced_content = call_haiku_for_enhancement(section_type, original_content)
+        except Exception:
+            if usage_result: refund_sharded_quota(user_id, 'aiEnhance') # Nothing was delivered
+            raise
+
+        response = {'enhancedContent': enhanced_content, 'cached': False}
+        if usage_result:
+            response['usageInfo'] = {
+                'feature': 'aiEnhance',
+                'used': usage_result.get('used', 0),
+                'limit': usage_result.get('limit', 0),
+                'remaining': usage_result.get('remaining', 0)
+            }
+        return jsonify(response)
 
     except ValueError as ve: # Catch API key errors specifically
          print(f"Configuration Error: {ve}")
@@ -3078,6 +5560,117 @@ def enhance_resume_content_route():
         else:
             return jsonify({'error': f'Server error enhancing content: {str(e)}'}), 500
 
+@app.route('/enhance-resume-content/batch', methods=['POST'])
+def enhance_resume_content_batch_route():
+    """Enhances multiple resume sections in one request; returns per-item results and errors."""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Invalid JSON payload'}), 400
+
+        items = data.get('items')
+        user_id = data.get('userId') # Optional: charge aiEnhance server-side (one unit per generated item)
+        regenerate = str(data.get('regenerate', False)).lower() == 'true' # Batch-wide cache opt-out; items may also set 'regenerate'
+
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'items must be a non-empty list of {sectionType, originalContent}'}), 400
+        if len(items) > ENHANCE_BATCH_MAX_ITEMS:
+            return jsonify({'error': f'Too many items ({len(items)}). Maximum per batch: {ENHANCE_BATCH_MAX_ITEMS}'}), 400
+
+        # Validate items individually so one bad item does not fail the batch
+        results = []
+        valid_items = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('sectionType') or not item.get('originalContent'):
+                results.append({'index': index, 'sectionType': item.get('sectionType') if isinstance(item, dict) else None,
+                                'error': 'sectionType and originalContent are required'})
+                continue
+            if not (regenerate or str(item.get('regenerate', False)).lower() == 'true'):
+                cached_content = get_cached_enhancement(item['sectionType'], item['originalContent'])
+                if cached_content is not None:
+                    results.append({'index': index, 'sectionType': item['sectionType'], 'enhancedContent': cached_content, 'cached': True})
+                    continue
+            valid_items.append((index, item))
+
+        print(f"Received batch enhancement request: {len(items)} items, {len(valid_items)} to generate")
+
+        if valid_items and not CLAUDE_API_KEY: # Before charging: a misconfigured server must not bill the user
+            return jsonify({'error': 'Server configuration error: Claude API Key is not configured.'}), 503
+
+        usage_result = None
+        if user_id and valid_items:
+            usage_result = consume_sharded_quota(user_id, 'aiEnhance', amount=len(valid_items))
+            if not usage_result.get('allowed', False):
+                if usage_result.get('limitReached'):
+                    return jsonify({
+                        'error': usage_result.get('error'),
+                        'limitReached': True,
+                        'requested': len(valid_items),
+                        'used': usage_result.get('used', 0),
+                        'limit': usage_result.get('limit', 0),
+                        'remaining': usage_result.get('remaining', 0),
+                        'plan': usage_result.get('plan', 'free')
+                    }), 403
+                return jsonify({'error': usage_result.get('error', 'Failed to update usage counter')}), 500
+
+        if valid_items:
+            generated = enhance_sections_batch(valid_items)
+            results.extend(generated)
+            failed_generations = sum(1 for result in generated if 'error' in result)
+            if usage_result and failed_generations and refund_sharded_quota(user_id, 'aiEnhance', failed_generations):
+                usage_result['used'] = usage_result.get('used', 0) - failed_generations
+                usage_result['remaining'] = usage_result.get('remaining', 0) + failed_generations
+        results.sort(key=lambda result: result['index'])
+
+        failed_count = sum(1 for result in results if 'error' in result)
+        response = {
+            'results': results,
+            'succeeded': len(results) - failed_count,
+            'failed': failed_count
+        }
+        if usage_result:
+            response['usageInfo'] = {
+                'feature': 'aiEnhance',
+                'used': usage_result.get('used', 0),
+                'limit': usage_result.get('limit', 0),
+                'remaining': usage_result.get('remaining', 0)
+            }
+        return jsonify(response)
+
+    except Exception as e:
+        print(f"Error in /enhance-resume-content/batch route: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'Server error enhancing content: {str(e)}'}), 500
+
+
+@app.route('/record-feature-usage', methods=['POST'])
+def record_feature_usage():
+    """Checks and records one use of a high-frequency feature (pdfDownloads/aiEnhance) via sharded counters."""
+    try:
+        data = request.get_json()
+        if not data: return jsonify({'error': 'Invalid JSON payload'}), 400
+
+        user_id = data.get('userId')
+        feature_type = data.get('feature')
+
+        if not user_id: return jsonify({'error': 'User ID required'}), 400
+        if feature_type not in SHARDED_USAGE_FEATURES:
+            return jsonify({'error': f'Invalid feature type: {feature_type}. Valid features: {", ".join(SHARDED_USAGE_FEATURES)}'}), 400
+        if not db: return jsonify({'error': 'Database unavailable'}), 503
+
+        usage_result = consume_sharded_quota(user_id, feature_type)
+        if not usage_result.get('allowed', False):
+            status_code = 403 if usage_result.get('limitReached') else 500
+            return jsonify({'success': False, **usage_result}), status_code
+
+        return jsonify({'success': True, 'feature': feature_type, **usage_result})
+
+    except Exception as e:
+        print(f"Error in /record-feature-usage: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'Server error: {str(e)}', 'success': False}), 500
+
+
 @app.route('/purchase-addon', methods=['POST'])
 def purchase_addon():
     """Purchases an addon for a specific feature, increasing the user's limit."""
@@ -3174,6 +5767,7 @@ def purchase_addon():
             return purchase_ref.id
         
         purchase_id = update_in_transaction(transaction, user_ref, addon_purchase)
+        invalidate_quota_snapshot(user_id)
         
         print(f"User {user_id} purchased {quantity} {feature_type} addon(s) (effective: {effective_quantity})")
         
@@ -3356,8 +5950,14 @@ def create_razorpay_order():
         try:
             print("Calling Razorpay API to create order...")
             # Create order in Razorpay
-            order = razorpay_client.order.create(data=order_data)
+            order = call_with_circuit('razorpay', razorpay_client.order.create, data=order_data)
             print(f"Razorpay order created successfully: {order['id']}")
+        except ConnectionError as e: # Breaker open: fail fast instead of waiting on a dead gateway
+            print(f"Razorpay circuit open: {e}")
+            return jsonify({
+                'error': 'Payment gateway temporarily unavailable',
+                'details': 'Please try again in a minute'
+            }), 503
         except razorpay.errors.BadRequestError as e:
             print(f"Razorpay BadRequestError: {e}")
             # Log detailed error information
@@ -3600,6 +6200,7 @@ def verify_razorpay_payment():
             def update_in_transaction(transaction, user_ref, payment_data):
                 # Update user plan
                 transaction.update(user_ref, update_data)
+                reset_usage_shards(transaction, user_ref)
                 print(f"Transaction: Updated user plan in transaction")
                 
                 # Add payment record
@@ -3611,6 +6212,7 @@ def verify_razorpay_payment():
                 
             try:
                 payment_id = update_in_transaction(transaction, user_ref, payment_data)
+                invalidate_quota_snapshot(user_id)
                 print(f"Transaction completed successfully. Payment record ID: {payment_id}")
             except Exception as tx_error:
                 print(f"Transaction failed: {tx_error}")
@@ -3722,6 +6324,7 @@ def verify_razorpay_payment():
             
             try:    
                 purchase_id = update_addon_in_transaction(transaction, user_ref, addon_purchase)
+                invalidate_quota_snapshot(user_id)
                 print(f"Transaction completed successfully. Purchase record ID: {purchase_id}")
             except Exception as tx_error:
                 print(f"Transaction failed: {tx_error}")
@@ -0,0 +1,42 @@
+"""
+Microbenchmarks for text helpers on the request path. Run from the repository root:
+
+    python benchmarks/bench_text_processing.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+
+from backend import CLAUDE_MODEL, estimate_tokens, sanitize_string_for_json
+from test_sanitize_string_for_json import reference_sanitize_string_for_json
+
+
+def average_milliseconds(function, argument, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def bench_sanitize_string_for_json(chars=45000, iterations=20):
+    sample = "Summary:\tLed C:\\builds migration\r\n- \"Reduced p95 by 38%\" \u2014 कार्य अनुभव\x07\n"
+    text = (sample * (chars // len(sample) + 1))[:chars]
+    print(f"sanitize_string_for_json, {chars} chars x {iterations}:")
+    print(f"  translate table: {average_milliseconds(sanitize_string_for_json, text, iterations):.3f} ms")
+    print(f"  reference loop:  {average_milliseconds(reference_sanitize_string_for_json, text, iterations):.3f} ms")
+
+
+def bench_estimate_tokens(chars=30000, iterations=200):
+    sample = ("Led migration of 12 services to Kubernetes; reduced p95 latency by 38%. कार्य अनुभव: "
+              "{\"skill\": \"Python\"}\n")
+    text = (sample * (chars // len(sample) + 1))[:chars]
+    print(f"estimate_tokens, {chars} mixed-script chars x {iterations}:")
+    print(f"  {average_milliseconds(lambda value: estimate_tokens(value, CLAUDE_MODEL), text, iterations):.4f} ms")
+
+
+if __name__ == '__main__':
+    bench_sanitize_string_for_json()
+    bench_estimate_tokens()
@@ -25,12 +25,18 @@ const state = {
     audioDataArray: null,
     vadAnimationFrameId: null,
     speechDetectedInChunk: false,
+    chunkStreamer: null, // Uploads the answer being recorded to /transcribe-chunk
 };
 
 // VAD Constants
 const SPEECH_THRESHOLD = 55;
 const FFT_SIZE = 256;
 
+// Streaming transcription: while recording, a new self-contained chunk starts every
+// TRANSCRIBE_CHUNK_MS - TRANSCRIBE_CHUNK_OVERLAP_MS, so consecutive chunks overlap by TRANSCRIBE_CHUNK_OVERLAP_MS
+const TRANSCRIBE_CHUNK_MS = 4000;
+const TRANSCRIBE_CHUNK_OVERLAP_MS = 1000;
+
 // API Base URL
 const API_BASE_URL = 'https://iris-ai-backend.onrender.com';
 
@@ -1772,14 +1778,14 @@ function checkAnalysisStatus(sessionId) {
             unlockSection('prep-plan');
             unlockSection('mock-interview');
             // Check if there's interview history to unlock performance/history
-            fetch(`${API_BASE_URL}/get-progress-history/${sessionId}`)
-                .then(res => res.ok ? res.json() : null)
+            fetchProgressHistory(sessionId)
                 .then(historyData => {
                     if (historyData && historyData.interviews?.length > 0) {
                          unlockSection('performance'); // Unlock based on existing history
                          unlockSection('history');
                     }
-                });
+                })
+                .catch(error => console.error('Error checking interview history:', error));
 
             loadAnalysisResults(sessionId);
             loadPreparationPlan(sessionId);
@@ -1818,22 +1824,32 @@ function loadAnalysisResults(sessionId) {
     });
 }
 
-// New function to load interview data from the progress history
-function loadLatestInterviewData(sessionId) {
-    console.log(`Attempting to load latest interview data for session: ${sessionId}`);
-    
-    // First get the progress history which contains interview IDs
+// Loads progress as { interviews, trends }: for a signed-in user, the progress index across all of their
+// sessions in one request (/get-user-progress); otherwise the current session's own history.
+function fetchProgressHistory(sessionId) {
+    const user = typeof firebase !== 'undefined' ? firebase.auth().currentUser : null;
+    if (user) {
+        return fetch(`${API_BASE_URL}/get-user-progress/${user.uid}`)
+            .then(response => {
+                if (!response.ok) throw new Error(`Failed to get progress history (${response.status})`);
+                return response.json();
+            })
+            .then(data => ({ interviews: data.series || [], trends: data.trends || null, latestAnalysis: data.latestAnalysis || null }));
+    }
     return fetch(`${API_BASE_URL}/get-progress-history/${sessionId}`)
         .then(response => {
-            if (!response.ok) {
-                if (response.status === 404) {
-                    console.log("No interview history found.");
-                    return { interviews: [] };
-                }
-                throw new Error(`Failed to fetch progress history (${response.status})`);
-            }
+            if (response.status === 404) return { interviews: [], trends: null, message: "No history found yet." }; // Handle no history gracefully
+            if (!response.ok) throw new Error(`Failed to get progress history (${response.status})`);
             return response.json();
-        })
+        });
+}
+
+// New function to load interview data from the progress history
+function loadLatestInterviewData(sessionId, knownHistory = null) {
+    console.log(`Attempting to load latest interview data for session: ${sessionId}`);
+    
+    // First get the progress history which contains interview IDs (reuse it if the caller already has it)
+    return (knownHistory ? Promise.resolve(knownHistory) : fetchProgressHistory(sessionId))
         .then(historyData => {
             if (!historyData.interviews || historyData.interviews.length === 0) {
                 console.log("No interviews found in history.");
@@ -2917,10 +2933,13 @@ function setupMediaRecorder(stream) {
 
             // --- Reset flag AFTER checking ---
             state.speechDetectedInChunk = false;
+            const chunkStreamer = state.chunkStreamer;
+            state.chunkStreamer = null;
 
             // --- Make decision based on the check ---
             if (!speechWasDetectedInThisSegment || currentAudioChunks.length === 0) {
                 console.warn(`No speech detected in last segment (flag=${speechWasDetectedInThisSegment}) or no audio data captured. Discarding.`);
+                if (chunkStreamer) chunkStreamer.cancel();
 
                 // Restart listening if the interview is still active and AI isn't talking
                 if (state.isInterviewActive && !state.isAIResponding) {
@@ -2939,7 +2958,7 @@ function setupMediaRecorder(stream) {
             const mimeType = state.mediaRecorder.mimeType || options.mimeType || 'audio/webm';
             const audioBlob = new Blob(currentAudioChunks, { type: mimeType });
 
-            processAudioResponse(audioBlob, mimeType); // Pass mimeType
+            processAudioResponse(audioBlob, mimeType, chunkStreamer); // Pass mimeType
         };
         // **** END MODIFIED onstop handler ****
 
@@ -2953,6 +2972,8 @@ function setupMediaRecorder(stream) {
             clearInterval(state.recordingTimer);
             state.speechDetectedInChunk = false; // Reset on error
             state.audioChunks = []; // Clear chunks on error
+            if (state.chunkStreamer) state.chunkStreamer.cancel();
+            state.chunkStreamer = null;
         };
 
         console.log("MediaRecorder setup complete.");
@@ -3026,7 +3047,7 @@ function startMockInterview() {
         }
         return response.json();
     })
-    .then(data => { // data contains { interviewId, sessionId, interviewType, greeting, usageInfo }
+    .then(data => { // data contains { interviewId, sessionId, interviewType, greeting, greetingAudioBase64, greetingAudioFormat, usageInfo }
         console.log('Interview started response:', data);
         if (!data.interviewId || !data.greeting) {
             throw new Error("Invalid response from start-mock-interview");
@@ -3054,7 +3075,8 @@ function startMockInterview() {
 
         // Display and speak greeting
         addMessageToConversation('interviewer', data.greeting);
-        generateAndPlayTTS(data.greeting); // Triggers listening when done
+        // Greeting audio is synthesized during start; /generate-tts is only called if that failed
+        generateAndPlayTTS(data.greeting, { audioBase64: data.greetingAudioBase64, format: data.greetingAudioFormat }); // Triggers listening when done
 
         // Reset button states (or maybe hide/change function)
         if(startBtn1) { startBtn1.disabled = false; startBtn1.textContent = 'Start Interview'; }
@@ -3151,6 +3173,12 @@ function startListeningAutomatically() {
     try {
         state.mediaRecorder.start(); // Start recorder (records continuously until stopped)
         console.log("MediaRecorder started for automatic listening.");
+        try {
+            state.chunkStreamer = createChunkStreamer(state.interviewId);
+        } catch (e) {
+            console.warn("Streaming transcription unavailable, the full recording will be transcribed:", e);
+            state.chunkStreamer = null;
+        }
         if(micIcon) micIcon.classList.remove('fa-microphone-slash'); // Ensure visual state is correct
         if(micIcon) micIcon.classList.add('fa-microphone-alt', 'text-danger'); // Indicate listening
 
@@ -3349,7 +3377,7 @@ function stopRecordingAndProcess() {
     console.log(`stopRecordingAndProcess finished.`); // Removed speech detected log here as it's checked in onstop
 }
 
-function processAudioResponse(audioBlob, mimeType = 'audio/webm') {
+function processAudioResponse(audioBlob, mimeType = 'audio/webm', chunkStreamer = null) {
      console.log(`Processing recorded audio blob. Size: ${audioBlob.size}, Type: ${mimeType}`);
      // document.getElementById('processingIndicator').style.display = 'none'; // Hide processing indicator
 
@@ -3359,6 +3387,7 @@ function processAudioResponse(audioBlob, mimeType = 'audio/webm') {
     }
      if (audioBlob.size < 100) { // Very small blob might be noise/error
         console.warn("Audio blob size is very small, skipping processing.");
+         if (chunkStreamer) chunkStreamer.cancel();
          // Restart listening?
          if(state.isInterviewActive && !state.isAIResponding) {
              startListeningAutomatically();
@@ -3366,46 +3395,229 @@ function processAudioResponse(audioBlob, mimeType = 'audio/webm') {
         return;
     }
 
-
-    const formData = new FormData();
-    // Use the determined mimeType for the filename extension if possible
-    const fileExtension = mimeType.split('/')[1]?.split(';')[0] || 'webm';
-    const filename = `recording.${fileExtension}`;
-    formData.append('audio', audioBlob, filename);
-    formData.append('interviewId', state.interviewId);
-
-    console.log(`Sending audio to /process-audio as ${filename}`);
     state.isAIResponding = true; // Mark AI as busy while processing audio/getting response
-
-    fetch(`${API_BASE_URL}/process-audio`, {
-        method: 'POST',
-        body: formData
+    animateInterviewer(false);
+
+    // One request for the whole turn: transcript, interviewer reply and its speech arrive as NDJSON events,
+    // and each audio chunk is played as soon as it arrives instead of after the full reply is synthesized.
+    const speech = createSpeechQueue();
+    const replyChunks = [];
+    let transcriptReceived = false;
+    let finished = false;
+
+    // With streaming transcription the answer is already transcribed by the time recording stops;
+    // otherwise (or if the chunk flow failed) the full recording is sent for transcription.
+    const streamedTranscript = chunkStreamer
+        ? chunkStreamer.finish().catch(error => {
+            console.warn('Streaming transcription failed, sending the full recording:', error);
+            return null;
+        })
+        : Promise.resolve(null);
+
+    streamedTranscript
+    .then(transcript => {
+        const formData = new FormData();
+        formData.append('interviewId', state.interviewId);
+        if (transcript !== null) {
+            console.log('Sending streamed transcript to /interview-turn');
+            formData.append('transcript', transcript);
+        } else {
+            // Use the determined mimeType for the filename extension if possible
+            const fileExtension = mimeType.split('/')[1]?.split(';')[0] || 'webm';
+            const filename = `recording.${fileExtension}`;
+            formData.append('audio', audioBlob, filename);
+            console.log(`Sending audio to /interview-turn as ${filename}`);
+        }
+        return fetch(`${API_BASE_URL}/interview-turn`, {
+            method: 'POST',
+            body: formData
+        });
     })
     .then(response => {
-        if (!response.ok) throw new Error(`Transcription failed (${response.status})`);
-        return response.json();
+        if (!response.ok) throw new Error(`Voice turn failed (${response.status})`);
+        return readNdjsonStream(response, event => {
+            if (event.type === 'transcript') {
+                transcriptReceived = true;
+                if (event.text && event.text.trim()) addMessageToConversation('candidate', event.text);
+            } else if (event.type === 'reply_chunk') {
+                replyChunks[event.index] = event.text;
+            } else if (event.type === 'audio') {
+                speech.push({ audioBase64: event.audioBase64, format: event.format });
+            } else if (event.type === 'audio_error') {
+                console.warn(`Speech for reply chunk ${event.index} failed: ${event.error}. Using browser TTS for it.`);
+                speech.push({ text: replyChunks[event.index] });
+            } else if (event.type === 'done') {
+                finished = true;
+                addMessageToConversation('interviewer', event.interviewerResponse);
+                speech.end(); // Listening restarts once the queued speech has played
+            } else if (event.type === 'error') {
+                finished = true;
+                throw new Error(event.error || 'Voice turn failed');
+            }
+        });
     })
-    .then(data => {
-        console.log('Transcription result:', data);
-        if (data.transcription && data.transcription.trim()) {
-            addMessageToConversation('candidate', data.transcription);
-            sendUserResponseToBackend(data.transcription); // Send transcription for AI response
-        } else {
-             console.warn("Empty transcription received.");
-             addMessageToConversation("system", "(No speech detected or transcription failed)");
-             state.isAIResponding = false; // AI finished processing (failed transcription)
-             // Restart listening?
-             if(state.isInterviewActive) startListeningAutomatically();
-        }
+    .then(() => {
+        if (!finished) throw new Error('Voice turn ended unexpectedly');
     })
     .catch(error => {
-        console.error('Error processing audio:', error);
-        alert(`Error processing your response: ${error.message}`);
-        addMessageToConversation("system", `Error processing audio: ${error.message}`);
+        console.error('Error processing voice turn:', error);
+        speech.cancel();
+        if (!transcriptReceived) {
+            alert(`Error processing your response: ${error.message}`);
+            addMessageToConversation("system", `Error processing audio: ${error.message}`);
+        } else if (error.message === 'No speech detected in audio') {
+            addMessageToConversation("system", "(No speech detected or transcription failed)");
+        } else {
+            addMessageToConversation('interviewer', `Sorry, an error occurred: ${error.message}. Let's try again.`);
+        }
+        animateInterviewer(false);
         state.isAIResponding = false; // AI finished processing (error)
-         // Restart listening?
-         if(state.isInterviewActive) startListeningAutomatically();
+        if(state.isInterviewActive) startListeningAutomatically();
+    });
+}
+
+// Uploads the answer being recorded as overlapping self-contained chunks to /transcribe-chunk, one MediaRecorder per
+// chunk on the main recorder's stream. finish() stops recording, marks the newest chunk final and resolves with the
+// running transcript, or null if the chunk flow did not complete and the full recording should be sent instead.
+function createChunkStreamer(interviewId) {
+    const source = state.mediaRecorder;
+    const options = source.mimeType ? { mimeType: source.mimeType } : {};
+    const answerId = `${Date.now()}-${Math.random().toString(36).slice(2, 10)}`;
+    const chunks = [];
+    let sequence = 0, failed = false, cancelled = false;
+
+    const upload = (blob, chunkSequence, final) => {
+        const formData = new FormData();
+        const fileExtension = (blob.type || 'audio/webm').split('/')[1]?.split(';')[0] || 'webm';
+        formData.append('audio', blob, `chunk-${chunkSequence}.${fileExtension}`);
+        formData.append('interviewId', interviewId);
+        formData.append('answerId', answerId);
+        formData.append('sequence', chunkSequence);
+        formData.append('final', final ? 'true' : 'false');
+        return fetch(`${API_BASE_URL}/transcribe-chunk`, { method: 'POST', body: formData })
+            .then(response => {
+                if (!response.ok) throw new Error(`Chunk transcription failed (${response.status})`);
+                return response.json();
+            })
+            .then(data => {
+                if (!final && data.partialTranscript) console.log(`Partial transcript (through chunk ${data.appliedThrough}):`, data.partialTranscript);
+                return data;
+            });
+    };
+
+    const startChunk = () => {
+        const chunkSequence = sequence++;
+        const recorder = new MediaRecorder(source.stream, options);
+        const parts = [];
+        let stopped = false, final = false;
+        recorder.ondataavailable = event => { if (event.data.size > 0) parts.push(event.data); };
+        const uploaded = new Promise(resolve => {
+            recorder.onstop = () => {
+                if (cancelled) return resolve(null);
+                const result = upload(new Blob(parts, { type: recorder.mimeType || options.mimeType || 'audio/webm' }), chunkSequence, final);
+                // Only the final chunk's result is awaited; a lost earlier chunk is skipped by the server
+                resolve(final ? result : result.catch(error => { console.warn(`Chunk ${chunkSequence} upload failed:`, error); return null; }));
+            };
+        });
+        const chunk = {
+            uploaded,
+            stop(isFinal) { // Returns false if the chunk had already stopped
+                if (stopped) return false;
+                stopped = true;
+                final = isFinal;
+                clearTimeout(chunk.timer);
+                recorder.stop();
+                return true;
+            }
+        };
+        chunks.push(chunk);
+        recorder.start();
+        chunk.timer = setTimeout(() => chunk.stop(false), TRANSCRIBE_CHUNK_MS);
+        return chunk;
+    };
+
+    let current = startChunk();
+    const stepTimer = setInterval(() => {
+        try {
+            current = startChunk();
+        } catch (e) {
+            console.warn('Could not start the next transcription chunk:', e);
+            failed = true;
+            clearInterval(stepTimer);
+        }
+    }, TRANSCRIBE_CHUNK_MS - TRANSCRIBE_CHUNK_OVERLAP_MS);
+
+    return {
+        finish() {
+            clearInterval(stepTimer);
+            chunks.forEach(chunk => { if (chunk !== current) chunk.stop(false); });
+            if (!current.stop(true) || failed) return Promise.resolve(null);
+            return current.uploaded.then(data => (data && data.final && !data.dropped ? data.partialTranscript : null));
+        },
+        cancel() {
+            cancelled = true;
+            clearInterval(stepTimer);
+            chunks.forEach(chunk => chunk.stop(false));
+        }
+    };
+}
+
+// Calls onEvent with each parsed line of a newline-delimited JSON response as it arrives
+function readNdjsonStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    const pump = () => reader.read().then(({ done, value }) => {
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        const lines = buffer.split('\n');
+        buffer = done ? '' : lines.pop();
+        lines.forEach(line => { if (line.trim()) onEvent(JSON.parse(line)); });
+        if (!done) return pump();
     });
+    return pump();
+}
+
+// Plays speech chunks in order as they are pushed: backend audio ({audioBase64, format}) or, for a chunk whose
+// synthesis failed, browser TTS ({text}). After end(), listening restarts when the last chunk has played.
+function createSpeechQueue() {
+    const queue = [];
+    let playing = false, ended = false, cancelled = false;
+
+    const finish = () => {
+        animateInterviewer(false);
+        state.isAIResponding = false;
+        if(state.isInterviewActive) startListeningAutomatically();
+    };
+    const playNext = () => {
+        if (cancelled) return;
+        const item = queue.shift();
+        if (!item) {
+            playing = false;
+            if (ended) finish();
+            return;
+        }
+        playing = true;
+        animateInterviewer(true);
+        if (item.audioBase64) {
+            const audio = new Audio(`data:audio/${item.format || 'mp3'};base64,${item.audioBase64}`);
+            audio.onended = playNext;
+            audio.onerror = (e) => { console.error("Error playing backend audio chunk:", e); playNext(); };
+            audio.play().catch(e => { console.error("Audio chunk play failed:", e); playNext(); });
+        } else if (item.text && 'speechSynthesis' in window) {
+            const utterance = new SpeechSynthesisUtterance(item.text);
+            utterance.onend = playNext;
+            utterance.onerror = (event) => { console.error('Browser SpeechSynthesis Error:', event.error); playNext(); };
+            window.speechSynthesis.speak(utterance);
+        } else {
+            playNext();
+        }
+    };
+
+    return {
+        push(item) { queue.push(item); if (!playing) playNext(); },
+        end() { ended = true; if (!playing) playNext(); },
+        cancel() { cancelled = true; queue.length = 0; }
+    };
 }
 
 function sendUserResponseToBackend(userResponse) {
@@ -3446,32 +3658,38 @@ function sendUserResponseToBackend(userResponse) {
 
 // --- TTS Function ---
 
-function generateAndPlayTTS(text) {
+function generateAndPlayTTS(text, prefetchedAudio) {
      if (!text) return;
-     console.log("Requesting TTS for:", text);
      state.isAIResponding = true; // AI is about to speak
      animateInterviewer(true); // Start animation
 
-
-    // --- Attempt 1: Fetch from Backend (Preferred) ---
-    fetch(`${API_BASE_URL}/generate-tts`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ text: text })
-    })
-    .then(response => {
-        if (!response.ok) {
-             // Throw error to trigger fallback
-             throw new Error(`Backend TTS failed (${response.status})`);
-        }
-        return response.json();
-    })
+    // --- Attempt 1: Audio already returned by the backend (e.g. the greeting), else fetch it (Preferred) ---
+    let audioRequest;
+    if (prefetchedAudio && prefetchedAudio.audioBase64) {
+        console.log("Using prefetched TTS audio for:", text);
+        audioRequest = Promise.resolve(prefetchedAudio);
+    } else {
+        console.log("Requesting TTS for:", text);
+        audioRequest = fetch(`${API_BASE_URL}/generate-tts`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ text: text })
+        })
+        .then(response => {
+            if (!response.ok) {
+                 // Throw error to trigger fallback
+                 throw new Error(`Backend TTS failed (${response.status})`);
+            }
+            return response.json();
+        });
+    }
+    audioRequest
     .then(data => {
         if (!data.audioBase64) {
              throw new Error("Backend returned no audio data.");
         }
         console.log("Playing TTS audio from backend");
-        const audio = new Audio(`data:audio/mp3;base64,${data.audioBase64}`);
+        const audio = new Audio(`data:audio/${data.format || 'mp3'};base64,${data.audioBase64}`);
 
         audio.onended = () => {
             console.log("Backend TTS finished playing.");
@@ -3722,14 +3940,14 @@ function pollInterviewAnalysis(interviewId) {
             displayInterviewAnalysis(data); // Display results
 
             // Unlock history section based on results
-            fetch(`${API_BASE_URL}/get-progress-history/${state.sessionId}`)
-                .then(res => res.ok ? res.json() : null)
+            fetchProgressHistory(state.sessionId)
                 .then(historyData => {
                     if (historyData && historyData.interviews?.length > 0) { // Unlock if any history exists
                          unlockSection('performance'); // Ensure performance is unlocked
                          unlockSection('history');
                     }
-                });
+                })
+                .catch(error => console.error('Error checking interview history:', error));
 
              const endBtn = document.getElementById('endInterviewBtn');
              if(endBtn) endBtn.disabled = false; endBtn.textContent = 'End Interview & Analyze'; // Reset button state
@@ -4139,12 +4357,7 @@ function loadProgressHistory() {
             </div>
          </div>`;
 
-    fetch(`${API_BASE_URL}/get-progress-history/${state.sessionId}`)
-    .then(response => {
-        if (response.status === 404) return { interviews: [], trends: null, message: "No history found yet." }; // Handle no history gracefully
-        if (!response.ok) throw new Error(`Failed to get progress history (${response.status})`);
-        return response.json();
-    })
+    fetchProgressHistory(state.sessionId)
     .then(data => {
         console.log('Progress history data:', data);
         // Restore original history section structure
@@ -4440,14 +4653,7 @@ function checkAndLoadSessionStatus(sessionId) {
 function checkAndUnlockHistorySections(sessionIdToCheck) {
     if (!sessionIdToCheck) return; // Need a session ID
     
-    fetch(`${API_BASE_URL}/get-progress-history/${sessionIdToCheck}`)
-        .then(res => {
-            if (!res.ok) {
-                console.log(`No history found or error fetching for session ${sessionIdToCheck} (status: ${res.status}). Keeping sections locked.`);
-                return null;
-            }
-            return res.json();
-        })
+    fetchProgressHistory(sessionIdToCheck)
         .then(historyData => {
             if (historyData && historyData.interviews?.length > 0) {
                 console.log(`Found ${historyData.interviews.length} past interviews for session ${sessionIdToCheck}. Unlocking performance/history.`);
@@ -4455,7 +4661,7 @@ function checkAndUnlockHistorySections(sessionIdToCheck) {
                 unlockSection('history');
                 
                 // Load the interview data and display it
-                loadLatestInterviewData(sessionIdToCheck)
+                loadLatestInterviewData(sessionIdToCheck, historyData)
                     .then(analysisData => {
                         if (analysisData) {
                             restorePerformanceSectionHTML();
@@ -5088,6 +5294,7 @@ function initResumeBuilder() {
     
     // NEW: Update usage UI to display remaining usage
     updateResumeBuilderUsageUI();
+    refreshResumeBuilderUsage();
     
     console.log("Resume builder initialized with usage tracking.");
 }
@@ -5277,16 +5484,22 @@ async function enhanceResumeContent(sectionType, contentElement, button) {
             },
             body: JSON.stringify({
                 sectionType: sectionType,
-                originalContent: originalContent
+                originalContent: originalContent,
+                userId: firebase.auth().currentUser.uid // The server charges the enhancement against this user's quota
             })
         });
 
         if (!response.ok) {
             const errorData = await response.json().catch(() => ({ error: 'Network error or invalid JSON response' }));
+            if (errorData.limitReached) {
+                applyServerUsage('aiEnhance', errorData);
+                showUpgradeModal('aiEnhance');
+            }
             throw new Error(errorData.error || `Failed to enhance content (${response.status})`);
         }
 
         const data = await response.json();
+        applyServerUsage('aiEnhance', data.usageInfo);
 
         if (data.enhancedContent) {
             contentElement.value = data.enhancedContent; // Update the input/textarea
@@ -5426,9 +5639,9 @@ function getResumeData() {
     return data;
 }
 
-function downloadResumePDF() {
+async function downloadResumePDF() {
     // First, check if user can download PDF
-    if (!trackPdfDownload()) {
+    if (!(await trackPdfDownload())) {
         return; // Stop if limit is reached or user not logged in
     }
 
@@ -6758,7 +6971,7 @@ function applyDocumentSize() {
 }
 
 // Tracks usage of PDF downloads
-function trackPdfDownload() {
+async function trackPdfDownload() {
     // Check if user is logged in
     if (!firebase.auth().currentUser) {
         showMessage('Please sign in to download PDFs', 'warning');
@@ -6773,21 +6986,56 @@ function trackPdfDownload() {
         return false;
     }
     
-    // Increment usage counter
-    if (typeof irisAuth !== 'undefined' && typeof irisAuth.incrementUsageCounter === 'function') {
-        irisAuth.incrementUsageCounter('pdfDownloads')
-            .then(result => {
-                console.log('PDF download usage updated:', result);
-                updateResumeBuilderUsageUI();
-            })
-            .catch(error => {
-                console.error('Failed to update PDF download usage:', error);
-            });
+    // Record the download on the server, which enforces the limit
+    try {
+        const response = await fetch(`${API_BASE_URL}/record-feature-usage`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ userId: firebase.auth().currentUser.uid, feature: 'pdfDownloads' })
+        });
+        const data = await response.json().catch(() => ({}));
+        applyServerUsage('pdfDownloads', data);
+        if (data.limitReached) {
+            showMessage(`You've reached your PDF download limit (${data.used}/${data.limit}). Please upgrade your plan to continue.`, 'warning');
+            showUpgradeModal('pdfDownloads');
+            return false;
+        }
+        if (!response.ok) {
+            showMessage(data.error || 'Could not record PDF download. Please try again.', 'danger');
+            return false;
+        }
+    } catch (error) {
+        console.error('Failed to record PDF download usage:', error);
+        showMessage('Could not record PDF download. Please try again.', 'danger');
+        return false;
     }
     
     return true;
 }
 
+// Applies usage counts returned by the server (which include sharded counters) to the local profile
+function applyServerUsage(featureType, usageInfo) {
+    const userProfile = irisAuth?.getUserProfile();
+    if (!userProfile || !userProfile.usage || !usageInfo || typeof usageInfo.used !== 'number') return;
+    userProfile.usage[featureType] = { used: usageInfo.used, limit: usageInfo.limit };
+    updateResumeBuilderUsageUI();
+}
+
+// Loads server-side usage for the resume builder features, since the profile document excludes sharded counts
+async function refreshResumeBuilderUsage() {
+    const user = firebase.auth().currentUser;
+    if (!user) return;
+    try {
+        const response = await fetch(`${API_BASE_URL}/get-user-usage/${user.uid}`);
+        if (!response.ok) return;
+        const data = await response.json();
+        applyServerUsage('pdfDownloads', data.pdfDownloads);
+        applyServerUsage('aiEnhance', data.aiEnhance);
+    } catch (error) {
+        console.error('Failed to load resume builder usage:', error);
+    }
+}
+
 // Tracks usage of AI enhance feature
 function trackAiEnhance() {
     // Check if user is logged in
@@ -6799,23 +7047,11 @@ function trackAiEnhance() {
         return false;
     }
     
-    // Check usage limit
+    // Check usage limit (the server charges the enhancement and enforces the limit)
     if (!checkFeatureAccess('aiEnhance')) {
         return false;
     }
     
-    // Increment usage counter
-    if (typeof irisAuth !== 'undefined' && typeof irisAuth.incrementUsageCounter === 'function') {
-        irisAuth.incrementUsageCounter('aiEnhance')
-            .then(result => {
-                console.log('AI enhance usage updated:', result);
-                updateResumeBuilderUsageUI();
-            })
-            .catch(error => {
-                console.error('Failed to update AI enhance usage:', error);
-            });
-    }
-    
     return true;
 }
 
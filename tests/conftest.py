@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend.py is a top-level module, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
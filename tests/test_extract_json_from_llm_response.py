@@ -0,0 +1,39 @@
+import pytest
+
+from backend import extract_json_from_llm_response
+
+
+def test_complete_object_inside_prose_and_fences():
+    parsed, repairs = extract_json_from_llm_response('Here you go:\n```json\n{"a": [1, "x}"]}\n```\nThanks')
+    assert parsed == {'a': [1, 'x}']}
+    assert repairs == []
+
+
+@pytest.mark.parametrize('text, root, expected', [
+    # An unfinished trailing member is dropped, not closed into an empty container
+    ('[{"a":1}, {"b"', '[', [{'a': 1}]),
+    ('[{"a":1}, {"b": ', '[', [{'a': 1}]),
+    ('{"q": [{"a": 1}, [', '{', {'q': [{'a': 1}]}),
+    ('{"a": 1, "b": {', '{', {'a': 1}),
+    # A trailing number may itself be cut short, so its key is dropped (and reported)
+    ('{"a": 1', '{', {}),
+    ('{"a": 1, "b": 23', '{', {'a': 1}),
+    # Complete literals, strings and partial objects with complete members are kept
+    ('{"a": true', '{', {'a': True}),
+    ('{"a": "hel', '{', {'a': 'hel'}),
+    ('[{"a": 1, "b": 2, "c"', '[', [{'a': 1, 'b': 2}]),
+])
+def test_truncated_tail_repair(text, root, expected):
+    parsed, repairs = extract_json_from_llm_response(text, root=root)
+    assert parsed == expected
+    assert repairs
+
+
+def test_dropped_scalar_is_reported():
+    _, repairs = extract_json_from_llm_response('{"a": 1')
+    assert any('dropped incomplete trailing content' in repair and '"a": 1' in repair for repair in repairs)
+
+
+def test_unrepairable_input_raises():
+    with pytest.raises(ValueError):
+        extract_json_from_llm_response('no json here')
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from backend import sanitize_string_for_json
+
+
+def reference_sanitize_string_for_json(text):
+    """The character-loop implementation sanitize_string_for_json replaced; the translate table must match it."""
+    if not isinstance(text, str):
+        return text
+    cleaned_text = ''
+    for char in text:
+        if ord(char) >= 32 and ord(char) != 127:
+            cleaned_text += char
+        elif char in ['\n', '\t', '\r']:
+            cleaned_text += ' '
+    cleaned_text = cleaned_text.replace('\\', '\\\\')
+    checked_text = ''
+    for char in cleaned_text:
+        if 31 < ord(char) < 127 or ord(char) > 127:
+            checked_text += char
+        else:
+            checked_text += ' '
+    return checked_text.strip()
+
+
+# Control characters, DEL, backslashes, quotes, non-ASCII (incl. Unicode whitespace) and lone surrogates
+SAMPLE_ALPHABET = ([chr(code) for code in range(32)] + ['\x7f', '\\', '"', "'", ' ', 'a', 'Z', '0', '{', '}',
+                   '\u00e9', '\u0915', '\u2028', '\u3000', '\U0001F600', '\ud800', '\udfff'])
+
+
+def random_text(rng, max_length=64):
+    return ''.join(rng.choice(SAMPLE_ALPHABET) if rng.random() < 0.8 else chr(rng.randrange(0x110000))
+                   for _ in range(rng.randrange(max_length + 1)))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_matches_reference_on_random_strings(seed):
+    rng = random.Random(seed)
+    for _ in range(2000):
+        text = random_text(rng)
+        assert sanitize_string_for_json(text) == reference_sanitize_string_for_json(text), repr(text)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("  line one\nline\ttwo\r\n", "line one line two"),
+    ("C:\\path", "C:\\\\path"),
+    ("bell\x07 and del\x7f", "bell and del"),
+    ("", ""),
+])
+def test_examples(text, expected):
+    assert sanitize_string_for_json(text) == expected
+
+
+@pytest.mark.parametrize('value', [None, 42, 1.5, ['a'], {'a': 1}])
+def test_non_strings_pass_through(value):
+    assert sanitize_string_for_json(value) is value
@@ -0,0 +1,34 @@
+import pytest
+
+import backend
+from backend import estimate_tokens, observe_token_usage, truncate_to_token_budget
+
+
+@pytest.fixture(autouse=True)
+def fresh_calibration(monkeypatch):
+    monkeypatch.setattr(backend, '_token_calibration', {})
+
+
+def test_estimate_tokens_counts_utf8_bytes():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('abcd' * 100) == 100
+    assert estimate_tokens('कार्य' * 10) > estimate_tokens('abcde' * 10) # multi-byte scripts cost more per char
+
+
+def test_calibration_scales_estimates_and_ignores_outliers():
+    observe_token_usage('model-a', 100, 150)
+    assert estimate_tokens('abcd' * 100, 'model-a') == 150
+    assert estimate_tokens('abcd' * 100, 'model-a', calibrated=False) == 100
+    observe_token_usage('model-a', 100, 1000) # outside TOKEN_CALIBRATION_BOUNDS
+    assert backend._token_calibration['model-a']['samples'] == 1
+
+
+@pytest.mark.parametrize('text', ['word ' * 5000, 'कार्य अनुभव ' * 2000, 'x' * 20000])
+def test_truncate_fits_budget(text):
+    truncated = truncate_to_token_budget(text, 500)
+    assert estimate_tokens(truncated) <= 500
+    assert truncated.endswith('[... truncated to fit token budget]')
+
+
+def test_truncate_keeps_text_within_budget():
+    assert truncate_to_token_budget('short text', 500) == 'short text'